@@ -347,36 +347,21 @@ EOF
 
     # 1. Файл состояния
     FIREWALL_STATE_FILE="${INSTALL_DIR}/firewall_mode.state"
-    echo "flushed" > "$FIREWALL_STATE_FILE"
+    echo '{"mode": "flushed"}' > "$FIREWALL_STATE_FILE"
     add_m "file:$FIREWALL_STATE_FILE"
 
     # 2. Главный скрипт автозапуска
     AUTORUN_SCRIPT_PATH="${SCRIPTS_DIR}/kdw-firewall-autorun.sh"
     cat > "$AUTORUN_SCRIPT_PATH" << 'EOF'
 #!/bin/sh
-STATE_FILE="/opt/etc/kdw/firewall_mode.state"
-SCRIPTS_DIR="/opt/etc/kdw/scripts"
-
-if [ ! -f "$STATE_FILE" ]; then
-    exit 0
-fi
-
-MODE=$(cat "$STATE_FILE")
-
-case "$MODE" in
-    lists_only)
-        sh "${SCRIPTS_DIR}/kdw_apply_proxy_lists.sh"
-        ;;
-    all_traffic)
-        # Для этого режима нужны параметры, которые бот передает при интерактивном запуске.
-        # При автозапуске мы не можем их знать, поэтому просто сбрасываем правила.
-        # Это безопасное поведение по умолчанию.
-        sh "${SCRIPTS_DIR}/kdw_flush_proxy_rules.sh"
-        ;;
-    flushed)
-        sh "${SCRIPTS_DIR}/kdw_flush_proxy_rules.sh"
-        ;;
-esac
+# Приводит Firewall к состоянию из firewall_mode.state. Если правила и
+# ipset уже соответствуют режиму, ничего не меняется, поэтому скрипт
+# можно вызывать из системных хуков сколько угодно часто.
+KDW_DIR="/opt/etc/kdw"
+PYTHON="${KDW_DIR}/venv/bin/python"
+[ -x "$PYTHON" ] || PYTHON="python3"
+
+cd "$KDW_DIR" && "$PYTHON" -m core.firewall reconcile
 EOF
     chmod +x "$AUTORUN_SCRIPT_PATH"
     add_m "file:$AUTORUN_SCRIPT_PATH"
@@ -0,0 +1,131 @@
+import os
+import glob
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .shell_utils import run_shell_command
+from .log_utils import log
+from .ipset_manager import dynamic_set_name
+
+# Директория, подключенная в dnsmasq.conf через conf-dir=/opt/etc/kdw/ipsets,*.conf
+DNSMASQ_IPSETS_DIR = "/opt/etc/kdw/ipsets"
+# Шаблон init-скрипта dnsmasq в Entware
+DNSMASQ_INIT_PATTERN = "/opt/etc/init.d/S*dnsmasq*"
+# dnsmasq читает строки конфигурации в буфер ограниченного размера,
+# поэтому длинный список доменов разбивается на несколько директив
+MAX_LINE_LENGTH = 1000
+
+
+def compile_ipset_lines(domains: Iterable[str], set_name: str) -> List[str]:
+    """
+    Собирает директивы dnsmasq `ipset=/d1/d2/.../set` для доменов.
+    В одну строку попадает столько доменов, сколько помещается
+    в MAX_LINE_LENGTH: так dnsmasq быстрее разбирает конфигурацию
+    и тратит меньше памяти, чем на директиву для каждого домена.
+    """
+    suffix = f"/{set_name}"
+    lines = []
+    current = "ipset="
+    for domain in sorted(set(domains)):
+        if len(current) + len(domain) + 1 + len(suffix) > MAX_LINE_LENGTH and current != "ipset=":
+            lines.append(current + suffix)
+            current = "ipset="
+        current += f"/{domain}"
+    if current != "ipset=":
+        lines.append(current + suffix)
+    return lines
+
+
+class DnsmasqManager:
+    """
+    Генерирует для dnsmasq правила `ipset=` из списков доменов.
+
+    dnsmasq сам добавляет IP-адреса домена и всех его поддоменов
+    в ipset списка в момент DNS-запроса, поэтому домены не нужно
+    заранее разрешать при применении списков.
+    """
+
+    def __init__(self, ipsets_dir: Optional[str] = None):
+        self.ipsets_dir = ipsets_dir or DNSMASQ_IPSETS_DIR
+
+    def conf_path(self, list_name: str) -> str:
+        """Возвращает путь к файлу правил dnsmasq для списка."""
+        return os.path.join(self.ipsets_dir, f"{list_name}.conf")
+
+    def write_list(self, list_name: str, domains: Iterable[str]) -> Tuple[bool, int]:
+        """
+        Записывает правила для списка, если они изменились.
+
+        Returns:
+            Кортеж (изменился ли файл, число директив в файле).
+        """
+        lines = compile_ipset_lines(domains, dynamic_set_name(list_name))
+        content = "".join(f"{line}\n" for line in lines)
+        path = self.conf_path(list_name)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                if f.read() == content:
+                    return False, len(lines)
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(self.ipsets_dir, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return True, len(lines)
+
+    def covers_subdomains(self, list_name: str) -> bool:
+        """
+        Проверяет, что поддомены записей списка маршрутизируются через
+        dnsmasq: dnsmasq установлен и правила ipset= для списка записаны.
+        Без этого в ipset попадают только адреса самих записей, и запись
+        родителя поддомены не покрывает.
+        """
+        return bool(glob.glob(DNSMASQ_INIT_PATTERN)) and os.path.exists(self.conf_path(list_name))
+
+    async def reload(self) -> Tuple[bool, str]:
+        """
+        Перезапускает dnsmasq, чтобы он перечитал правила.
+        SIGHUP здесь не подходит: по нему dnsmasq перечитывает только
+        hosts-файлы, но не conf-dir с директивами ipset=.
+        """
+        scripts = glob.glob(DNSMASQ_INIT_PATTERN)
+        if not scripts:
+            return False, "init-скрипт dnsmasq не найден"
+        return await run_shell_command(f"sh {scripts[0]} restart")
+
+    async def sync(self, lists: Dict[str, Iterable[str]]) -> Tuple[bool, str]:
+        """
+        Обновляет правила dnsmasq для переданных списков доменов.
+        dnsmasq перезапускается только если хотя бы один файл изменился.
+
+        Args:
+            lists: Словарь имя списка -> домены.
+
+        Returns:
+            Кортеж (успех, отчет).
+        """
+        report = []
+        changed = False
+        try:
+            for list_name, domains in lists.items():
+                domains = list(domains)
+                list_changed, lines = self.write_list(list_name, domains)
+                changed = changed or list_changed
+                report.append(f"{list_name}: dnsmasq {len(domains)} доменов в {lines} строках")
+        except Exception as e:
+            log.error(f"Не удалось записать правила dnsmasq: {e}")
+            return False, "\n".join(report + [f"Ошибка записи правил dnsmasq: {e}"])
+
+        if not changed:
+            report.append("Правила dnsmasq не изменились.")
+            return True, "\n".join(report)
+
+        success, output = await self.reload()
+        if success:
+            report.append("dnsmasq перезапущен с новыми правилами.")
+        else:
+            log.error(f"Не удалось перезапустить dnsmasq: {output}")
+            report.append(f"Ошибка перезапуска dnsmasq: {output}")
+        return success, "\n".join(report)
@@ -0,0 +1,562 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+from configparser import ConfigParser
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .shell_utils import run_shell_command
+from .log_utils import log
+from .list_registry import ListRegistry, get_registry, CONFIG_FILE
+from .ipset_manager import IpsetManager, ipset_name
+from . import list_manager
+
+# Цепочка KDW в таблице nat и правило перехода в нее из PREROUTING
+CHAIN = "KDW_PROXY"
+HOOK_RULE = f"-A PREROUTING -j {CHAIN}"
+# Пакетные файлы для iptables-restore и ipset restore. Лежат в /tmp (RAM),
+# чтобы не изнашивать flash
+RESTORE_FILE = "/tmp/kdw_iptables.restore"
+IPSET_RESTORE_FILE = "/tmp/kdw_ipset_flush.restore"
+# Префикс имен ipset KDW
+IPSET_PREFIX = "kdw_"
+# Выбранный в боте режим Firewall и скомпилированные для него правила (JSON)
+FIREWALL_STATE_FILE = "/opt/etc/kdw/firewall_mode.state"
+# Отпечаток последнего согласованного состояния. Лежит в /tmp: после
+# перезагрузки правил в ядре нет, и первое согласование применяет все заново
+FINGERPRINT_FILE = "/tmp/kdw_firewall.fingerprint"
+# Локальные и служебные сети, которые в режиме "весь трафик" идут напрямую,
+# иначе трафик прокси к самому себе зациклится
+EXCLUDE_NETS = (
+    "0.0.0.0/8", "10.0.0.0/8", "127.0.0.0/8", "169.254.0.0/16",
+    "172.16.0.0/12", "192.168.0.0/16", "224.0.0.0/4", "240.0.0.0/4",
+)
+
+# Режимы Firewall (поле mode файла состояния firewall_mode.state)
+MODE_LISTS = "lists_only"
+MODE_ALL = "all_traffic"
+MODE_FLUSHED = "flushed"
+
+
+def compile_lists_rules(registry: ListRegistry, existing_sets: Optional[Set[str]] = None) -> List[str]:
+    """
+    Собирает правила цепочки для режима "по спискам".
+
+    Списки direct идут первыми (RETURN): их адреса не проксируются, даже
+    если попали и в список прокси. Затем каждому списку прокси - REDIRECT
+    на его порт. Правила для ipset, которых нет в ядре, пропускаются:
+    iptables-restore отверг бы всю транзакцию из-за одной ссылки.
+
+    Args:
+        registry: Реестр списков.
+        existing_sets: Имена существующих ipset; None - не проверять.
+    """
+    returns, redirects = [], []
+    for spec in registry:
+        set_name = ipset_name(spec.name)
+        if existing_sets is not None and set_name not in existing_sets:
+            continue
+        if spec.direct:
+            returns.append(f"-A {CHAIN} -m set --match-set {set_name} dst -j RETURN")
+        else:
+            redirects.append(f"-A {CHAIN} -p tcp -m set --match-set {set_name} dst -j REDIRECT --to-ports {spec.port}")
+    return returns + redirects
+
+
+def compile_all_traffic_rules(port: int, exclude: Iterable[str] = EXCLUDE_NETS) -> List[str]:
+    """Собирает правила цепочки для режима "весь трафик" через один порт прокси."""
+    rules = [f"-A {CHAIN} -d {net} -j RETURN" for net in exclude]
+    rules.append(f"-A {CHAIN} -p tcp -j REDIRECT --to-ports {port}")
+    return rules
+
+
+def compile_restore(rules: Iterable[str], hooked: bool) -> str:
+    """
+    Собирает транзакцию для `iptables-restore --noflush`.
+
+    Объявление цепочки очищает ее (или создает), и новые правила
+    появляются в том же коммите: ядро получает таблицу nat целиком
+    один раз, а цепочка ни в какой момент не бывает собранной наполовину.
+    Остальные цепочки nat с --noflush не затрагиваются.
+
+    Args:
+        rules: Правила цепочки в формате iptables-save.
+        hooked: Переход из PREROUTING в цепочку уже есть.
+    """
+    lines = ["*nat", f":{CHAIN} - [0:0]"]
+    if not hooked:
+        lines.append(f"-I PREROUTING 1 -j {CHAIN}")
+    lines.extend(rules)
+    lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+
+def _is_kdw_rule(rule: str) -> bool:
+    """Проверяет, что правило переходит в цепочку KDW или использует ipset KDW."""
+    words = rule.split()
+    for option, value in zip(words, words[1:]):
+        if option in ("-j", "-g") and value == CHAIN:
+            return True
+        if option == "--match-set" and value.startswith(IPSET_PREFIX):
+            return True
+    return False
+
+
+def compile_flush(nat_dump: str) -> Optional[str]:
+    """
+    Собирает транзакцию удаления всех правил KDW по выводу
+    `iptables-save -t nat`.
+
+    Каждое правило вне цепочки KDW, которое в нее переходит или ссылается
+    на ipset KDW, удаляется командой -D с той же спецификацией; сама
+    цепочка очищается и удаляется. Таблица читается один раз, поэтому
+    стоимость линейна по числу правил, а не квадратична.
+
+    Returns:
+        Текст транзакции или None, если удалять нечего.
+    """
+    in_nat = False
+    has_chain = False
+    deletions = []
+    for line in nat_dump.splitlines():
+        line = line.strip()
+        if line.startswith("*"):
+            in_nat = line == "*nat"
+        elif not in_nat:
+            continue
+        elif line.startswith(f":{CHAIN} "):
+            has_chain = True
+        elif line.startswith("-A ") and not line.startswith(f"-A {CHAIN} ") and _is_kdw_rule(line):
+            deletions.append("-D " + line[3:])
+
+    if not has_chain and not deletions:
+        return None
+    lines = ["*nat"]
+    if has_chain:
+        lines.append(f":{CHAIN} - [0:0]")
+    lines.extend(deletions)
+    if has_chain:
+        lines.append(f"-X {CHAIN}")
+    lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+
+def compile_ipset_flush(set_names: Iterable[str]) -> List[str]:
+    """
+    Собирает пакет `ipset restore`, удаляющий ipset KDW. Сначала все они
+    очищаются: list:set отпускает свои части, и порядок удаления неважен.
+    """
+    names = sorted(name for name in set_names if name.startswith(IPSET_PREFIX))
+    return [f"flush {name}" for name in names] + [f"destroy {name}" for name in names]
+
+
+def _digest(parts: Iterable[str]) -> str:
+    """Хэш набора строк для отпечатка состояния."""
+    return hashlib.sha1("\n".join(parts).encode('utf-8')).hexdigest()
+
+
+def live_signature(nat_dump: str, set_names: Iterable[str]) -> str:
+    """
+    Отпечаток живого состояния: правила KDW из вывода `iptables-save -t nat`
+    (цепочка, ее правила и переходы в нее) и имена ipset KDW. Содержимое
+    ipset в отпечаток не входит: его между применениями меняет dnsmasq.
+    """
+    in_nat = False
+    lines = []
+    for line in nat_dump.splitlines():
+        line = line.strip()
+        if line.startswith("*"):
+            in_nat = line == "*nat"
+        elif in_nat and (line.startswith((f":{CHAIN} ", f"-A {CHAIN} ")) or (line.startswith("-A ") and _is_kdw_rule(line))):
+            lines.append(line.split(" [", 1)[0] if line.startswith(":") else line)
+    lines.extend(sorted(name for name in set_names if name.startswith(IPSET_PREFIX)))
+    return _digest(lines)
+
+
+class FirewallState:
+    """
+    Запись файла состояния Firewall: режим, прокси и порт режима
+    "весь трафик", исключенные сети и скомпилированные правила цепочки
+    с их хэшем. Пишется ботом при смене режима; при загрузке правила
+    восстанавливаются из записи как есть, без повторного вывода
+    параметров из kdw.cfg.
+    """
+
+    def __init__(self, mode: str, proxy: Optional[str] = None, port: Optional[int] = None,
+                 exclude: Iterable[str] = EXCLUDE_NETS, rules: Optional[List[str]] = None,
+                 rules_hash: Optional[str] = None):
+        self.mode = mode
+        self.proxy = proxy
+        self.port = port
+        self.exclude = list(exclude)
+        self.rules = list(rules or [])
+        self.rules_hash = rules_hash if rules_hash is not None else _digest(self.rules)
+
+    @classmethod
+    def compile(cls, mode: str, proxy: Optional[str] = None, port: Optional[int] = None) -> "FirewallState":
+        """
+        Строит запись для режима. Правила сохраняются только для режима
+        "весь трафик": в режиме "по спискам" они зависят от ipset в ядре
+        и собираются при каждом применении.
+        """
+        rules = compile_all_traffic_rules(port) if mode == MODE_ALL and port else []
+        return cls(mode, proxy, port, rules=rules)
+
+    @property
+    def intact(self) -> bool:
+        """Правила записи совпадают со своим хэшем."""
+        return _digest(self.rules) == self.rules_hash
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "mode": self.mode,
+            "proxy": self.proxy,
+            "port": self.port,
+            "exclude": self.exclude,
+            "rules": self.rules,
+            "rules_hash": self.rules_hash,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, object]) -> "FirewallState":
+        return cls(data.get("mode") or MODE_FLUSHED, data.get("proxy"), data.get("port"),
+                   data.get("exclude", EXCLUDE_NETS), data.get("rules"), data.get("rules_hash"))
+
+
+def read_state(path: Optional[str] = None) -> FirewallState:
+    """
+    Читает файл состояния Firewall. Понимает и прежний формат - одно
+    имя режима текстом. Без файла состояния режим - flushed.
+    """
+    try:
+        with open(path or FIREWALL_STATE_FILE, 'r', encoding='utf-8') as f:
+            content = f.read().strip()
+    except FileNotFoundError:
+        return FirewallState(MODE_FLUSHED)
+    if not content.startswith("{"):
+        return FirewallState(content or MODE_FLUSHED)
+    try:
+        return FirewallState.from_dict(json.loads(content))
+    except ValueError as e:
+        log.warning(f"Поврежден файл состояния Firewall {path or FIREWALL_STATE_FILE}: {e}")
+        return FirewallState(MODE_FLUSHED)
+
+
+def write_state(state: FirewallState, path: Optional[str] = None) -> None:
+    """Атомарно записывает файл состояния Firewall."""
+    path = path or FIREWALL_STATE_FILE
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state.to_dict(), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+async def _run_batch(command: str, path: str, content: str) -> Tuple[bool, str]:
+    """Записывает пакет во временный файл и скармливает его команде одним вызовом."""
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return await run_shell_command(f"{command} < {path}")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class FirewallManager:
+    """
+    Компилирует цепочку KDW_PROXY из реестра списков и режима и
+    применяет ее одним вызовом `iptables-restore --noflush`; так же,
+    одной транзакцией, удаляет все правила KDW.
+    """
+
+    def __init__(self, registry: Optional[ListRegistry] = None):
+        self.registry = registry or get_registry()
+
+    async def get_existing_sets(self) -> Set[str]:
+        """Возвращает имена ipset, существующих в ядре."""
+        success, output = await run_shell_command("ipset -n list")
+        return set(output.split()) if success else set()
+
+    async def is_hooked(self) -> bool:
+        """Проверяет, есть ли переход из PREROUTING в цепочку KDW."""
+        success, output = await run_shell_command("iptables -t nat -S PREROUTING")
+        return success and HOOK_RULE in output.splitlines()
+
+    async def restore(self, content: str) -> Tuple[bool, str]:
+        """Применяет транзакцию одним вызовом iptables-restore."""
+        return await _run_batch("iptables-restore --noflush", RESTORE_FILE, content)
+
+    async def flush(self, keep_ipsets: bool = False) -> Tuple[bool, str]:
+        """
+        Удаляет все правила KDW одной транзакцией iptables-restore и,
+        если не задано keep_ipsets, все ipset KDW одним пакетом ipset restore.
+
+        Returns:
+            Кортеж (успех, отчет).
+        """
+        started = time.monotonic()
+        report = []
+        success = True
+
+        dumped, nat_dump = await run_shell_command("iptables-save -t nat")
+        transaction = compile_flush(nat_dump) if dumped else None
+        if not dumped:
+            report.append("iptables недоступен, правила не очищались.")
+        elif transaction is None:
+            report.append("Правил KDW в iptables нет.")
+        else:
+            restored, output = await self.restore(transaction)
+            removed = sum(line.startswith("-D ") for line in transaction.splitlines())
+            if restored:
+                report.append(f"Удалена цепочка {CHAIN} и переходов в нее: {removed}")
+            else:
+                success = False
+                log.error(f"Не удалось очистить правила KDW: {output}")
+                report.append(f"Ошибка iptables-restore, правила не изменены:\n{output}")
+
+        if keep_ipsets:
+            report.append("ipset-списки KDW сохранены.")
+        elif success:
+            batch = compile_ipset_flush(await self.get_existing_sets())
+            if batch:
+                destroyed, output = await _run_batch("ipset restore", IPSET_RESTORE_FILE, "\n".join(batch) + "\n")
+                if destroyed:
+                    report.append(f"Удалено ipset-списков KDW: {len(batch) // 2}")
+                else:
+                    success = False
+                    report.append(f"Ошибка удаления ipset-списков:\n{output}")
+
+        report.append(f"Время очистки: {(time.monotonic() - started) * 1000:.0f} мс")
+        return success, "\n".join(report)
+
+    async def legacy_sets(self) -> List[str]:
+        """
+        Возвращает ipset списков старого формата: один hash:net вместо
+        list:set. Пока на такой ipset ссылаются правила, заменить его нельзя.
+        """
+        sets = await IpsetManager().get_existing_sets()
+        names = [ipset_name(spec.name) for spec in self.registry]
+        return [name for name in names if name in sets and sets[name]["type"] != "list:set"]
+
+    async def detach(self, legacy: List[str]) -> Tuple[bool, str]:
+        """
+        Снимает правила KDW, сохраняя ipset, чтобы синхронизация списков
+        могла заменить ipset старого формата на list:set. Правила затем
+        применяются заново.
+        """
+        if not legacy:
+            return True, "ipset старого формата нет."
+        success, output = await self.flush(keep_ipsets=True)
+        return success, f"ipset старого формата ({', '.join(legacy)}): правила KDW сняты для перехода на list:set.\n{output}"
+
+    async def apply(self, mode: str, port: Optional[int] = None) -> Tuple[bool, str]:
+        """
+        Приводит цепочку KDW_PROXY к заданному режиму.
+
+        Args:
+            mode: MODE_LISTS или MODE_ALL.
+            port: Порт прокси для MODE_ALL.
+
+        Returns:
+            Кортеж (успех, отчет).
+        """
+        if mode == MODE_LISTS:
+            existing = await self.get_existing_sets()
+            rules = compile_lists_rules(self.registry, existing)
+            missing = [spec.name for spec in self.registry if ipset_name(spec.name) not in existing]
+            return await self.apply_rules(rules, missing)
+        if mode == MODE_ALL:
+            if not port:
+                return False, "Не задан порт прокси для режима 'весь трафик'."
+            return await self.apply_rules(compile_all_traffic_rules(port))
+        return False, f"Неизвестный режим Firewall: {mode}"
+
+    async def apply_rules(self, rules: List[str], missing: Iterable[str] = ()) -> Tuple[bool, str]:
+        """
+        Заменяет цепочку KDW_PROXY готовыми правилами одной транзакцией.
+
+        Args:
+            rules: Правила цепочки в формате iptables-save.
+            missing: Списки без ipset, для отчета.
+        """
+        started = time.monotonic()
+        success, output = await self.restore(compile_restore(rules, await self.is_hooked()))
+        if not success:
+            log.error(f"iptables-restore завершился с ошибкой: {output}")
+            return False, f"Ошибка iptables-restore, правила не изменены:\n{output}"
+
+        report = [f"Цепочка {CHAIN}: {len(rules)} правил применено одной транзакцией "
+                  f"за {(time.monotonic() - started) * 1000:.0f} мс"]
+        if missing:
+            report.append(f"Нет ipset для списков: {', '.join(missing)}")
+        return True, "\n".join(report)
+
+
+class FirewallReconciler:
+    """
+    Приводит Firewall к состоянию из firewall_mode.state, делая только то,
+    что действительно расходится. В режиме "весь трафик" применяются
+    правила, сохраненные в записи состояния, если они совпадают со своим
+    хэшем; иначе они собираются заново по порту из записи.
+
+    Желаемое состояние (режим, реестр списков, отметки файлов списков)
+    и живое (правила KDW и имена ipset) сводятся к отпечаткам и сравниваются
+    с сохраненными после прошлого согласования. Если они совпадают, ничего
+    не делается: вызов стоит одного iptables-save и одного ipset list.
+    Иначе ipset синхронизируются разницей (только если изменились списки
+    или пропали ipset), а цепочка заменяется одной транзакцией.
+
+    После перезагрузки ipset в ядре нет: они сразу восстанавливаются
+    из снимка последнего применения, правила применяются, а списки
+    синхронизируются уже в фоне. Маршрутизация по спискам работает,
+    не дожидаясь разрешения доменов.
+    """
+
+    def __init__(self, manager: Optional[FirewallManager] = None,
+                 state_file: Optional[str] = None, fingerprint_file: Optional[str] = None):
+        self.manager = manager or FirewallManager()
+        self.state_file = state_file or FIREWALL_STATE_FILE
+        self.fingerprint_file = fingerprint_file or FINGERPRINT_FILE
+
+    def read_state(self) -> FirewallState:
+        """Читает запись состояния, выбранного в боте."""
+        return read_state(self.state_file)
+
+    def desired_port(self) -> Optional[int]:
+        """
+        Порт прокси по умолчанию из kdw.cfg. Нужен только для записи
+        прежнего формата, в которой порт не сохранен.
+        """
+        config = ConfigParser()
+        config.read(CONFIG_FILE, encoding='utf-8')
+        return self.manager.registry.port(config.get('firewall', 'default_proxy_type', fallback='trojan'))
+
+    def lists_signature(self) -> str:
+        """Отпечаток файлов списков и их журналов по размеру и mtime."""
+        parts = []
+        for spec in self.manager.registry:
+            for suffix in (".list", ".list.journal"):
+                path = os.path.join(list_manager.LISTS_DIR, f"{spec.name}{suffix}")
+                try:
+                    stat = os.stat(path)
+                    parts.append(f"{path} {stat.st_size} {stat.st_mtime_ns}")
+                except FileNotFoundError:
+                    parts.append(f"{path} -")
+        return _digest(parts)
+
+    def load_fingerprint(self) -> Dict[str, str]:
+        try:
+            with open(self.fingerprint_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_fingerprint(self, fingerprint: Dict[str, str]) -> None:
+        tmp_path = f"{self.fingerprint_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(fingerprint, f)
+        os.replace(tmp_path, self.fingerprint_file)
+
+    async def live_state(self) -> Tuple[str, Set[str]]:
+        """Возвращает отпечаток живого состояния и имена ipset KDW."""
+        _success, nat_dump = await run_shell_command("iptables-save -t nat")
+        sets = {name for name in await self.manager.get_existing_sets() if name.startswith(IPSET_PREFIX)}
+        return live_signature(nat_dump, sets), sets
+
+    async def reconcile(self) -> Tuple[bool, str]:
+        """
+        Согласует Firewall с выбранным режимом.
+
+        Returns:
+            Кортеж (успех, отчет).
+        """
+        started = time.monotonic()
+        state = self.read_state()
+        mode = state.mode
+        rules: List[str] = []
+        if mode == MODE_ALL:
+            if state.rules and state.intact:
+                rules = state.rules
+            else:
+                port = state.port or self.desired_port()
+                if not port:
+                    return False, "Не определен порт прокси по умолчанию (секции [firewall] и [lists] в kdw.cfg)."
+                rules = compile_all_traffic_rules(port, state.exclude)
+
+        lists = self.lists_signature() if mode == MODE_LISTS else ""
+        registry = [f"{spec.name} {spec.port} {spec.set_type}" for spec in self.manager.registry]
+        desired = _digest([mode] + rules + registry)
+        live, sets = await self.live_state()
+        cached = self.load_fingerprint()
+        if cached == {"desired": desired, "lists": lists, "live": live}:
+            return True, f"Состояние Firewall актуально ({(time.monotonic() - started) * 1000:.0f} мс)."
+
+        report = []
+        if mode == MODE_FLUSHED:
+            success, output = await self.manager.flush()
+            report.append(output)
+        elif mode in (MODE_LISTS, MODE_ALL):
+            success = True
+            if mode == MODE_LISTS:
+                # ipset старого формата заменяется, только когда на него не ссылаются правила
+                legacy = await self.manager.legacy_sets()
+                if legacy:
+                    success, output = await self.manager.detach(legacy)
+                    report.append(output)
+                missing = [spec.name for spec in self.manager.registry if ipset_name(spec.name) not in sets]
+                restored, exact = (await IpsetManager().restore_snapshot()) if missing and success else (False, False)
+                if restored:
+                    # Снимок старше файла состояния - дельта от него неверна, нужна полная пересборка
+                    command = f"sh {list_manager.UPDATE_SCRIPT}" + ("" if exact else " --full")
+                    await run_shell_command(f"{command} > /dev/null 2>&1 &")
+                    report.append("ipset восстановлены из снимка, списки применяются в фоне.")
+                elif success and (missing or legacy or cached.get("lists") != lists):
+                    # Разница списков уходит в ipset; dnsmasq перезапускается, только если правила изменились
+                    success, output = await run_shell_command(f"sh {list_manager.UPDATE_SCRIPT}")
+                    report.append(output)
+            if success:
+                if mode == MODE_ALL:
+                    success, output = await self.manager.apply_rules(rules)
+                else:
+                    success, output = await self.manager.apply(mode)
+                report.append(output)
+        else:
+            return False, f"Неизвестный режим Firewall: {mode}"
+
+        if success:
+            live, _sets = await self.live_state()
+            try:
+                self.save_fingerprint({"desired": desired, "lists": lists, "live": live})
+            except Exception as e:
+                log.warning(f"Не удалось сохранить отпечаток Firewall: {e}")
+        report.append(f"Согласование Firewall ({mode}): {(time.monotonic() - started) * 1000:.0f} мс")
+        return success, "\n".join(report)
+
+
+async def _main(args: List[str]) -> int:
+    """
+    Точка входа для shell-скриптов.
+    Использование: python -m core.firewall lists_only | all_traffic <порт> | flushed [--keep-ipsets] | reconcile | detach_legacy
+    """
+    if not args:
+        print("Использование: python -m core.firewall lists_only | all_traffic <порт> | flushed [--keep-ipsets] | reconcile | detach_legacy",
+              file=sys.stderr)
+        return 2
+    if args[0] == "reconcile":
+        success, report = await FirewallReconciler().reconcile()
+    elif args[0] == "detach_legacy":
+        manager = FirewallManager()
+        success, report = await manager.detach(await manager.legacy_sets())
+    elif args[0] == MODE_FLUSHED:
+        success, report = await FirewallManager().flush(keep_ipsets="--keep-ipsets" in args)
+    else:
+        port = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+        success, report = await FirewallManager().apply(args[0], port)
+    print(report, file=sys.stdout if success else sys.stderr)
+    return 0 if success else 1
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,659 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import fcntl
+import asyncio
+import hashlib
+from contextlib import contextmanager
+from configparser import ConfigParser
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, Union
+
+from .shell_utils import run_shell_command
+from .log_utils import log
+from .net_utils import aggregate_networks
+from .list_registry import DEFAULT_SET_TYPE, get_registry
+from .resolver import DnsResolver, ResolveCache, DEFAULT_NAMESERVER, DEFAULT_CONCURRENCY, DEFAULT_TIMEOUT
+
+# Файл с последним примененным содержимым ipset-списков KDW
+IPSET_STATE_FILE = "/opt/etc/kdw/ipset.state.json"
+# Пакетный файл для `ipset restore`. Лежит в /tmp (RAM), чтобы не изнашивать flash
+RESTORE_FILE = "/tmp/kdw_ipset.restore"
+# Блокировка применения списков. Бот, кнопки Firewall и хуки загрузки
+# запускают загрузчик отдельными процессами с общими RESTORE_FILE и
+# IPSET_STATE_FILE, поэтому применения упорядочиваются между процессами
+APPLY_LOCK_FILE = "/tmp/kdw_ipset.lock"
+# Снимок ipset KDW после последнего применения и его метаданные (отпечаток
+# состояния, которому соответствует снимок). При загрузке роутера снимок
+# восстанавливается сразу, а списки применяются уже в фоне
+SNAPSHOT_FILE = "/opt/etc/kdw/ipset.snapshot"
+SNAPSHOT_META_FILE = "/opt/etc/kdw/ipset.snapshot.json"
+# Запас времени жизни записи ipset сверх TTL ее домена: за это время
+# фоновая задача обновления DNS должна успеть разрешить домен и продлить запись
+IPSET_TIMEOUT_GRACE = 900
+
+# Предельное число записей в одном hash:net (значение maxelem)
+SHARD_MAXELEM = 65536
+# Сколько записей списка кладется в один hash:net. Остаток до maxelem -
+# запас на рост списка до пересчета числа частей
+SHARD_FILL = 49152
+# Наибольшее число частей с записями списка в его list:set
+LIST_SET_SIZE = 32
+# Границы hashsize: ядро само увеличивает таблицу по мере наполнения,
+# поэтому размер задается по числу записей, а не с запасом
+HASHSIZE_MIN = 64
+HASHSIZE_MAX = 65536
+
+# Записи списка: перечень (все бессрочные) или словарь запись -> момент устаревания
+ListEntries = Union[Iterable[str], Mapping[str, int]]
+
+
+def ipset_name(list_name: str) -> str:
+    """Возвращает имя ipset (list:set), на который ссылаются правила iptables."""
+    return f"kdw_{list_name}_list"
+
+
+def shard_name(list_name: str, index: int) -> str:
+    """Возвращает имя части (hash:net) ipset списка."""
+    return f"{ipset_name(list_name)}_{index}"
+
+
+def dynamic_set_name(list_name: str) -> str:
+    """
+    Возвращает имя части, в которую dnsmasq добавляет адреса доменов
+    списка. Она не содержит записей из файлов и никогда не пересобирается:
+    иначе swap стер бы адреса, добавленные dnsmasq.
+    """
+    return f"{ipset_name(list_name)}_dns"
+
+
+def shadow_name(set_name: str) -> str:
+    """Возвращает имя теневого ipset, который наполняется перед обменом."""
+    return f"{set_name}_tmp"
+
+
+def shard_count(entries_count: int) -> int:
+    """Возвращает число частей, на которое делится список из entries_count записей."""
+    return min(LIST_SET_SIZE, max(1, -(-entries_count // SHARD_FILL)))
+
+
+def shard_of(entry: str, shards: int) -> int:
+    """
+    Возвращает номер части для записи. Распределение по хешу записи
+    не зависит от остальных записей, поэтому добавление одной подсети
+    не перекладывает остальные между частями.
+    """
+    return zlib.crc32(entry.encode()) % shards
+
+
+def create_line(set_name: str, entries_count: int = 0, set_type: str = DEFAULT_SET_TYPE) -> str:
+    """
+    Возвращает команду создания части ipset (hash:net или hash:ip)
+    с размером по числу записей.
+    Поддержка таймаутов включена с бессрочным значением по умолчанию:
+    записи без таймаута живут всегда.
+    """
+    hashsize = HASHSIZE_MIN
+    while hashsize < entries_count // 2 and hashsize < HASHSIZE_MAX:
+        hashsize *= 2
+    return f"create {set_name} {set_type} hashsize {hashsize} maxelem {SHARD_MAXELEM} timeout 0"
+
+
+def snapshot_lines(save_output: str) -> List[str]:
+    """
+    Выбирает из вывода `ipset save` команды для ipset KDW. Все create
+    идут раньше add: в выводе list:set может оказаться перед своими
+    частями, а добавить в него можно только существующий ipset.
+    Теневые ipset незавершенной пересборки не сохраняются.
+    """
+    creates, adds = [], []
+    for line in save_output.splitlines():
+        words = line.split()
+        if len(words) < 3 or not words[1].startswith("kdw_") or words[1].endswith("_tmp"):
+            continue
+        if words[0] == "create":
+            creates.append(line)
+        elif words[0] == "add":
+            adds.append(line)
+    return creates + adds
+
+
+def snapshot_digest(lines: Iterable[str]) -> str:
+    """
+    Хэш снимка для проверки, изменился ли он. Не учитываются оставшиеся
+    таймауты записей (они убывают каждую секунду) и адреса, которые dnsmasq
+    добавляет в свою часть при DNS-запросах: иначе снимок переписывался бы
+    на flash после каждого применения.
+    """
+    digest = hashlib.sha1()
+    for line in lines:
+        words = line.split()
+        if words[0] == "add" and words[1].endswith("_dns"):
+            continue
+        if words[0] == "add" and "timeout" in words[3:]:
+            words = words[:words.index("timeout", 3)]
+        digest.update(" ".join(words).encode('utf-8') + b"\n")
+    return digest.hexdigest()
+
+
+class IpsetManager:
+    """
+    Синхронизирует ipset-списки KDW с файлами списков.
+
+    Каждый список - это list:set с именем ipset_name(), на который
+    ссылаются правила iptables, и одна или несколько частей hash:net.
+    Число частей выбирается по числу записей, так что большие списки
+    не упираются в maxelem одного ipset. Отдельная часть dynamic_set_name()
+    принадлежит dnsmasq: она только создается, если ее нет, и в разнице
+    и пересборке не участвует.
+
+    Вместо полной очистки и повторного наполнения вычисляется разница
+    между последним примененным состоянием и текущими списками, и в ядро
+    отправляется только она. Если содержимое живой части неизвестно или
+    запрошена полная пересборка, рядом наполняется теневой ipset и
+    атомарно меняется местами с живым через `ipset swap`. Живой ipset
+    при этом никогда не бывает пустым.
+
+    IP-адреса, полученные из DNS, добавляются с таймаутом (TTL домена
+    плюс запас) и сами уходят из ipset, если их перестали продлевать.
+    """
+
+    def __init__(self, state_file: Optional[str] = None):
+        self.state_file = state_file or IPSET_STATE_FILE
+
+    def load_state(self) -> Dict[str, Dict[str, int]]:
+        """
+        Читает последнее примененное состояние ipset-списков:
+        ipset -> {запись: момент устаревания, 0 - бессрочно}.
+        """
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # Состояние старого формата хранило только перечень записей
+            return {name: dict(entries) if isinstance(entries, dict) else dict.fromkeys(entries, 0)
+                    for name, entries in data.items()}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log.warning(f"Не удалось прочитать состояние ipset {self.state_file}: {e}")
+            return {}
+
+    def save_state(self, state: Dict[str, Dict[str, int]]) -> None:
+        """Атомарно сохраняет примененное состояние ipset-списков."""
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({name: dict(sorted(entries.items())) for name, entries in state.items()}, f)
+        os.replace(tmp_path, self.state_file)
+
+    def state_fingerprint(self) -> str:
+        """Отпечаток примененного состояния: хэш файла состояния."""
+        try:
+            with open(self.state_file, 'rb') as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except FileNotFoundError:
+            return ""
+
+    async def save_snapshot(self) -> Tuple[bool, str]:
+        """
+        Сохраняет снимок ipset KDW (`ipset save`) вместе с отпечатком
+        состояния, которому он соответствует. Неизменившийся снимок
+        (см. snapshot_digest) не переписывается, чтобы не изнашивать flash.
+        """
+        success, output = await run_shell_command("ipset save")
+        if not success:
+            return False, f"Не удалось сохранить снимок ipset: {output}"
+        lines = snapshot_lines(output)
+        content = "".join(f"{line}\n" for line in lines)
+        meta = {"fingerprint": self.state_fingerprint(), "snapshot": snapshot_digest(lines)}
+        try:
+            with open(SNAPSHOT_META_FILE, 'r', encoding='utf-8') as f:
+                if json.load(f) == meta and os.path.exists(SNAPSHOT_FILE):
+                    return True, "Снимок ipset не изменился."
+        except (FileNotFoundError, ValueError):
+            pass
+
+        for path, data in ((SNAPSHOT_FILE, content), (SNAPSHOT_META_FILE, json.dumps(meta))):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return True, "Снимок ipset сохранен."
+
+    async def restore_snapshot(self) -> Tuple[bool, bool]:
+        """
+        Восстанавливает ipset KDW из снимка одним `ipset restore`.
+
+        Returns:
+            Кортеж (восстановлен ли снимок, соответствует ли он текущему
+            файлу состояния). Если не соответствует, дельта от состояния
+            неверна и списки нужно пересобрать полностью (--full).
+        """
+        try:
+            with open(SNAPSHOT_META_FILE, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if not os.path.exists(SNAPSHOT_FILE):
+                return False, False
+        except (FileNotFoundError, ValueError):
+            return False, False
+
+        success, output = await run_shell_command(f"ipset -exist restore < {SNAPSHOT_FILE}")
+        if not success:
+            log.warning(f"Не удалось восстановить ipset из снимка: {output}")
+            return False, False
+        return True, meta.get("fingerprint") == self.state_fingerprint()
+
+    @staticmethod
+    def compute_delta(applied: Dict[str, int], desired: Dict[str, int]) -> Tuple[Set[str], Set[str], Set[str]]:
+        """
+        Вычисляет разницу между примененным и желаемым содержимым.
+
+        Returns:
+            Кортеж (новые записи, записи для удаления, записи с новым сроком жизни).
+        """
+        to_add = desired.keys() - applied.keys()
+        to_remove = applied.keys() - desired.keys()
+        to_extend = {entry for entry in desired.keys() & applied.keys() if desired[entry] != applied[entry]}
+        return to_add, to_remove, to_extend
+
+    @staticmethod
+    def entry_line(op: str, set_name: str, entry: str, expires: int, now: int) -> str:
+        """Возвращает строку add/del пакета; у записей из DNS add задает таймаут."""
+        if op == "add" and expires:
+            return f"add {set_name} {entry} timeout {expires + IPSET_TIMEOUT_GRACE - now}"
+        return f"{op} {set_name} {entry}"
+
+    async def get_existing_sets(self) -> Dict[str, Dict]:
+        """
+        Возвращает ipset-списки, которые существуют в ядре:
+        имя -> {"type": тип, "timeout": поддержка таймаутов, "references": число ссылок}.
+        """
+        success, output = await run_shell_command("ipset list -t")
+        if not success:
+            return {}
+        sets: Dict[str, Dict] = {}
+        info: Dict = {}
+        for line in output.splitlines():
+            key, _, value = line.partition(":")
+            value = value.strip()
+            if key == "Name":
+                info = sets.setdefault(value, {"type": "", "timeout": False, "references": 0})
+            elif key == "Type":
+                info["type"] = value
+            elif key == "Header":
+                info["timeout"] = " timeout " in f" {value} "
+            elif key == "References":
+                info["references"] = int(value or 0)
+        return sets
+
+    async def restore(self, lines: List[str]) -> Tuple[Set[int], str]:
+        """
+        Загружает пакет команд одним вызовом `ipset restore`.
+
+        `ipset restore` останавливается на первой ошибочной строке.
+        Такая строка откладывается, а остаток пакета загружается повторно.
+        Это запасной путь для непредвиденных ошибок: записи, которые ядро
+        заведомо отвергнет (IPv6), в пакет не попадают.
+
+        Args:
+            lines: Строки пакета (create / add / del / swap / destroy).
+
+        Returns:
+            Кортеж (номера неудачных строк, текст последней ошибки).
+        """
+        failed: Set[int] = set()
+        error = ""
+        offset = 0
+        try:
+            while offset < len(lines):
+                with open(RESTORE_FILE, 'w', encoding='utf-8') as f:
+                    f.write("\n".join(lines[offset:]) + "\n")
+                success, output = await run_shell_command(f"ipset -exist restore < {RESTORE_FILE}")
+                if success:
+                    break
+                error = output
+                match = re.search(r"line (\d+)", output)
+                bad_line = offset + int(match.group(1)) - 1 if match else -1
+                if not (offset <= bad_line < len(lines)) or not lines[bad_line].startswith(("add ", "del ")):
+                    # Ошибка не в отдельной записи - остаток пакета считаем не примененным
+                    failed.update(range(offset, len(lines)))
+                    break
+                failed.add(bad_line)
+                offset = bad_line + 1
+        finally:
+            if os.path.exists(RESTORE_FILE):
+                os.remove(RESTORE_FILE)
+        return failed, error
+
+    async def sync(self, lists: Dict[str, ListEntries], full: bool = False,
+                   set_types: Optional[Dict[str, str]] = None) -> Tuple[bool, str]:
+        """
+        Приводит ipset-списки к содержимому переданных списков.
+        Вся разница загружается в ядро одним пакетом `ipset restore`.
+
+        Args:
+            lists: Словарь имя списка -> записи (IP, подсети). Записи можно
+                   передать словарем запись -> момент устаревания (unix-время,
+                   0 - бессрочно): такие записи добавляются с таймаутом,
+                   а при изменении срока продлеваются повторным add.
+            full: Пересобрать существующие части целиком через теневой
+                  ipset и `ipset swap`, не полагаясь на сохраненное состояние.
+            set_types: Тип частей ipset для каждого списка (по умолчанию
+                  hash:net). Часть другого типа пересоздается.
+
+        Returns:
+            Кортеж (успех, отчет с числом записей и временем применения).
+        """
+        started = time.monotonic()
+        now = int(time.time())
+        state = self.load_state()
+        existing_sets = await self.get_existing_sets()
+
+        lines: List[str] = []
+        # Для каждой строки add/del записи запоминаем, к какой части и записи она относится
+        line_entries: Dict[int, Tuple[str, str, str]] = {}
+        # Часть -> (список, желаемое содержимое, добавлено, удалено, продлено)
+        plan: Dict[str, Tuple[str, Dict[str, int], int, int, int]] = {}
+        # Номер строки swap для пересобираемых частей: если она не выполнилась,
+        # живая часть осталась прежней и ее состояние не обновляется
+        swap_lines: Dict[str, int] = {}
+        # Строки создания list:set списка: без них части списка не применяются
+        setup_lines: Dict[str, List[int]] = {}
+        shards_by_list: Dict[str, int] = {}
+        # Списки, которые нельзя применить без повторного применения правил Firewall
+        blocked_lists: List[str] = []
+        report = []
+
+        for list_name, entries in lists.items():
+            top = ipset_name(list_name)
+            items = entries.items() if isinstance(entries, Mapping) else ((entry, 0) for entry in entries)
+            # Записи, чей таймаут в ядре уже истек, не загружаются
+            desired = {entry.strip(): expires for entry, expires in items
+                       if entry.strip() and not entry.startswith('#')
+                       and (not expires or expires + IPSET_TIMEOUT_GRACE > now)}
+            # Части создаются семейства inet: IPv6-запись ipset restore отверг бы,
+            # и она уходила бы в ядро отдельным повтором при каждом применении
+            ipv6 = [entry for entry in desired if ":" in entry]
+            for entry in ipv6:
+                del desired[entry]
+            if ipv6:
+                report.append(f"{list_name}: пропущено IPv6-записей: {len(ipv6)} (ipset KDW только для IPv4)")
+
+            top_info = existing_sets.get(top)
+            new_top = top_info is None or top_info["type"] != "list:set"
+            if top_info and new_top:
+                # ipset старого формата (один hash:net) заменяется на list:set
+                if top_info["references"]:
+                    blocked_lists.append(list_name)
+                    report.append(f"{list_name}: ipset старого формата используется правилами iptables, "
+                                  f"перепримените правила Firewall")
+                    continue
+                setup_lines.setdefault(list_name, []).append(len(lines))
+                lines.append(f"destroy {top}")
+            if new_top:
+                setup_lines.setdefault(list_name, []).append(len(lines))
+                # Плюс одно место под часть dnsmasq
+                lines.append(f"create {top} list:set size {LIST_SET_SIZE + 1}")
+            state.pop(top, None)
+
+            dns_set = dynamic_set_name(list_name)
+            if dns_set not in existing_sets:
+                setup_lines.setdefault(list_name, []).append(len(lines))
+                lines.append(create_line(dns_set))
+            if new_top or dns_set not in existing_sets:
+                setup_lines.setdefault(list_name, []).append(len(lines))
+                lines.append(f"add {top} {dns_set}")
+
+            set_type = (set_types or {}).get(list_name, DEFAULT_SET_TYPE)
+            shards = shard_count(len(desired))
+            shards_by_list[list_name] = shards
+            parts: List[Dict[str, int]] = [{} for _ in range(shards)]
+            for entry, expires in desired.items():
+                parts[shard_of(entry, shards)][entry] = expires
+
+            for index, part in enumerate(parts):
+                set_name = shard_name(list_name, index)
+                info = existing_sets.get(set_name)
+                applied = state.get(set_name, {})
+                if info and info["type"] != set_type:
+                    # Тип списка изменился в kdw.cfg: swap между разными типами
+                    # невозможен, часть пересоздается
+                    if not new_top:
+                        lines.append(f"del {top} {set_name}")
+                    lines.append(f"destroy {set_name}")
+                    info = None
+                if info is None:
+                    # Часть в ядре отсутствует (перезагрузка, очистка) - наполняем напрямую
+                    lines.append(create_line(set_name, len(part), set_type))
+                    applied = {}
+                elif full or set_name not in state or not info["timeout"]:
+                    # Содержимое живой части неизвестно или она создана без поддержки
+                    # таймаутов - собираем теневую и меняем местами
+                    shadow = shadow_name(set_name)
+                    lines.append(create_line(shadow, len(part), set_type))
+                    lines.append(f"flush {shadow}")
+                    for entry in sorted(part):
+                        line_entries[len(lines)] = ("add", set_name, entry)
+                        lines.append(self.entry_line("add", shadow, entry, part[entry], now))
+                    swap_lines[set_name] = len(lines)
+                    lines.append(f"swap {shadow} {set_name}")
+                    lines.append(f"destroy {shadow}")
+                    if new_top:
+                        lines.append(f"add {top} {set_name}")
+                    to_add, to_remove, to_extend = self.compute_delta(applied, part)
+                    plan[set_name] = (list_name, part, len(to_add), len(to_remove), len(to_extend))
+                    continue
+
+                to_add, to_remove, to_extend = self.compute_delta(applied, part)
+                # Повторный add с -exist обновляет таймаут уже загруженной записи
+                for op, entries_to_apply in (("del", to_remove), ("add", to_add | to_extend)):
+                    for entry in sorted(entries_to_apply):
+                        line_entries[len(lines)] = (op, set_name, entry)
+                        lines.append(self.entry_line(op, set_name, entry, part.get(entry, 0), now))
+                if info is None or new_top:
+                    lines.append(f"add {top} {set_name}")
+                plan[set_name] = (list_name, part, len(to_add), len(to_remove), len(to_extend))
+
+            # Части, которые больше не нужны после уменьшения списка
+            for name in sorted(set(existing_sets) | set(state)):
+                match = re.fullmatch(rf"{re.escape(top)}_(\d+)", name)
+                if not match or int(match.group(1)) < shards:
+                    continue
+                if name in existing_sets:
+                    if not new_top:
+                        lines.append(f"del {top} {name}")
+                    lines.append(f"destroy {name}")
+                state.pop(name, None)
+
+        failed_lines, error = await self.restore(lines) if lines else (set(), "")
+        failed_adds: Dict[str, Set[str]] = {}
+        failed_dels: Dict[str, Set[str]] = {}
+        for line_no in sorted(failed_lines):
+            if line_no in line_entries:
+                op, set_name, entry = line_entries[line_no]
+                target = failed_adds if op == "add" else failed_dels
+                target.setdefault(set_name, set()).add(entry)
+            log.warning(f"Не удалось выполнить '{lines[line_no]}'")
+
+        # Ошибки отдельных записей попадают в отчет, но не считаются сбоем применения
+        all_ok = not blocked_lists and all(line_no in line_entries for line_no in failed_lines)
+        # Список -> [записей, добавлено, удалено, продлено, ошибок]
+        totals: Dict[str, List[int]] = {}
+        failed_parts: Dict[str, List[str]] = {}
+        for set_name, (list_name, desired, added, removed, extended) in plan.items():
+            if any(line_no in failed_lines for line_no in setup_lines.get(list_name, [])):
+                continue
+            if swap_lines.get(set_name) in failed_lines:
+                failed_parts.setdefault(list_name, []).append(set_name)
+                continue
+            applied = state.get(set_name, {})
+            set_failed_adds = failed_adds.get(set_name, set())
+            set_failed_dels = failed_dels.get(set_name, set())
+            # Неудачные записи не считаются примененными и будут повторены в следующий раз
+            new_state = dict(desired)
+            for entry in set_failed_adds:
+                if entry in applied:
+                    new_state[entry] = applied[entry]
+                else:
+                    del new_state[entry]
+            for entry in set_failed_dels:
+                new_state[entry] = applied[entry]
+            state[set_name] = new_state
+            failed_new = len(set_failed_adds - applied.keys())
+            counters = totals.setdefault(list_name, [0, 0, 0, 0, 0])
+            counters[0] += len(new_state)
+            counters[1] += added - failed_new
+            counters[2] += removed - len(set_failed_dels)
+            counters[3] += extended - (len(set_failed_adds) - failed_new)
+            counters[4] += len(set_failed_adds) + len(set_failed_dels)
+
+        for list_name, shards in shards_by_list.items():
+            if any(line_no in failed_lines for line_no in setup_lines.get(list_name, [])):
+                report.append(f"{list_name}: не удалось создать ipset {ipset_name(list_name)}")
+                continue
+            if list_name in failed_parts:
+                report.append(f"{list_name}: пересборка не выполнена, ipset оставлен без изменений "
+                              f"({', '.join(failed_parts[list_name])})")
+            if list_name not in totals:
+                continue
+            count, added, removed, extended, errors = totals[list_name]
+            report.append(f"{list_name}: {count} зап. (+{added} -{removed})"
+                          + (f", продлено: {extended}" if extended else "")
+                          + (f", ошибок: {errors}" if errors else "")
+                          + (f", частей ipset: {shards}" if shards > 1 else ""))
+        if not all_ok:
+            report.append(f"Ошибка ipset restore: {error}")
+
+        try:
+            self.save_state(state)
+        except Exception as e:
+            all_ok = False
+            report.append(f"Не удалось сохранить состояние ipset: {e}")
+
+        report.append(f"Время применения: {time.monotonic() - started:.2f} с")
+        return all_ok, "\n".join(report)
+
+
+@contextmanager
+def apply_lock(path: Optional[str] = None) -> Iterator[None]:
+    """
+    Межпроцессная блокировка применения списков (flock). Ожидает, пока
+    завершится применение, запущенное другим процессом.
+    """
+    with open(path or APPLY_LOCK_FILE, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _load_config() -> ConfigParser:
+    """Читает kdw.cfg из корня проекта."""
+    config = ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kdw.cfg'), encoding='utf-8')
+    return config
+
+
+def _load_resolver(config: ConfigParser) -> DnsResolver:
+    """Создает резолвер с параметрами из секции [kdw.settings] файла kdw.cfg."""
+    return DnsResolver(
+        nameserver=config.get('kdw.settings', 'dns_server', fallback=DEFAULT_NAMESERVER),
+        concurrency=config.getint('kdw.settings', 'dns_concurrency', fallback=DEFAULT_CONCURRENCY),
+        timeout=config.getfloat('kdw.settings', 'dns_timeout', fallback=DEFAULT_TIMEOUT),
+    )
+
+
+async def _main(args: List[str]) -> int:
+    """
+    Точка входа для shell-скриптов: обновляет правила dnsmasq `ipset=`
+    и синхронизирует ipset-списки с IP-адресами и подсетями из списков.
+    Использование: python -m core.ipset_manager [--full | --refresh] [список ...]
+
+    Если в [kdw.settings] включен resolve_on_apply, домены дополнительно
+    разрешаются при применении. С --refresh повторно разрешаются только
+    домены с истекшим TTL; если таких нет, скрипт ничего не делает.
+
+    Одновременно выполняется только одно применение: остальные процессы
+    ждут блокировку apply_lock() и затем считают разницу от уже
+    обновленного состояния.
+    """
+    with apply_lock():
+        return await _apply(args)
+
+
+async def _apply(args: List[str]) -> int:
+    """Применяет списки к ipset и dnsmasq (см. _main)."""
+    from .list_manager import ListManager
+    from .dnsmasq_manager import DnsmasqManager
+    from .resolver import split_entries
+
+    full = "--full" in args
+    refresh = "--refresh" in args
+    list_names = [arg for arg in args if not arg.startswith("--")]
+
+    config = _load_config()
+    resolve_on_apply = config.getboolean('kdw.settings', 'resolve_on_apply', fallback=False)
+    if refresh and not resolve_on_apply:
+        print("Разрешение доменов при применении отключено, IP добавляет dnsmasq.")
+        return 0
+
+    list_manager = ListManager()
+    names = list_names or list_manager.get_list_files()
+    lists = {name: list_manager.get_entries(name) for name in names}
+    split = {name: split_entries(entries) for name, entries in lists.items()}
+
+    reports = []
+    # Пересекающиеся и смежные подсети объединяются до загрузки в ipset
+    for name, (networks, domains) in split.items():
+        aggregated, eliminated = aggregate_networks(networks)
+        split[name] = (set(aggregated), domains)
+        if eliminated:
+            reports.append(f"{name}: подсети объединены, записей меньше на {eliminated}")
+
+    if not resolve_on_apply:
+        ip_sets = {name: networks for name, (networks, _domains) in split.items()}
+        stats = {}
+    else:
+        domains = {domain for _networks, list_domains in split.values() for domain in list_domains}
+        cache = ResolveCache()
+        cache.load()
+        if not list_names:
+            cache.prune(domains)
+        if refresh and not cache.expired(domains):
+            print("Устаревших записей DNS нет.")
+            return 0
+
+        ip_sets, stats = await _load_resolver(config).resolve_lists(
+            {name: networks | domains for name, (networks, domains) in split.items()}, cache=cache
+        )
+        try:
+            cache.save()
+        except Exception as e:
+            log.warning(f"Не удалось сохранить кэш DNS: {e}")
+
+    # ipset-списки должны существовать до того, как dnsmasq начнет в них писать
+    registry = get_registry()
+    set_types = {name: registry.get(name).set_type for name in ip_sets if name in registry}
+    ipset_manager = IpsetManager()
+    success, report = await ipset_manager.sync(ip_sets, full=full, set_types=set_types)
+    reports.append(report)
+    if success and not refresh:
+        # Снимок для быстрого восстановления маршрутизации после перезагрузки
+        _saved, snapshot_report = await ipset_manager.save_snapshot()
+        reports.append(snapshot_report)
+    reports.extend(f"{name}: {list_stats}" for name, list_stats in stats.items())
+    if not refresh:
+        dnsmasq_success, dnsmasq_report = await DnsmasqManager().sync(
+            {name: domains for name, (_networks, domains) in split.items()}
+        )
+        success = success and dnsmasq_success
+        reports.append(dnsmasq_report)
+
+    print("\n".join(reports), file=sys.stdout if success else sys.stderr)
+    return 0 if success else 1
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
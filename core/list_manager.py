@@ -1,11 +1,235 @@
 import os
 import glob
-from typing import List, Tuple, Optional
+import gzip
+import asyncio
+import heapq
+import ipaddress
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from typing import Awaitable, Callable, Dict, Iterable, List, Set, Tuple, Optional
 from .shell_utils import run_shell_command
+from .log_utils import log
+from .net_utils import normalize_entry, normalize_entries
+from .list_registry import get_registry
 
-# Путь к директории со списками и скрипту обновления
+# Путь к директории со списками и скрипту обновления ipset-списков
 LISTS_DIR = "/opt/etc/kdw/lists"
 UPDATE_SCRIPT = "/opt/etc/kdw/scripts/apply_lists.sh"
+# Число операций в журнале, после которого список уплотняется в .list файл
+JOURNAL_COMPACT_THRESHOLD = 512
+# Число строк, которые импорт файла нормализует и фиксирует за один шаг
+IMPORT_CHUNK_SIZE = 10000
+# Число записей на одной странице просмотра списка
+LIST_PAGE_SIZE = 50
+# Наибольшая длина записи на странице просмотра: LIST_PAGE_SIZE записей
+# такой длины помещаются в одно сообщение Telegram (4096 символов)
+LIST_ENTRY_WIDTH = 72
+# Максимальное число результатов поиска домена
+SEARCH_LIMIT = 20
+# Окно (в секундах), в течение которого правки списков копятся перед применением
+APPLY_DEBOUNCE = 2.0
+
+def shorten_entry(entry: str, width: int = LIST_ENTRY_WIDTH) -> str:
+    """
+    Укорачивает длинную запись для показа, заменяя середину многоточием:
+    начало и домен верхнего уровня остаются видны.
+    """
+    if len(entry) <= width:
+        return entry
+    head = (width - 1) // 2
+    return f"{entry[:head]}…{entry[len(entry) - (width - 1 - head):]}"
+
+
+class ListDiff:
+    """
+    Итоговые изменения списков после фиксации транзакции:
+    какие домены добавлены в какие списки и какие удалены.
+    """
+
+    def __init__(self):
+        self.added: Dict[str, Set[str]] = {}
+        self.removed: Dict[str, Set[str]] = {}
+
+    def __bool__(self) -> bool:
+        return any(self.added.values()) or any(self.removed.values())
+
+    def touched_lists(self) -> List[str]:
+        """Возвращает имена списков, в которых есть изменения."""
+        return sorted(name for name in set(self.added) | set(self.removed)
+                      if self.added.get(name) or self.removed.get(name))
+
+    def merge(self, other: "ListDiff") -> "ListDiff":
+        """
+        Добавляет к этим изменениям более поздние. Запись, добавленная
+        и затем удаленная (или наоборот), учитывается по последней операции.
+        """
+        for list_name, added in other.added.items():
+            self.removed.get(list_name, set()).difference_update(added)
+            self.added.setdefault(list_name, set()).update(added)
+        for list_name, removed in other.removed.items():
+            self.added.get(list_name, set()).difference_update(removed)
+            self.removed.setdefault(list_name, set()).update(removed)
+        return self
+
+
+class ImportResult:
+    """
+    Итог импорта файла в список: сколько строк прочитано и что с ними стало.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.added = 0
+        # Уже есть в целевом списке (в том числе повторы внутри файла)
+        self.existing = 0
+        # Уже есть в других списках и потому пропущены
+        self.foreign = 0
+        # Покрыты родительским доменом из целевого списка
+        self.covered = 0
+        self.rejected = 0
+        # Зафиксированные изменения: применяется только целевой список
+        self.diff = ListDiff()
+
+
+class ListTransaction:
+    """
+    Накапливает добавления, удаления и перемещения доменов по нескольким
+    спискам и фиксирует их одной записью на каждый затронутый файл.
+
+    Пример:
+        tx = list_manager.transaction()
+        tx.move("example.com", "trojan", "vmess")
+        tx.add("vmess", ["new.com"])
+        diff = await tx.commit()
+    """
+
+    def __init__(self, manager: "ListManager"):
+        self._manager = manager
+        # список -> {домен: должен ли домен присутствовать после фиксации}
+        self._ops: Dict[str, Dict[str, bool]] = {}
+
+    def add(self, list_name: str, domains: Iterable[str]) -> "ListTransaction":
+        """
+        Планирует добавление доменов в список. Записи нормализуются,
+        некорректные пропускаются (отчет о них дает normalize_entries).
+        """
+        ops = self._ops.setdefault(list_name, {})
+        for domain in domains:
+            try:
+                domain = normalize_entry(domain)
+            except ValueError:
+                continue
+            if domain:
+                ops[domain] = True
+        return self
+
+    def remove(self, list_name: str, domains: Iterable[str]) -> "ListTransaction":
+        """
+        Планирует удаление доменов из списка. Удаляется и запись
+        в исходном виде, и ее нормализованная форма: так можно убрать
+        записи, добавленные до появления нормализации.
+        """
+        ops = self._ops.setdefault(list_name, {})
+        for domain in domains:
+            domain = domain.strip()
+            if not domain:
+                continue
+            ops[domain] = False
+            try:
+                normalized = normalize_entry(domain)
+            except ValueError:
+                continue
+            if normalized:
+                ops[normalized] = False
+        return self
+
+    def move(self, domain: str, from_list: str, to_list: str) -> "ListTransaction":
+        """Планирует перемещение домена из одного списка в другой."""
+        self.remove(from_list, [domain])
+        self.add(to_list, [domain])
+        return self
+
+    async def commit(self) -> ListDiff:
+        """
+        Фиксирует все накопленные операции.
+
+        Returns:
+            ListDiff с фактически произошедшими изменениями.
+        """
+        diff = ListDiff()
+        for list_name, ops in self._ops.items():
+            existing = self._manager._refresh_list(list_name)
+            added = {d for d, present in ops.items() if present and d not in existing}
+            removed = {d for d, present in ops.items() if not present and d in existing}
+            if added or removed:
+                self._manager._commit_ops(list_name, added, removed)
+                diff.added[list_name] = added
+                diff.removed[list_name] = removed
+        self._ops = {}
+        return diff
+
+
+class ApplyScheduler:
+    """
+    Откладывает и объединяет применение списков.
+
+    Правки, поступившие в течение окна APPLY_DEBOUNCE, применяются одним
+    запуском скрипта обновления: их ListDiff объединяются, а все вызвавшие
+    получают один общий future с результатом. Запуски сериализуются
+    блокировкой, поэтому два применения никогда не идут одновременно.
+    Правки, пришедшие во время выполнения, попадают в следующий запуск.
+    """
+
+    def __init__(self, manager: "ListManager", delay: Optional[float] = None):
+        self._manager = manager
+        self.delay = APPLY_DEBOUNCE if delay is None else delay
+        # Блокировка запусков скрипта обновления (ее же берет refresh_resolved)
+        self.lock = asyncio.Lock()
+        # Накопленные изменения и future следующего запуска
+        self._pending: Optional[ListDiff] = None
+        self._full = False
+        self._future: Optional[asyncio.Future] = None
+
+    def schedule(self, diff: Optional[ListDiff] = None) -> asyncio.Future:
+        """
+        Ставит изменения в очередь на применение.
+
+        Args:
+            diff: Зафиксированные изменения; None - применить все списки.
+
+        Returns:
+            Future с результатом (успех, отчет) общего запуска.
+        """
+        loop = asyncio.get_running_loop()
+        if diff is not None and not diff and self._future is None:
+            future = loop.create_future()
+            future.set_result((True, "Изменений в списках нет."))
+            return future
+
+        if self._future is None:
+            self._future = loop.create_future()
+            self._pending = ListDiff()
+            self._full = False
+            loop.create_task(self._run(self._future))
+        if diff is None:
+            self._full = True
+        else:
+            self._pending.merge(diff)
+        return self._future
+
+    async def _run(self, future: asyncio.Future) -> None:
+        """Дожидается конца окна и своей очереди, затем применяет накопленное."""
+        await asyncio.sleep(self.delay)
+        async with self.lock:
+            # С этого момента новые правки копятся для следующего запуска
+            diff = None if self._full else self._pending
+            self._future, self._pending = None, None
+            try:
+                result = await self._manager.apply_changes(diff)
+            except Exception as e:
+                result = (False, f"Ошибка применения списков:\n`{e}`")
+            future.set_result(result)
+
 
 class ListManager:
     """
@@ -17,17 +241,225 @@ class ListManager:
         # Это полезно для локальной разработки.
         os.makedirs(LISTS_DIR, exist_ok=True)
 
+        # Резидентный индекс: содержимое каждого списка и обратное отображение
+        # домен -> список. Файл перечитывается только при изменении его mtime.
+        self._entries: Dict[str, Set[str]] = {}
+        self._index: Dict[str, str] = {}
+        self._stamps: Dict[str, Tuple[str, Optional[float], Optional[float]]] = {}
+        # Число неуплотненных операций в журнале каждого списка
+        self._journal_ops: Dict[str, int] = {}
+        # Отсортированные записи списков для постраничного просмотра;
+        # сбрасываются при любом изменении списка
+        self._sorted: Dict[str, List[str]] = {}
+        # Индекс поиска по всем спискам: отсортированные записи и они же
+        # в перевернутом виде (для поиска по суффиксу). None - нужно пересобрать
+        self._search: Optional[Tuple[List[str], List[str]]] = None
+        self._scheduler: Optional[ApplyScheduler] = None
+        self.refresh_index()
+
+    @staticmethod
+    def _list_path(list_name: str) -> str:
+        """Возвращает путь к файлу списка."""
+        return os.path.join(LISTS_DIR, f"{list_name}.list")
+
+    @staticmethod
+    def _journal_path(list_name: str) -> str:
+        """Возвращает путь к журналу изменений списка."""
+        return os.path.join(LISTS_DIR, f"{list_name}.list.journal")
+
+    def _get_stamp(self, list_name: str) -> Tuple[str, Optional[float], Optional[float]]:
+        """Отметка состояния списка на диске: путь и mtime файла и журнала."""
+        file_path = self._list_path(list_name)
+        return file_path, self._get_mtime(file_path), self._get_mtime(self._journal_path(list_name))
+
+    @staticmethod
+    def _get_mtime(file_path: str) -> Optional[float]:
+        """Возвращает mtime файла или None, если файла нет."""
+        try:
+            return os.stat(file_path).st_mtime
+        except OSError:
+            return None
+
+    def _unindex(self, domain: str, list_name: str) -> None:
+        """
+        Убирает домен из индекса, если он числился за списком.
+        Если домен есть еще и в другом списке, индекс переходит к нему.
+        """
+        if self._index.get(domain) != list_name:
+            return
+        del self._index[domain]
+        for other_list, domains in self._entries.items():
+            if other_list != list_name and domain in domains:
+                self._index[domain] = other_list
+                break
+
+    def _drop_from_index(self, list_name: str) -> None:
+        """Удаляет из индекса все домены, принадлежащие списку."""
+        self._sorted.pop(list_name, None)
+        self._search = None
+        for domain in self._entries.pop(list_name, set()):
+            self._unindex(domain, list_name)
+
+    def _refresh_list(self, list_name: str) -> Set[str]:
+        """
+        Возвращает множество доменов списка, перечитывая файл и журнал
+        только если они изменились с момента последней загрузки.
+        """
+        stamp = self._get_stamp(list_name)
+        if self._stamps.get(list_name) == stamp and list_name in self._entries:
+            return self._entries[list_name]
+
+        self._drop_from_index(list_name)
+        domains = set()
+        ops = 0
+        try:
+            if stamp[1] is not None:
+                with open(stamp[0], 'r', encoding='utf-8') as f:
+                    domains = set(line.strip() for line in f if line.strip())
+            if stamp[2] is not None:
+                # Проигрываем журнал поверх содержимого файла
+                journal_path = self._journal_path(list_name)
+                complete = 0
+                with open(journal_path, 'rb') as f:
+                    for raw in f:
+                        if not raw.endswith(b"\n"):
+                            break
+                        complete += len(raw)
+                        line = raw.decode('utf-8', errors='replace')
+                        op, domain = line[:1], line[1:].strip()
+                        if not domain:
+                            continue
+                        if op == '+':
+                            domains.add(domain)
+                        elif op == '-':
+                            domains.discard(domain)
+                        ops += 1
+                if complete < os.path.getsize(journal_path):
+                    # Оборванная сбоем последняя строка не применяется и отрезается,
+                    # иначе следующая запись журнала склеилась бы с ней
+                    log.warning(f"Журнал {journal_path} оборван, отброшена неполная строка")
+                    os.truncate(journal_path, complete)
+                    stamp = self._get_stamp(list_name)
+        except Exception:
+            # Игнорируем ошибки чтения, используем то, что удалось прочитать
+            pass
+
+        self._entries[list_name] = domains
+        self._journal_ops[list_name] = ops
+        for domain in domains:
+            self._index.setdefault(domain, list_name)
+        self._stamps[list_name] = stamp
+        return domains
+
+    def _commit_ops(self, list_name: str, added: Set[str], removed: Set[str],
+                    auto_compact: bool = True) -> None:
+        """
+        Дописывает операции в журнал списка одной записью, сбрасывает ее
+        на диск и применяет к индексу. При превышении порога журнал
+        уплотняется в .list файл, если не задано auto_compact=False.
+        """
+        lines = [f"-{domain}\n" for domain in sorted(removed)]
+        lines += [f"+{domain}\n" for domain in sorted(added)]
+        if not lines:
+            return
+        with open(self._journal_path(list_name), 'a', encoding='utf-8') as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_ops[list_name] = self._journal_ops.get(list_name, 0) + len(lines)
+        self._stamps[list_name] = self._get_stamp(list_name)
+
+        self._sorted.pop(list_name, None)
+        self._search = None
+        domains = self._entries.setdefault(list_name, set())
+        domains -= removed
+        domains |= added
+        for domain in removed:
+            self._unindex(domain, list_name)
+        for domain in added:
+            self._index.setdefault(domain, list_name)
+
+        if auto_compact and self._journal_ops[list_name] >= JOURNAL_COMPACT_THRESHOLD:
+            self.compact(list_name)
+
+    def compact(self, list_name: str) -> None:
+        """
+        Уплотняет журнал: атомарно записывает отсортированный список
+        (временный файл + rename) и удаляет журнал.
+        Если журнала нет, файл не переписывается.
+        """
+        domains = self._refresh_list(list_name)
+        journal_path = self._journal_path(list_name)
+        if not os.path.exists(journal_path):
+            return
+
+        file_path = self._list_path(list_name)
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(sorted(domains)) + "\n" if domains else "")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+        # Повторное проигрывание журнала поверх уже уплотненного файла
+        # дает тот же результат, поэтому сбой до удаления журнала безопасен.
+        os.remove(journal_path)
+        self._journal_ops[list_name] = 0
+        self._stamps[list_name] = self._get_stamp(list_name)
+
+    def compact_all(self) -> None:
+        """Уплотняет журналы всех списков."""
+        for list_name in self.get_list_files():
+            self.compact(list_name)
+
+    def refresh_index(self) -> None:
+        """
+        Синхронизирует индекс с файлами списков.
+        Перечитываются только файлы с изменившимся mtime.
+        """
+        for list_name in self.get_list_files():
+            self._refresh_list(list_name)
+
     def get_list_files(self) -> List[str]:
         """
-        Возвращает статический список доступных для редактирования списков.
+        Возвращает имена списков из реестра (секция [lists] файла kdw.cfg).
+        """
+        return get_registry().names()
+
+    def get_entries(self, list_name: str) -> Set[str]:
+        """Возвращает копию текущего содержимого списка (с учетом журнала)."""
+        return set(self._refresh_list(list_name))
+
+    def sorted_entries(self, list_name: str) -> List[str]:
+        """
+        Возвращает записи списка в отсортированном виде. Массив строится
+        один раз и переиспользуется, пока список не изменится.
+        """
+        entries = self._refresh_list(list_name)
+        if list_name not in self._sorted:
+            self._sorted[list_name] = sorted(entries)
+        return self._sorted[list_name]
+
+    def get_page(self, list_name: str, page: int, page_size: int = LIST_PAGE_SIZE) -> Tuple[List[str], int, int]:
+        """
+        Возвращает одну страницу отсортированного списка.
+
+        Returns:
+            Кортеж (записи страницы, номер страницы после ограничения
+            диапазоном, всего страниц).
         """
-        # В будущем можно сделать этот список динамическим, например, на основе
-        # существующих сервисов. Пока что он статический.
-        return ["shadowsocks", "trojan", "vmess", "direct"]
+        entries = self.sorted_entries(list_name)
+        pages = max(1, -(-len(entries) // page_size))
+        page = min(max(page, 0), pages - 1)
+        return entries[page * page_size:(page + 1) * page_size], page, pages
+
+    def export_gzip(self, list_name: str) -> bytes:
+        """Возвращает отсортированный список, сжатый gzip, для отправки файлом."""
+        entries = self.sorted_entries(list_name)
+        return gzip.compress("".join(f"{entry}\n" for entry in entries).encode('utf-8'))
 
     def find_domain(self, domain_to_find: str) -> Optional[str]:
         """
-        Ищет домен во всех файлах списков.
+        Ищет домен во всех списках по резидентному индексу.
 
         Args:
             domain_to_find: Искомый домен.
@@ -35,36 +467,213 @@ class ListManager:
         Returns:
             Имя списка, в котором найден домен, или None.
         """
-        domain_to_find = domain_to_find.strip()
-        for list_name in self.get_list_files():
-            file_path = os.path.join(LISTS_DIR, f"{list_name}.list")
-            if not os.path.exists(file_path):
-                continue
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        if line.strip() == domain_to_find:
-                            return list_name
-            except Exception:
-                # Игнорируем ошибки чтения, просто ищем дальше
-                continue
+        self.refresh_index()
+        return self._index.get(domain_to_find.strip())
+
+    def find_domains(self, domains: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Пакетный поиск доменов во всех списках.
+
+        Списки синхронизируются с диском один раз за вызов (изменившиеся
+        файлы читаются построчно за один проход), после чего каждый домен
+        ищется в индексе.
+
+        Args:
+            domains: Итерируемый набор доменов.
+
+        Returns:
+            Словарь домен -> имя списка (или None), в порядке первого появления.
+        """
+        self.refresh_index()
+        result: Dict[str, Optional[str]] = {}
+        for domain in domains:
+            domain = domain.strip()
+            if domain and domain not in result:
+                result[domain] = self._index.get(domain)
+        return result
+
+    @staticmethod
+    def _is_domain(entry: str) -> bool:
+        """Проверяет, что запись списка - домен, а не IP-адрес или подсеть."""
+        try:
+            ipaddress.ip_network(entry, strict=False)
+            return False
+        except ValueError:
+            return True
+
+    @staticmethod
+    def _parent_domains(domain: str):
+        """
+        Перебирает родительские домены от ближайшего к корню:
+        'a.b.example.com' -> 'b.example.com', 'example.com', 'com'.
+        """
+        labels = domain.split('.')
+        for i in range(1, len(labels)):
+            yield '.'.join(labels[i:])
+
+    def find_covering(self, domain: str) -> Optional[Tuple[str, str]]:
+        """
+        Ищет ближайший родительский домен, уже присутствующий в списках.
+        Запись родителя в списке покрывает все его поддомены.
+
+        Args:
+            domain: Проверяемый домен.
+
+        Returns:
+            Кортеж (родительский домен, имя списка) или None.
+        """
+        self.refresh_index()
+        return self._nearest_parent(domain.strip())
+
+    def find_coverings(self, domains: Iterable[str]) -> Dict[str, Optional[Tuple[str, str]]]:
+        """
+        Пакетный find_covering: индекс синхронизируется с файлами один раз
+        на весь пакет, а не на каждый домен.
+
+        Returns:
+            Словарь домен -> (родительский домен, имя списка) или None.
+        """
+        self.refresh_index()
+        return {domain: self._nearest_parent(domain.strip()) for domain in domains}
+
+    def _nearest_parent(self, domain: str) -> Optional[Tuple[str, str]]:
+        """find_covering без синхронизации индекса с файлами."""
+        if not self._is_domain(domain):
+            return None
+        for parent in self._parent_domains(domain):
+            list_name = self._index.get(parent)
+            if list_name:
+                return parent, list_name
         return None
 
+    def match_host(self, host: str) -> Optional[str]:
+        """
+        Определяет, какой список маршрутизирует хост. Побеждает самая
+        длинная совпавшая запись: точный домен, затем ближайший родитель.
+        Стоимость - число меток в имени хоста.
+
+        Args:
+            host: Имя хоста.
+
+        Returns:
+            Имя списка или None, если хост не покрыт ни одним списком.
+        """
+        self.refresh_index()
+        host = host.strip().rstrip('.')
+        list_name = self._index.get(host)
+        if list_name or not self._is_domain(host):
+            return list_name
+        for parent in self._parent_domains(host):
+            list_name = self._index.get(parent)
+            if list_name:
+                return list_name
+        return None
+
+    def _search_arrays(self) -> Tuple[List[str], List[str]]:
+        """Возвращает индекс поиска, пересобирая его после изменений списков."""
+        self.refresh_index()
+        if self._search is None:
+            entries = sorted(self._index)
+            self._search = (entries, sorted(entry[::-1] for entry in entries))
+        return self._search
+
+    @staticmethod
+    def _prefix_slice(array: List[str], prefix: str) -> List[str]:
+        """Возвращает элементы отсортированного массива, начинающиеся с prefix."""
+        return array[bisect_left(array, prefix):bisect_right(array, prefix + "\U0010ffff")]
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> List[Tuple[str, str, str]]:
+        """
+        Ищет записи во всех списках.
+
+        Запрос `*.example.com` ищет сам домен и его поддомены. Обычный
+        запрос дает, по убыванию релевантности: точное совпадение,
+        покрывающий родительский домен, поддомены, записи с таким началом
+        и, если результатов мало, записи, содержащие запрос. Внутри каждой
+        группы короткие записи идут первыми.
+
+        Поддомены ищутся двоичным поиском по массиву перевернутых строк,
+        префиксы - по отсортированному массиву; полный перебор нужен только
+        для поиска подстроки.
+
+        Returns:
+            Список кортежей (запись, имя списка, вид совпадения).
+        """
+        query = query.strip().lower()
+        suffix_only = query.startswith("*.")
+        query = query.lstrip("*.").rstrip(".")
+        if not query:
+            return []
+        entries, reversed_entries = self._search_arrays()
+        found: Dict[str, str] = {}
+
+        def take(candidates: Iterable[str], kind: str) -> None:
+            candidates = (entry for entry in candidates if entry not in found)
+            for entry in heapq.nsmallest(limit - len(found), candidates, key=lambda e: (len(e), e)):
+                found[entry] = kind
+
+        if query in self._index:
+            take([query], "точное")
+        if not suffix_only:
+            covering = self.find_covering(query)
+            if covering:
+                take([covering[0]], "родитель")
+        take((entry[::-1] for entry in self._prefix_slice(reversed_entries, f".{query}"[::-1])), "поддомен")
+        if not suffix_only:
+            take(self._prefix_slice(entries, query), "начало")
+            if len(found) < limit:
+                take((entry for entry in entries if query in entry), "вхождение")
+
+        return [(entry, self._index[entry], kind) for entry, kind in found.items()]
+
+    def find_redundant(self, list_name: str) -> List[str]:
+        """
+        Возвращает домены списка, которые уже покрыты родительским доменом
+        из этого же списка и поэтому избыточны.
+        """
+        domains = self._refresh_list(list_name)
+        return sorted(
+            domain for domain in domains
+            if self._is_domain(domain)
+            and any(parent in domains for parent in self._parent_domains(domain))
+        )
+
+    async def collapse_list(self, list_name: str) -> List[str]:
+        """
+        Удаляет из списка поддомены, покрытые родительскими записями.
+
+        Returns:
+            Список удаленных доменов.
+        """
+        redundant = self.find_redundant(list_name)
+        if redundant and await self.remove_from_list(list_name, redundant):
+            return redundant
+        return []
+
+    def transaction(self) -> ListTransaction:
+        """Создает транзакцию для пакетного изменения нескольких списков."""
+        return ListTransaction(self)
+
     async def move_domain(self, domain: str, from_list: str, to_list: str) -> bool:
         """
         Перемещает домен из одного списка в другой.
         """
-        # Шаг 1: Удаляем из старого списка
-        await self.remove_from_list(from_list, [domain])
-        # Шаг 2: Добавляем в новый список
-        await self.add_to_list(to_list, [domain])
-        return True
+        try:
+            await self.transaction().move(domain, from_list, to_list).commit()
+            return True
+        except Exception:
+            return False
 
     def read_list(self, list_name: str) -> str:
         """
         Читает содержимое файла списка и возвращает его как строку.
+        Незавершенный журнал предварительно уплотняется в файл.
         """
         file_path = os.path.join(LISTS_DIR, f"{list_name}.list")
+        try:
+            self.compact(list_name)
+        except Exception as e:
+            return f"Ошибка уплотнения журнала: {e}"
         if not os.path.exists(file_path):
             # Если файла нет, создадим его
             with open(file_path, 'w', encoding='utf-8') as f:
@@ -80,70 +689,132 @@ class ListManager:
 
     async def add_to_list(self, list_name: str, domains: List[str]) -> bool:
         """
-        Добавляет домены в файл списка, избегая дубликатов.
+        Добавляет домены в список, избегая дубликатов.
+        Изменение записывается в журнал, а не переписывает весь файл.
         Возвращает True, если были добавлены новые домены.
         """
-        file_path = os.path.join(LISTS_DIR, f"{list_name}.list")
-        
         try:
-            existing_domains = set()
-            if os.path.exists(file_path):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    # Читаем только непустые строки
-                    existing_domains = set(line.strip() for line in f if line.strip())
-            
-            initial_count = len(existing_domains)
-            
-            for domain in domains:
-                existing_domains.add(domain.strip())
-
-            if len(existing_domains) > initial_count:
-                sorted_domains = sorted(list(existing_domains))
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write("\n".join(sorted_domains) + "\n")
-                return True
-            return False
-
+            diff = await self.transaction().add(list_name, domains).commit()
+            return bool(diff.added.get(list_name))
         except Exception:
             return False
 
+    async def import_entries(self, list_name: str, lines: Iterable[str],
+                             progress: Optional[Callable[[ImportResult], Awaitable[None]]] = None,
+                             chunk_size: Optional[int] = None, skip_covered: bool = False) -> ImportResult:
+        """
+        Потоково импортирует строки (например, загруженного файла) в список.
+
+        Строки читаются порциями по chunk_size: каждая порция нормализуется,
+        записи из других списков пропускаются, новые дописываются в журнал.
+        Память расходуется только на одну порцию, а журнал уплотняется один
+        раз в конце, а не после каждой порции.
+
+        Args:
+            list_name: Целевой список.
+            lines: Итератор строк; читается однократно.
+            progress: Корутина, которая вызывается после каждой порции.
+            chunk_size: Размер порции, по умолчанию IMPORT_CHUNK_SIZE.
+            skip_covered: Пропускать поддомены, покрытые родительским доменом
+                целевого списка (как при добавлении текстом). Включается,
+                только если поддомены родителя маршрутизирует dnsmasq.
+        """
+        result = ImportResult()
+        lines = iter(lines)
+        chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+        try:
+            while True:
+                chunk = list(islice(lines, chunk_size))
+                if not chunk:
+                    break
+                result.lines += len(chunk)
+                normalized = normalize_entries(chunk)
+                result.rejected += len(normalized.rejected)
+                result.existing += normalized.duplicates
+
+                new = set()
+                for entry, owner in self.find_domains(normalized.entries).items():
+                    if owner is None:
+                        covering = self._nearest_parent(entry) if skip_covered else None
+                        if covering and covering[1] == list_name:
+                            result.covered += 1
+                        else:
+                            new.add(entry)
+                    elif owner == list_name:
+                        result.existing += 1
+                    else:
+                        result.foreign += 1
+                if new:
+                    self._refresh_list(list_name)
+                    self._commit_ops(list_name, new, set(), auto_compact=False)
+                    result.added += len(new)
+                    result.diff.added.setdefault(list_name, set()).update(new)
+
+                if progress:
+                    await progress(result)
+                # Отдаем управление циклу событий между порциями
+                await asyncio.sleep(0)
+        finally:
+            self.compact(list_name)
+        return result
+
     async def remove_from_list(self, list_name: str, domains: List[str]) -> bool:
         """
-        Удаляет домены из файла списка.
+        Удаляет домены из списка.
+        Изменение записывается в журнал, а не переписывает весь файл.
         Возвращает True, если были удалены домены.
         """
-        file_path = os.path.join(LISTS_DIR, f"{list_name}.list")
-        if not os.path.exists(file_path):
-            return False
-
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                existing_domains = set(line.strip() for line in f if line.strip())
-            
-            initial_count = len(existing_domains)
-            domains_to_remove = {d.strip() for d in domains}
-            
-            # Удаляем домены
-            existing_domains -= domains_to_remove
-
-            if len(existing_domains) < initial_count:
-                sorted_domains = sorted(list(existing_domains))
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write("\n".join(sorted_domains) + "\n")
-                return True
-            return False
+            diff = await self.transaction().remove(list_name, domains).commit()
+            return bool(diff.removed.get(list_name))
         except Exception:
             return False
 
-    async def apply_changes(self) -> Tuple[bool, str]:
+    async def apply_changes(self, diff: Optional[ListDiff] = None) -> Tuple[bool, str]:
         """
         Запускает скрипт обновления списков и возвращает результат.
+
+        Args:
+            diff: Изменения, зафиксированные транзакцией. Если передан
+                  пустой diff, применять нечего и скрипт не запускается.
         """
+        if diff is not None and not diff:
+            return True, "Изменений в списках нет."
+
         if not os.path.exists(UPDATE_SCRIPT):
             return False, f"Скрипт обновления `{UPDATE_SCRIPT}` не найден. Запустите установку/обновление бота, чтобы создать его."
 
-        success, output = await run_shell_command(UPDATE_SCRIPT)
+        # Синхронизируются только затронутые списки, в ipset уходит лишь разница
+        command = f"sh {UPDATE_SCRIPT}"
+        if diff is not None:
+            command = f"{command} {' '.join(diff.touched_lists())}"
+
+        success, output = await run_shell_command(command)
         if success:
-            return True, "Списки успешно обновлены."
+            return True, f"Списки успешно обновлены.\n```\n{output}\n```" if output else "Списки успешно обновлены."
         else:
             return False, f"Ошибка обновления списков:\n`{output}`"
+
+    def schedule_apply(self, diff: Optional[ListDiff] = None) -> asyncio.Future:
+        """
+        Ставит применение изменений в общую очередь (см. ApplyScheduler).
+        Несколько правок подряд стоят одного запуска скрипта обновления.
+        """
+        return self.scheduler.schedule(diff)
+
+    @property
+    def scheduler(self) -> ApplyScheduler:
+        """Планировщик применения списков, создается при первом обращении."""
+        if self._scheduler is None:
+            self._scheduler = ApplyScheduler(self)
+        return self._scheduler
+
+    async def refresh_resolved(self) -> Tuple[bool, str]:
+        """
+        Повторно разрешает домены с истекшим TTL и продлевает их записи в ipset.
+        Остальные домены берутся из кэша DNS и не запрашиваются.
+        """
+        if not os.path.exists(UPDATE_SCRIPT):
+            return False, f"Скрипт обновления `{UPDATE_SCRIPT}` не найден."
+        async with self.scheduler.lock:
+            return await run_shell_command(f"sh {UPDATE_SCRIPT} --refresh")
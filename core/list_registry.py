@@ -0,0 +1,146 @@
+import os
+import sys
+from configparser import ConfigParser
+from typing import Dict, Iterator, List, Optional
+
+from .log_utils import log
+
+# kdw.cfg в корне проекта
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kdw.cfg')
+# Секция kdw.cfg с описанием списков
+LISTS_SECTION = "lists"
+# Значение вместо порта для списка, трафик которого идет напрямую
+DIRECT = "direct"
+# Типы частей ipset, в которые загружаются записи списка
+DEFAULT_SET_TYPE = "hash:net"
+SET_TYPES = ("hash:net", "hash:ip")
+# Списки по умолчанию, если в kdw.cfg нет секции [lists]
+DEFAULT_LISTS = {
+    "shadowsocks": "1080",
+    "trojan": "10829",
+    "vmess": "10810",
+    "direct": DIRECT,
+}
+
+
+class ListSpec:
+    """
+    Описание одного списка: куда направляется его трафик и какого типа
+    ipset-части хранят его записи.
+    """
+
+    def __init__(self, name: str, port: Optional[int], set_type: str = DEFAULT_SET_TYPE):
+        self.name = name
+        # Порт прокси для REDIRECT; None - трафик списка идет напрямую
+        self.port = port
+        self.set_type = set_type
+
+    @property
+    def direct(self) -> bool:
+        """Список исключений: трафик к его адресам не проксируется."""
+        return self.port is None
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ListSpec) and (self.name, self.port, self.set_type) == (other.name, other.port, other.set_type)
+
+    def __repr__(self) -> str:
+        return f"ListSpec({self.name!r}, {self.port!r}, {self.set_type!r})"
+
+
+def parse_list_spec(name: str, value: str) -> ListSpec:
+    """
+    Разбирает строку секции [lists]: `порт [тип ipset]` или `direct [тип ipset]`.
+
+    Raises:
+        ValueError: если порт или тип ipset некорректны.
+    """
+    name = name.strip().lower()
+    if not name or not name.replace("_", "").replace("-", "").isalnum():
+        raise ValueError(f"некорректное имя списка: {name!r}")
+    parts = value.split()
+    if not parts or len(parts) > 2:
+        raise ValueError(f"{name}: ожидается 'порт [тип ipset]' или 'direct [тип ipset]'")
+
+    target = parts[0].lower()
+    if target == DIRECT:
+        port = None
+    elif target.isdigit() and 0 < int(target) < 65536:
+        port = int(target)
+    else:
+        raise ValueError(f"{name}: некорректный порт {parts[0]!r}")
+
+    set_type = parts[1].lower() if len(parts) > 1 else DEFAULT_SET_TYPE
+    if set_type not in SET_TYPES:
+        raise ValueError(f"{name}: тип ipset {set_type!r} не поддерживается, допустимы: {', '.join(SET_TYPES)}")
+    return ListSpec(name, port, set_type)
+
+
+class ListRegistry:
+    """
+    Реестр списков из секции [lists] файла kdw.cfg: имя списка, порт
+    прокси (или direct) и тип ipset. Единственный источник перечня
+    списков для меню бота, индекса ListManager и правил Firewall.
+    """
+
+    def __init__(self, specs: List[ListSpec]):
+        self._specs: Dict[str, ListSpec] = {spec.name: spec for spec in specs}
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "ListRegistry":
+        """
+        Строит реестр из kdw.cfg. Некорректные строки пропускаются
+        с предупреждением; без секции [lists] используются DEFAULT_LISTS.
+        """
+        items = config.items(LISTS_SECTION) if config.has_section(LISTS_SECTION) else DEFAULT_LISTS.items()
+        specs = []
+        for name, value in items:
+            try:
+                specs.append(parse_list_spec(name, value))
+            except ValueError as e:
+                log.warning(f"Пропускаю список в [{LISTS_SECTION}]: {e}")
+        return cls(specs)
+
+    def names(self) -> List[str]:
+        """Имена списков в порядке их описания."""
+        return list(self._specs)
+
+    def get(self, name: str) -> Optional[ListSpec]:
+        return self._specs.get(name)
+
+    def port(self, name: str) -> Optional[int]:
+        """Порт прокси списка или None, если списка нет или он direct."""
+        spec = self._specs.get(name)
+        return spec.port if spec else None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._specs
+
+    def __iter__(self) -> Iterator[ListSpec]:
+        return iter(self._specs.values())
+
+
+_registry: Optional[ListRegistry] = None
+
+
+def get_registry() -> ListRegistry:
+    """Возвращает реестр списков, при первом обращении читая kdw.cfg."""
+    global _registry
+    if _registry is None:
+        config = ConfigParser()
+        config.read(CONFIG_FILE, encoding='utf-8')
+        _registry = ListRegistry.from_config(config)
+    return _registry
+
+
+def reload_registry() -> ListRegistry:
+    """Сбрасывает кэш и перечитывает реестр (после изменения kdw.cfg)."""
+    global _registry
+    _registry = None
+    return get_registry()
+
+
+if __name__ == '__main__':
+    # Для shell-скриптов: строка "имя порт|direct тип_ipset" на каждый список
+    for spec in get_registry():
+        print(spec.name, DIRECT if spec.direct else spec.port, spec.set_type)
+    sys.exit(0)
@@ -0,0 +1,166 @@
+import re
+import ipaddress
+import unicodedata
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+# Корректное доменное имя в нижнем регистре: метки 1-63 символа из [a-z0-9-]
+# без дефиса по краям, не менее двух меток, домен верхнего уровня не из одних цифр
+_DOMAIN_RE = re.compile(
+    r"(?=.{1,253}$)(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+"
+    r"(?=[a-z0-9-]*[a-z])[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?"
+)
+# Схема URL (http://, https://, socks5:// и т.п.)
+_SCHEME_RE = re.compile(r"^[a-z][a-z0-9+.-]*://")
+# Порт после имени хоста
+_PORT_RE = re.compile(r":\d+$")
+# Дешевая предпроверка перед разбором IP-адреса или подсети модулем ipaddress
+_IP_LIKE_RE = re.compile(r"[0-9a-f:.]+(?:/\d{1,3})?")
+
+
+class NormalizeResult:
+    """
+    Итог нормализации пакета строк: уникальные записи в порядке
+    появления, отклоненные строки и число отброшенных повторов.
+    """
+
+    def __init__(self):
+        self.entries: List[str] = []
+        self.rejected: List[str] = []
+        self.duplicates = 0
+
+
+def normalize_entry(line: str) -> Optional[str]:
+    """
+    Приводит строку к записи списка: домену, IP-адресу или подсети.
+
+    Домены приводятся к нижнему регистру и punycode (IDNA), из URL
+    убираются схема, учетные данные, путь и порт, отбрасываются
+    ведущие `*.`/`.` и завершающая точка. IP-адреса и подсети
+    возвращаются в каноническом виде.
+
+    Returns:
+        Запись или None для пустой строки и комментария.
+
+    Raises:
+        ValueError: если строка не является доменом, IP или подсетью.
+    """
+    entry = line.strip().lower()
+    if not entry or entry.startswith('#'):
+        return None
+    # Быстрый путь: строка уже является корректным доменом
+    if _DOMAIN_RE.fullmatch(entry):
+        return entry
+
+    entry = _SCHEME_RE.sub("", entry)
+    entry = entry.split('/', 1)[0] if '/' in entry and not _is_network(entry) else entry
+    entry = entry.split('?', 1)[0].split('#', 1)[0].rsplit('@', 1)[-1]
+    if entry.startswith('['):
+        # IPv6 в URL: [2001:db8::1]:443
+        entry = entry[1:].split(']', 1)[0]
+    elif entry.count(':') == 1:
+        entry = _PORT_RE.sub("", entry)
+
+    if _is_network(entry):
+        network = ipaddress.ip_network(entry, strict=False)
+        if '/' not in entry or network.prefixlen == network.max_prefixlen:
+            return str(network.network_address)
+        return str(network)
+
+    entry = entry.lstrip('*.').rstrip('.')
+    if not entry.isascii():
+        try:
+            entry = ".".join(_idna_label(label) for label in entry.split('.'))
+        except UnicodeError:
+            raise ValueError(f"некорректное IDN-имя: {line.strip()}")
+    if not _DOMAIN_RE.fullmatch(entry):
+        raise ValueError(f"некорректная запись: {line.strip()}")
+    return entry
+
+
+@lru_cache(maxsize=4096)
+def _idna_label(label: str) -> str:
+    """
+    Переводит метку домена в punycode. Метки кэшируются: в пакете
+    IDN-доменов одни и те же зоны (например, .рф) повторяются постоянно.
+    """
+    if label.isascii():
+        return label
+    return "xn--" + unicodedata.normalize("NFKC", label).lower().encode("punycode").decode("ascii")
+
+
+def _is_network(entry: str) -> bool:
+    """Проверяет, является ли строка IP-адресом или подсетью."""
+    if not _IP_LIKE_RE.fullmatch(entry):
+        return False
+    try:
+        ipaddress.ip_network(entry, strict=False)
+        return True
+    except ValueError:
+        return False
+
+
+def normalize_entries(lines: Iterable[str]) -> NormalizeResult:
+    """
+    Нормализует пакет строк (например, загруженный документ) с удалением
+    повторов. Некорректные строки не прерывают обработку, а попадают
+    в NormalizeResult.rejected.
+    """
+    result = NormalizeResult()
+    seen = set()
+    for line in lines:
+        try:
+            entry = normalize_entry(line)
+        except ValueError:
+            result.rejected.append(line.strip())
+            continue
+        if entry is None:
+            continue
+        if entry in seen:
+            result.duplicates += 1
+            continue
+        seen.add(entry)
+        result.entries.append(entry)
+    return result
+
+
+def aggregate_networks(entries: Iterable[str]) -> Tuple[List[str], int]:
+    """
+    Объединяет пересекающиеся и смежные IP-адреса и подсети в минимальный
+    набор префиксов.
+
+    Каждая запись переводится в целочисленный интервал [начало, конец],
+    интервалы сортируются и сливаются за один проход, после чего каждый
+    итоговый интервал снова разбивается на CIDR-префиксы. IPv4 и IPv6
+    обрабатываются отдельно.
+
+    Args:
+        entries: IP-адреса и подсети в виде строк.
+
+    Returns:
+        Кортеж (итоговые префиксы, на сколько записей стало меньше).
+        Одиночные адреса возвращаются без суффикса /32 (/128).
+    """
+    intervals = {4: [], 6: []}
+    total = 0
+    for entry in entries:
+        network = ipaddress.ip_network(entry.strip(), strict=False)
+        intervals[network.version].append((int(network.network_address), int(network.broadcast_address)))
+        total += 1
+
+    result = []
+    for version, address_class in ((4, ipaddress.IPv4Address), (6, ipaddress.IPv6Address)):
+        merged: List[List[int]] = []
+        for start, end in sorted(intervals[version]):
+            # Интервал пересекается с предыдущим или примыкает к нему вплотную
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        for start, end in merged:
+            for network in ipaddress.summarize_address_range(address_class(start), address_class(end)):
+                is_host = network.prefixlen == network.max_prefixlen
+                result.append(str(network.network_address) if is_host else str(network))
+
+    return result, total - len(result)
@@ -0,0 +1,338 @@
+import os
+import json
+import asyncio
+import ipaddress
+import random
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .log_utils import log
+
+# Параметры резолвера по умолчанию
+DEFAULT_NAMESERVER = "127.0.0.1"
+DEFAULT_CONCURRENCY = 64
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_ATTEMPTS = 2
+
+# Постоянный кэш разрешенных доменов с учетом TTL
+RESOLVE_CACHE_FILE = "/opt/etc/kdw/dns_cache.json"
+# Минимальное время жизни записи кэша: домены с TTL в единицы секунд
+# не должны перезапрашиваться при каждом обновлении
+MIN_CACHE_TTL = 60
+
+# Результаты разрешения одного домена
+RESOLVED = "resolved"
+FAILED = "failed"
+TIMED_OUT = "timed_out"
+
+_TYPE_A = 1
+_CLASS_IN = 1
+
+
+def split_entries(entries: Iterable[str]) -> Tuple[Set[str], Set[str]]:
+    """
+    Делит записи списка на IP-адреса/подсети и домены.
+
+    Returns:
+        Кортеж (IP и подсети, домены).
+    """
+    networks, domains = set(), set()
+    for entry in entries:
+        entry = entry.strip()
+        if not entry or entry.startswith('#'):
+            continue
+        try:
+            ipaddress.ip_network(entry, strict=False)
+            networks.add(entry)
+        except ValueError:
+            domains.add(entry)
+    return networks, domains
+
+
+def build_query(domain: str, query_id: int) -> bytes:
+    """Собирает DNS-запрос A-записи для домена."""
+    header = struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0)
+    question = b"".join(
+        bytes([len(label)]) + label
+        for label in (part.encode("idna") for part in domain.rstrip('.').split('.'))
+    )
+    return header + question + b"\x00" + struct.pack("!HH", _TYPE_A, _CLASS_IN)
+
+
+def _skip_name(data: bytes, offset: int) -> int:
+    """Пропускает (возможно сжатое) доменное имя и возвращает новое смещение."""
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += length + 1
+
+
+def parse_response(data: bytes, query_id: int) -> Tuple[int, List[Tuple[str, int]]]:
+    """
+    Разбирает DNS-ответ.
+
+    Returns:
+        Кортеж (rcode, список пар (IPv4-адрес, TTL)). В список попадают все
+        A-записи ответа, включая записи для цепочки CNAME.
+    """
+    resp_id, flags, qdcount, ancount, _nscount, _arcount = struct.unpack("!HHHHHH", data[:12])
+    if resp_id != query_id:
+        raise ValueError("идентификатор ответа не совпадает с запросом")
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(data, offset) + 4
+
+    records = []
+    for _ in range(ancount):
+        offset = _skip_name(data, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack("!HHIH", data[offset:offset + 10])
+        offset += 10
+        if rtype == _TYPE_A and rclass == _CLASS_IN and rdlength == 4:
+            records.append((str(ipaddress.IPv4Address(data[offset:offset + 4])), ttl))
+        offset += rdlength
+    return flags & 0x000F, records
+
+
+def _expires_at(records: List[Tuple[str, int]], now: int, min_ttl: int = MIN_CACHE_TTL) -> int:
+    """Возвращает момент устаревания ответа: по наименьшему TTL его записей."""
+    return now + max(min(ttl for _ip, ttl in records), min_ttl)
+
+
+class ResolveCache:
+    """
+    Постоянный кэш домен -> IP с учетом TTL из DNS-ответов.
+
+    Запись свежа до момента expires (unix-время). Повторно разрешаются
+    только устаревшие домены; если повторное разрешение не удалось,
+    прежние адреса остаются в кэше со старым сроком и сами уходят
+    из ipset по таймауту.
+    """
+
+    def __init__(self, cache_file: Optional[str] = None, min_ttl: int = MIN_CACHE_TTL):
+        self.cache_file = cache_file or RESOLVE_CACHE_FILE
+        self.min_ttl = min_ttl
+        self._records: Dict[str, Tuple[List[str], int]] = {}
+        self._dirty = False
+
+    def load(self) -> None:
+        """Читает кэш с диска. Поврежденный или отсутствующий кэш считается пустым."""
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._records = {domain: (list(ips), int(expires)) for domain, (ips, expires) in data.items()}
+        except FileNotFoundError:
+            self._records = {}
+        except Exception as e:
+            log.warning(f"Не удалось прочитать кэш DNS {self.cache_file}: {e}")
+            self._records = {}
+        self._dirty = False
+
+    def save(self) -> None:
+        """Атомарно сохраняет кэш, если он изменился."""
+        if not self._dirty:
+            return
+        tmp_path = f"{self.cache_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({domain: [ips, expires] for domain, (ips, expires) in self._records.items()}, f)
+        os.replace(tmp_path, self.cache_file)
+        self._dirty = False
+
+    def get(self, domain: str) -> Optional[Tuple[List[str], int]]:
+        """Возвращает (IP-адреса, момент устаревания) домена или None."""
+        return self._records.get(domain)
+
+    def expired(self, domains: Iterable[str], now: Optional[int] = None) -> Set[str]:
+        """Возвращает домены, которых нет в кэше или чья запись устарела."""
+        now = int(time.time()) if now is None else now
+        return {domain for domain in domains
+                if domain not in self._records or self._records[domain][1] <= now}
+
+    def update(self, domain: str, records: List[Tuple[str, int]], now: int) -> int:
+        """Запоминает ответ для домена и возвращает момент его устаревания."""
+        expires = _expires_at(records, now, self.min_ttl)
+        self._records[domain] = (sorted({ip for ip, _ttl in records}), expires)
+        self._dirty = True
+        return expires
+
+    def prune(self, domains: Iterable[str]) -> None:
+        """Удаляет из кэша домены, которых больше нет ни в одном списке."""
+        keep = set(domains)
+        stale = [domain for domain in self._records if domain not in keep]
+        for domain in stale:
+            del self._records[domain]
+        self._dirty = self._dirty or bool(stale)
+
+
+class _DnsProtocol(asyncio.DatagramProtocol):
+    """Протокол одного UDP-запроса: ждет первый ответ и отдает его в future."""
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class ResolveStats:
+    """Статистика разрешения доменов одного списка."""
+
+    def __init__(self):
+        self.resolved = 0
+        self.cached = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.elapsed = 0.0
+
+    @property
+    def total(self) -> int:
+        return self.resolved + self.cached + self.failed + self.timed_out
+
+    def __str__(self) -> str:
+        return (f"DNS {self.resolved + self.cached}/{self.total}, из кэша: {self.cached}, ошибок: {self.failed}, "
+                f"таймаутов: {self.timed_out}, {self.elapsed:.2f} с")
+
+
+class DnsResolver:
+    """
+    Асинхронный резолвер доменов из списков.
+
+    Запросы отправляются напрямую по UDP без пула потоков: все домены
+    разрешаются параллельно с ограничением числа одновременных запросов
+    и таймаутом на каждый запрос. Для домена возвращаются все его A-записи.
+    """
+
+    def __init__(self, nameserver: str = DEFAULT_NAMESERVER, port: int = 53,
+                 concurrency: int = DEFAULT_CONCURRENCY, timeout: float = DEFAULT_TIMEOUT,
+                 attempts: int = DEFAULT_ATTEMPTS):
+        self.nameserver = nameserver
+        self.port = port
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.attempts = attempts
+
+    async def query(self, domain: str) -> Tuple[int, List[Tuple[str, int]]]:
+        """
+        Выполняет один DNS-запрос A-записи.
+
+        Raises:
+            asyncio.TimeoutError: если ответ не пришел за self.timeout.
+        """
+        loop = asyncio.get_running_loop()
+        query_id = random.randint(0, 0xFFFF)
+        future = loop.create_future()
+        transport, _protocol = await loop.create_datagram_endpoint(
+            lambda: _DnsProtocol(future), remote_addr=(self.nameserver, self.port)
+        )
+        try:
+            transport.sendto(build_query(domain, query_id))
+            data = await asyncio.wait_for(future, self.timeout)
+            return parse_response(data, query_id)
+        finally:
+            transport.close()
+
+    async def resolve(self, domain: str) -> Tuple[str, List[Tuple[str, int]]]:
+        """
+        Разрешает домен с повторными попытками при таймауте.
+
+        Returns:
+            Кортеж (статус, список пар (IP, TTL)).
+        """
+        for _ in range(self.attempts):
+            try:
+                rcode, records = await self.query(domain)
+            except asyncio.TimeoutError:
+                continue
+            except Exception as e:
+                log.debug(f"Ошибка разрешения домена {domain}: {e}")
+                return FAILED, []
+            if rcode == 0 and records:
+                return RESOLVED, records
+            return FAILED, []
+        return TIMED_OUT, []
+
+    async def resolve_many(self, domains: Iterable[str]) -> Dict[str, Tuple[str, List[Tuple[str, int]]]]:
+        """
+        Параллельно разрешает набор доменов.
+
+        Returns:
+            Словарь домен -> (статус, список пар (IP, TTL)).
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results: Dict[str, Tuple[str, List[Tuple[str, int]]]] = {}
+
+        async def worker(domain: str):
+            async with semaphore:
+                results[domain] = await self.resolve(domain)
+
+        await asyncio.gather(*(worker(domain) for domain in set(domains)))
+        return results
+
+    async def resolve_lists(self, lists: Dict[str, Iterable[str]],
+                            cache: Optional[ResolveCache] = None) -> Tuple[Dict[str, Dict[str, int]], Dict[str, ResolveStats]]:
+        """
+        Превращает списки доменов в наборы IP для загрузчика ipset.
+        Домены всех списков разрешаются одним параллельным проходом,
+        IP-адреса и подсети из списков передаются как есть.
+
+        Args:
+            lists: Словарь имя списка -> записи.
+            cache: Кэш разрешенных доменов. Если передан, запрашиваются
+                   только устаревшие домены, а ответы сохраняются в кэш.
+
+        Returns:
+            Кортеж (список -> {IP/подсеть: момент устаревания, 0 - бессрочно},
+            список -> статистика разрешения).
+        """
+        started = time.monotonic()
+        now = int(time.time())
+        split = {list_name: split_entries(entries) for list_name, entries in lists.items()}
+        domains_all = {domain for _networks, domains in split.values() for domain in domains}
+        to_resolve = domains_all if cache is None else cache.expired(domains_all, now)
+        results = await self.resolve_many(to_resolve)
+        elapsed = time.monotonic() - started
+
+        # Домен -> (статус, IP-адреса, момент устаревания)
+        resolved: Dict[str, Tuple[str, List[str], int]] = {}
+        for domain in domains_all:
+            status, records = results.get(domain, (None, []))
+            if status == RESOLVED:
+                expires = cache.update(domain, records, now) if cache else _expires_at(records, now)
+                resolved[domain] = (RESOLVED, [ip for ip, _ttl in records], expires)
+                continue
+            cached = cache.get(domain) if cache else None
+            # Свежая запись кэша или прежние адреса домена, который сейчас не разрешился
+            ips, expires = cached if cached else ([], 0)
+            resolved[domain] = (status, ips, expires)
+
+        ip_sets: Dict[str, Dict[str, int]] = {}
+        stats: Dict[str, ResolveStats] = {}
+        for list_name, (networks, domains) in split.items():
+            list_stats = ResolveStats()
+            list_stats.elapsed = elapsed
+            entries = dict.fromkeys(networks, 0)
+            for domain in domains:
+                status, ips, expires = resolved[domain]
+                if status == RESOLVED:
+                    list_stats.resolved += 1
+                elif status is None:
+                    list_stats.cached += 1
+                elif status == TIMED_OUT:
+                    list_stats.timed_out += 1
+                else:
+                    list_stats.failed += 1
+                for ip in ips:
+                    # IP, общий для нескольких доменов, живет по самому долгому из них
+                    if entries.get(ip, -1) != 0:
+                        entries[ip] = max(entries.get(ip, 0), expires)
+            ip_sets[list_name] = entries
+            stats[list_name] = list_stats
+        return ip_sets, stats
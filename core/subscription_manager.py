@@ -0,0 +1,240 @@
+import os
+import json
+import hashlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import httpx
+
+from .list_manager import ListManager, ListDiff
+from .log_utils import log
+from .net_utils import normalize_entry
+
+# Метаданные подписок (ETag, Last-Modified) и снимки их последнего содержимого
+SUBSCRIPTIONS_STATE_FILE = "/opt/etc/kdw/subscriptions.state.json"
+SUBSCRIPTIONS_DIR = "/opt/etc/kdw/subscriptions"
+# Таймаут загрузки одного источника, в секундах
+DOWNLOAD_TIMEOUT = 60.0
+
+
+def normalize_line(line: str) -> Optional[str]:
+    """
+    Приводит строку источника к записи списка общим нормализатором.
+    Дополнительно понимает комментарии в конце строки (#) и формат
+    hosts-файла ("0.0.0.0 example.com").
+
+    Returns:
+        Запись или None, если строка пустая.
+
+    Raises:
+        ValueError: если запись некорректна.
+    """
+    line = line.split('#', 1)[0].strip()
+    if not line:
+        return None
+    return normalize_entry(line.split()[-1])
+
+
+def parse_sources(value: str) -> List[str]:
+    """Разбирает перечень источников из kdw.cfg (через запятую или пробел)."""
+    return [source for source in value.replace(',', ' ').split() if source]
+
+
+class SubscriptionManager:
+    """
+    Обновляет списки из подписок: HTTP(S)-адресов или локальных файлов.
+
+    Источник скачивается потоково, построчно нормализуется и складывается
+    в множество без повторов. Повторная загрузка условная (ETag /
+    If-Modified-Since, для файлов - mtime), а в список попадает только
+    разница с предыдущим снимком источника.
+    """
+
+    def __init__(self, list_manager: ListManager, sources: Dict[str, List[str]],
+                 state_file: Optional[str] = None, snapshots_dir: Optional[str] = None):
+        """
+        Args:
+            list_manager: Менеджер списков, в которые применяются изменения.
+            sources: Словарь имя списка -> источники подписки.
+        """
+        self.list_manager = list_manager
+        self.sources = sources
+        self.state_file = state_file or SUBSCRIPTIONS_STATE_FILE
+        self.snapshots_dir = snapshots_dir or SUBSCRIPTIONS_DIR
+        # Число отклоненных строк текущего источника
+        self._rejected = 0
+
+    def load_state(self) -> Dict[str, Dict[str, Dict[str, str]]]:
+        """Читает метаданные подписок: список -> источник -> {etag, last_modified}."""
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log.warning(f"Не удалось прочитать состояние подписок {self.state_file}: {e}")
+            return {}
+
+    def save_state(self, state: Dict[str, Dict[str, Dict[str, str]]]) -> None:
+        """Атомарно сохраняет метаданные подписок."""
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_file)
+
+    def _snapshot_path(self, list_name: str, source: str) -> str:
+        """Возвращает путь к снимку содержимого источника."""
+        digest = hashlib.sha1(source.encode()).hexdigest()[:12]
+        return os.path.join(self.snapshots_dir, f"{list_name}.{digest}.txt")
+
+    def read_snapshot(self, list_name: str, source: str) -> Set[str]:
+        """Читает последнее примененное содержимое источника."""
+        try:
+            with open(self._snapshot_path(list_name, source), 'r', encoding='utf-8') as f:
+                return {line.strip() for line in f if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def _write_snapshot(self, list_name: str, source: str, entries: Optional[Set[str]]) -> None:
+        """Атомарно записывает снимок источника; None удаляет снимок."""
+        path = self._snapshot_path(list_name, source)
+        if entries is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(f"{entry}\n" for entry in sorted(entries))
+        os.replace(tmp_path, path)
+
+    def _collect(self, lines: Iterable[str], entries: Set[str]) -> None:
+        """Нормализует строки источника и добавляет их в множество."""
+        for line in lines:
+            try:
+                entry = normalize_line(line)
+            except ValueError:
+                self._rejected += 1
+                continue
+            if entry:
+                entries.add(entry)
+
+    async def _fetch_url(self, url: str, meta: Dict[str, str]) -> Tuple[Optional[Set[str]], Dict[str, str]]:
+        """Потоково скачивает источник по HTTP с условным запросом."""
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        async with httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT, follow_redirects=True) as client:
+            async with client.stream("GET", url, headers=headers) as response:
+                if response.status_code == 304:
+                    return None, meta
+                response.raise_for_status()
+                entries: Set[str] = set()
+                async for line in response.aiter_lines():
+                    self._collect((line,), entries)
+                new_meta = {key: value for key, value in (
+                    ("etag", response.headers.get("ETag")),
+                    ("last_modified", response.headers.get("Last-Modified")),
+                ) if value}
+                return entries, new_meta
+
+    def _fetch_file(self, path: str, meta: Dict[str, str]) -> Tuple[Optional[Set[str]], Dict[str, str]]:
+        """Читает локальный файл построчно, если он изменился с прошлого раза."""
+        mtime = str(os.stat(path).st_mtime)
+        if meta.get("mtime") == mtime:
+            return None, meta
+        entries: Set[str] = set()
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            self._collect(f, entries)
+        return entries, {"mtime": mtime}
+
+    async def fetch(self, source: str, meta: Dict[str, str]) -> Tuple[Optional[Set[str]], Dict[str, str]]:
+        """
+        Загружает источник.
+
+        Returns:
+            Кортеж (записи или None, если источник не изменился; новые метаданные).
+        """
+        if source.startswith(("http://", "https://")):
+            return await self._fetch_url(source, meta)
+        return self._fetch_file(source[len("file://"):] if source.startswith("file://") else source, meta)
+
+    async def refresh(self, force: bool = False) -> Tuple[ListDiff, str]:
+        """
+        Обновляет все подписки и применяет к спискам только разницу.
+
+        Запись удаляется из списка, только если ее больше нет ни в одном
+        источнике этого списка. Записи, которые уже числятся в другом
+        списке, не добавляются: ручное распределение важнее подписки.
+        Источники, убранные из настроек, удаляют свои записи.
+
+        Args:
+            force: Скачать источники без условных заголовков.
+
+        Returns:
+            Кортеж (зафиксированные изменения, отчет по источникам).
+        """
+        state = self.load_state()
+        report = []
+        # Список -> источник -> новое содержимое (None - источник удален)
+        updates: Dict[str, Dict[str, Optional[Set[str]]]] = {}
+        new_state: Dict[str, Dict[str, Dict[str, str]]] = {}
+
+        for list_name, sources in self.sources.items():
+            for source in sources:
+                meta = {} if force else state.get(list_name, {}).get(source, {})
+                self._rejected = 0
+                try:
+                    entries, meta = await self.fetch(source, meta)
+                except Exception as e:
+                    log.warning(f"Не удалось загрузить подписку {source}: {e}")
+                    report.append(f"{list_name}: {source} - ошибка загрузки: {e}")
+                    entries, meta = None, state.get(list_name, {}).get(source, {})
+                else:
+                    if entries is None:
+                        report.append(f"{list_name}: {source} - без изменений")
+                    else:
+                        updates.setdefault(list_name, {})[source] = entries
+                        if self._rejected:
+                            report.append(f"{list_name}: {source} - отклонено {self._rejected} некорректных строк")
+                new_state.setdefault(list_name, {})[source] = meta
+
+        for list_name, sources in state.items():
+            for source in sources:
+                if source not in self.sources.get(list_name, []):
+                    updates.setdefault(list_name, {})[source] = None
+                    report.append(f"{list_name}: {source} - подписка удалена")
+
+        transaction = self.list_manager.transaction()
+        for list_name, changed in updates.items():
+            # Содержимое всех источников списка после обновления
+            current = {source: self.read_snapshot(list_name, source)
+                       for source in set(self.sources.get(list_name, [])) | set(changed)}
+            previous = set().union(*current.values()) if current else set()
+            for source, entries in changed.items():
+                current[source] = entries or set()
+            combined = set().union(*current.values()) if current else set()
+
+            added = combined - previous
+            owners = self.list_manager.find_domains(added)
+            foreign = {entry for entry, owner in owners.items() if owner and owner != list_name}
+            transaction.add(list_name, added - foreign)
+            transaction.remove(list_name, previous - combined)
+            for source, entries in changed.items():
+                if entries is not None:
+                    report.append(f"{list_name}: {source} - {len(entries)} зап.")
+            if foreign:
+                report.append(f"{list_name}: пропущено {len(foreign)} зап. из других списков")
+
+        diff = await transaction.commit()
+        for list_name, changed in updates.items():
+            for source, entries in changed.items():
+                self._write_snapshot(list_name, source, entries)
+        self.save_state(new_state)
+
+        for list_name in diff.touched_lists():
+            report.append(f"{list_name}: +{len(diff.added.get(list_name, ()))} "
+                          f"-{len(diff.removed.get(list_name, ()))}")
+        return diff, "\n".join(report)
@@ -13,6 +13,10 @@ import json
 import html
 import traceback
 import re
+import io
+import gzip
+import time
+import tempfile
 from configparser import ConfigParser
 from ast import literal_eval
 from functools import wraps
@@ -21,7 +25,7 @@ import logging
 import httpx
 from packaging.version import parse as parse_version
 
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.constants import ParseMode
 from telegram.error import BadRequest
 from telegram.ext import (
@@ -39,9 +43,14 @@ from telegram.ext import (
 from core.log_utils import log, set_level as set_log_level
 from core.installer import Installer
 from core.service_manager import ServiceManager
-from core.list_manager import ListManager
+from core.list_manager import ListManager, ListDiff, shorten_entry
+from core.list_registry import get_registry
+from core.firewall import FIREWALL_STATE_FILE, FirewallState, read_state, write_state
+from core.subscription_manager import SubscriptionManager, parse_sources
+from core.dnsmasq_manager import DnsmasqManager
 from core.config_manager import ConfigManager
 from core.shell_utils import run_shell_command
+from core.net_utils import normalize_entries
 
 # --- Глобальные переменные и константы ---
 __version__ = "1.0.2"
@@ -49,14 +58,14 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 default_config_file = os.path.join(script_dir, "kdw.cfg")
 persistence_file = os.path.join(script_dir, "kdw_persistence.pickle")
 UPDATE_STATE_FILE = "/tmp/kdw_update_state.json"
-FIREWALL_STATE_FILE = "/opt/etc/kdw/firewall_mode.state"
+# Префикс временных файлов загруженных пользователями списков
+IMPORT_TMP_PREFIX = "kdw_import_"
+# Как часто (в секундах) обновлять сообщение о ходе импорта
+IMPORT_PROGRESS_INTERVAL = 2.0
 
-# Порты для прокси
-PROXY_PORTS = {
-    "shadowsocks": 1080,
-    "trojan": 10829,
-    "vmess": 10810,
-}
+# Поддерживаемые типы прокси. Порты перенаправления задаются в секции
+# [lists] файла kdw.cfg (см. core.list_registry)
+PROXY_TYPES = ("shadowsocks", "trojan", "vmess")
 
 # Состояния для ConversationHandler. Определяют шаги диалога с пользователем.
 (
@@ -75,7 +84,8 @@ PROXY_PORTS = {
     SYSTEM_MANAGEMENT_MENU,
     BOT_SETTINGS_MENU,
     FIREWALL_MENU,
-) = range(15)
+    SEARCH_DOMAIN,
+) = range(16)
 
 # --- Инициализация ---
 # Загрузка конфигурации и инициализация основных модулей ядра.
@@ -115,7 +125,7 @@ bypass_keyboard = [["Ключи", "Списки"], ["🔙 Назад"]]
 key_types_keyboard = [["Shadowsocks"], ["Trojan", "Vmess"], ["🔙 Назад"]]
 key_list_keyboard = [["➕ Добавить"], ["🔙 Назад"]]
 cancel_keyboard = [["Отмена"]]
-lists_action_keyboard = [["👁️ Показать", "➕ Добавить"], ["➖ Удалить", "Поиск домена"], ["🔙 Назад"]]
+lists_action_keyboard = [["👁️ Показать", "➕ Добавить"], ["➖ Удалить", "Поиск домена"], ["🧹 Сжать", "🔙 Назад"]]
 
 
 # --- Декораторы ---
@@ -253,6 +263,38 @@ async def check_for_updates(context: ContextTypes.DEFAULT_TYPE):
                     log.error(f"Не удалось отправить уведомление об обновлении пользователю {user_id}: {e}")
             context.bot_data["last_notified_version"] = str(latest_version)
 
+async def refresh_resolved_ips(_context: ContextTypes.DEFAULT_TYPE):
+    """
+    Периодическая задача: повторно разрешает домены с истекшим TTL
+    и продлевает их записи в ipset. Выполняется только в режиме 'По спискам'.
+    """
+    if read_state().mode != "lists_only":
+        return
+
+    success, output = await list_manager.refresh_resolved()
+    if success:
+        log.debug(f"Обновление DNS-записей списков:\n{output}")
+    else:
+        log.warning(f"Ошибка обновления DNS-записей списков: {output}")
+
+async def refresh_subscriptions(_context: ContextTypes.DEFAULT_TYPE):
+    """
+    Периодическая задача: обновляет списки из подписок [subscriptions] в kdw.cfg
+    и применяет к ipset только получившуюся разницу.
+    """
+    sources = {list_name: parse_sources(value) for list_name, value in config.items('subscriptions')}
+    manager = SubscriptionManager(list_manager, sources)
+    diff, report = await manager.refresh()
+    log.debug(f"Обновление подписок:\n{report}")
+    if not diff:
+        return
+
+    success, output = await list_manager.schedule_apply(diff)
+    if success:
+        log.info(f"Списки обновлены из подписок:\n{report}")
+    else:
+        log.warning(f"Ошибка применения подписок: {output}")
+
 # --- Обработчики главного меню ---
 @private_access
 async def start(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -285,7 +327,7 @@ async def menu_state(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int
 
     # 2. Активные конфиги
     active_configs_lines = []
-    for proxy_type in PROXY_PORTS.keys():
+    for proxy_type in PROXY_TYPES:
         manager = ConfigManager(proxy_type)
         active_config_path = manager.get_active_config()
         if active_config_path:
@@ -297,10 +339,11 @@ async def menu_state(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int
 
     # 3. Режим Firewall
     current_state = "unknown"
+    firewall_state = None
     try:
         if os.path.exists(FIREWALL_STATE_FILE):
-            with open(FIREWALL_STATE_FILE, "r") as f:
-                current_state = f.read().strip()
+            firewall_state = read_state()
+            current_state = firewall_state.mode
     except Exception as e:
         log.warning(f"Не удалось прочитать файл состояния Firewall: {e}")
 
@@ -313,8 +356,8 @@ async def menu_state(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> int
     firewall_report = firewall_mode_map.get(current_state, "Неизвестно")
     
     if current_state == "all_traffic":
-        default_proxy = config.get('firewall', 'default_proxy_type', fallback='N/A')
-        firewall_report += f" (через {default_proxy.capitalize()})"
+        proxy = firewall_state.proxy or config.get('firewall', 'default_proxy_type', fallback='N/A')
+        firewall_report += f" (через {proxy.capitalize()})"
 
     report_parts.append(f"🔥 *Режим Firewall*: `{firewall_report}`")
 
@@ -714,28 +757,133 @@ async def select_list_action(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text(f"Выбран список: *{list_name.capitalize()}*\n\nЧто вы хотите сделать?", reply_markup=ReplyKeyboardMarkup(lists_action_keyboard, resize_keyboard=True), parse_mode=ParseMode.MARKDOWN)
     return SHOW_LIST
 
+# Чаты, которые уже ждут результата очередного применения списков: chat_id -> future
+apply_waiters = {}
+
+def schedule_apply_report(context: ContextTypes.DEFAULT_TYPE, chat_id: int, diff=None) -> None:
+    """
+    Ставит применение списков в общую очередь и присылает результат, когда
+    оно завершится. Обработчик не ждет применения, поэтому несколько правок
+    подряд (в том числе от разных администраторов) объединяются в один запуск,
+    а чат получает один отчет на запуск.
+    """
+    future = list_manager.schedule_apply(diff)
+    if apply_waiters.get(chat_id) is future:
+        return
+    apply_waiters[chat_id] = future
+
+    async def report() -> None:
+        _success, message = await future
+        if apply_waiters.get(chat_id) is future:
+            del apply_waiters[chat_id]
+        await context.bot.send_message(chat_id=chat_id, text=message, parse_mode=ParseMode.MARKDOWN)
+
+    context.application.create_task(report())
+
+def _list_page_view(list_name: str, page: int):
+    """
+    Собирает текст и инлайн-клавиатуру одной страницы списка.
+    Из индекса берется только нужный срез, а не весь файл. Длинные
+    записи укорачиваются, чтобы страница поместилась в одно сообщение;
+    полностью список доступен в выгрузке .gz.
+    """
+    entries, page, pages = list_manager.get_page(list_name, page)
+    if not entries:
+        return f"Список <b>{html.escape(list_name.capitalize())}</b> пуст.", None
+
+    text = (f"Список <b>{html.escape(list_name.capitalize())}</b>, страница {page + 1} из {pages}:\n\n"
+            f"<pre>{html.escape(chr(10).join(shorten_entry(entry) for entry in entries))}</pre>")
+    callback = f"listpage:{list_name}:"
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⏮", callback_data=f"{callback}0"))
+        navigation.append(InlineKeyboardButton("◀️", callback_data=f"{callback}{page - 1}"))
+    navigation.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"{callback}{page}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("▶️", callback_data=f"{callback}{page + 1}"))
+        navigation.append(InlineKeyboardButton("⏭", callback_data=f"{callback}{pages - 1}"))
+    keyboard = [navigation]
+    if pages > 10:
+        keyboard.append([
+            InlineKeyboardButton("-10", callback_data=f"{callback}{max(page - 10, 0)}"),
+            InlineKeyboardButton("+10", callback_data=f"{callback}{min(page + 10, pages - 1)}"),
+        ])
+    keyboard.append([InlineKeyboardButton("📦 Скачать .gz", callback_data=f"listexport:{list_name}")])
+    return text, InlineKeyboardMarkup(keyboard)
+
 @private_access
 async def show_list_content(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    Показывает содержимое выбранного списка доменов.
+    Показывает первую страницу выбранного списка доменов.
     """
     user_id = update.effective_user.id
     list_name = context.user_data.get('current_list')
     log.debug(f"Запрошено содержимое списка '{list_name}'", extra={'user_id': user_id})
-    
-    content = list_manager.read_list(list_name)
-    
-    if len(content) > 4000: # Оставляем запас
-        await update.message.reply_text(f"Содержимое списка *{list_name.capitalize()}*:", parse_mode=ParseMode.MARKDOWN)
-        # Отправляем содержимое в виде файла, если оно слишком большое
-        file_path = os.path.join(script_dir, f"{list_name}_content.txt")
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(content)
-        await update.message.reply_document(document=open(file_path, 'rb'))
-        os.remove(file_path)
-    else:
-        await update.message.reply_text(f"Содержимое списка *{list_name.capitalize()}*:\n\n<pre>{html.escape(content)}</pre>", parse_mode=ParseMode.HTML)
-        
+
+    text, reply_markup = _list_page_view(list_name, 0)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    return SHOW_LIST
+
+@private_access
+async def handle_list_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Обрабатывает кнопки постраничного просмотра и выгрузки списка.
+    """
+    query = update.callback_query
+    action, list_name, *rest = query.data.split(":")
+    if list_name not in list_manager.get_list_files():
+        await query.answer("Список не найден.")
+        return
+
+    if action == "listexport":
+        await query.answer("Готовлю файл...")
+        data = list_manager.export_gzip(list_name)
+        await query.message.reply_document(document=InputFile(io.BytesIO(data), filename=f"{list_name}.txt.gz"),
+                                           caption=f"Список {list_name.capitalize()}: {len(list_manager.sorted_entries(list_name))} зап.")
+        return
+
+    await query.answer()
+    text, reply_markup = _list_page_view(list_name, int(rest[0]) if rest and rest[0].isdigit() else 0)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    except BadRequest as e:
+        # Повторное нажатие на текущую страницу не меняет сообщение
+        if "not modified" not in str(e).lower():
+            raise
+
+@private_access
+async def ask_for_search_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Запрашивает у пользователя строку для поиска по всем спискам.
+    """
+    await update.message.reply_text(
+        "Отправьте домен или часть имени для поиска по всем спискам.\n"
+        "`*.example.com` - сам домен и все его поддомены.",
+        reply_markup=ReplyKeyboardMarkup(cancel_keyboard, resize_keyboard=True), parse_mode=ParseMode.MARKDOWN)
+    return SEARCH_DOMAIN
+
+@private_access
+async def search_domain(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Ищет запрос во всех списках и показывает найденные записи с именами списков.
+    """
+    user_id = update.effective_user.id
+    list_name = context.user_data.get('current_list')
+    query = update.message.text.strip()
+    if query != "Отмена":
+        started = time.perf_counter()
+        matches = list_manager.search(query)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        log.debug(f"Поиск '{query}': {len(matches)} совп. за {elapsed_ms:.1f} мс", extra={'user_id': user_id})
+        if matches:
+            lines = [f"<code>{html.escape(entry)}</code> - {html.escape(owner.capitalize())} ({kind})"
+                     for entry, owner, kind in matches]
+            text = f"Найдено по запросу <b>{html.escape(query)}</b>:\n\n" + "\n".join(lines)
+        else:
+            text = f"По запросу <b>{html.escape(query)}</b> ничего не найдено."
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+    await update.message.reply_text(f"Выбран список: *{list_name.capitalize()}*", reply_markup=ReplyKeyboardMarkup(lists_action_keyboard, resize_keyboard=True), parse_mode=ParseMode.MARKDOWN)
     return SHOW_LIST
 
 @private_access
@@ -746,7 +894,8 @@ async def ask_for_domains_to_add(update: Update, context: ContextTypes.DEFAULT_T
     user_id = update.effective_user.id
     list_name = context.user_data.get('current_list')
     log.debug(f"Запрошено добавление в список '{list_name}'", extra={'user_id': user_id})
-    await update.message.reply_text("Отправьте один или несколько доменов для добавления. Каждый домен с новой строки.", reply_markup=ReplyKeyboardMarkup(cancel_keyboard, resize_keyboard=True))
+    await update.message.reply_text("Отправьте один или несколько доменов для добавления. Каждый домен с новой строки.\n"
+                                    "Большой список можно прислать файлом .txt или .gz.", reply_markup=ReplyKeyboardMarkup(cancel_keyboard, resize_keyboard=True))
     return ADD_TO_LIST
 
 @private_access
@@ -756,16 +905,19 @@ async def add_domains_to_list(update: Update, context: ContextTypes.DEFAULT_TYPE
     """
     user_id = update.effective_user.id
     target_list = context.user_data.get('current_list')
-    domains_to_process = [d.strip() for d in update.message.text.splitlines() if d.strip()]
+    # URL, регистр, IDN, порты и маски *. приводятся к единому виду
+    normalized = normalize_entries(update.message.text.splitlines())
+    domains_to_process = normalized.entries
     
     log.debug(f"Попытка добавить {len(domains_to_process)} домен(ов) в список '{target_list}'", extra={'user_id': user_id})
 
     domains_to_add = []
     domains_to_move = {} # { 'source_list': ['domain1', 'domain2'] }
     domains_skipped = []
+    domains_covered = []
 
-    for domain in domains_to_process:
-        source_list = list_manager.find_domain(domain)
+    new_domains = []
+    for domain, source_list in list_manager.find_domains(domains_to_process).items():
         if source_list:
             if source_list == target_list:
                 domains_skipped.append(domain)
@@ -773,6 +925,16 @@ async def add_domains_to_list(update: Update, context: ContextTypes.DEFAULT_TYPE
                 if source_list not in domains_to_move:
                     domains_to_move[source_list] = []
                 domains_to_move[source_list].append(domain)
+        else:
+            new_domains.append(domain)
+
+    # Поддомен не нужен, если родительский домен уже есть в целевом списке
+    # и dnsmasq направляет поддомены родителя в ipset этого списка
+    coverings = list_manager.find_coverings(new_domains) if DnsmasqManager().covers_subdomains(target_list) else {}
+    for domain in new_domains:
+        covering = coverings.get(domain)
+        if covering and covering[1] == target_list:
+            domains_covered.append(domain)
         else:
             domains_to_add.append(domain)
 
@@ -793,6 +955,8 @@ async def add_domains_to_list(update: Update, context: ContextTypes.DEFAULT_TYPE
             "\n".join(move_report),
             f"\nХотите переместить их в список *{target_list.capitalize()}*?"
         ]
+        if normalized.rejected:
+            text_parts.append(f"\n🚫 Отклонено (некорректные записи): {len(normalized.rejected)} шт.")
         text = "\n".join(text_parts)
 
         keyboard = [[
@@ -810,8 +974,8 @@ async def add_domains_to_list(update: Update, context: ContextTypes.DEFAULT_TYPE
     changes_made = False
     
     if domains_to_add:
-        added = await list_manager.add_to_list(target_list, domains_to_add)
-        if added:
+        diff = await list_manager.transaction().add(target_list, domains_to_add).commit()
+        if diff:
             final_report.append(f"✅ Добавлено: {len(domains_to_add)} шт.")
             changes_made = True
         else:
@@ -821,6 +985,14 @@ async def add_domains_to_list(update: Update, context: ContextTypes.DEFAULT_TYPE
     if domains_skipped:
         final_report.append(f"🤷 Пропущено (уже в списке): {len(domains_skipped)} шт.")
 
+    if domains_covered:
+        final_report.append(f"🌳 Пропущено (покрыты родительским доменом): {len(domains_covered)} шт.")
+
+    if normalized.rejected:
+        examples = ", ".join(normalized.rejected[:5])
+        final_report.append(f"🚫 Отклонено (некорректные записи): {len(normalized.rejected)} шт.: {examples}"
+                            + (" ..." if len(normalized.rejected) > 5 else ""))
+
     if not final_report:
         await update.message.reply_text("Вы не отправили ни одного домена.", reply_markup=ReplyKeyboardMarkup(lists_action_keyboard, resize_keyboard=True))
         return SHOW_LIST
@@ -828,9 +1000,90 @@ async def add_domains_to_list(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text("\n".join(final_report))
     
     if changes_made:
-        await update.message.reply_text("Применяю изменения...")
-        _success, message = await list_manager.apply_changes()
-        await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_text("Изменения будут применены через несколько секунд...")
+        schedule_apply_report(context, update.effective_chat.id, diff)
+
+    await update.message.reply_text(f"Выбран список: *{target_list.capitalize()}*", reply_markup=ReplyKeyboardMarkup(lists_action_keyboard, resize_keyboard=True), parse_mode=ParseMode.MARKDOWN)
+    return SHOW_LIST
+
+def _open_import_file(path: str):
+    """Открывает загруженный файл как текст, распаковывая gzip по сигнатуре."""
+    with open(path, 'rb') as f:
+        is_gzip = f.read(2) == b"\x1f\x8b"
+    if is_gzip:
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+@private_access
+async def add_domains_from_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Импортирует домены из присланного файла .txt или .gz.
+    Файл читается порциями, а ход импорта отображается в одном
+    редактируемом сообщении.
+    """
+    user_id = update.effective_user.id
+    target_list = context.user_data.get('current_list')
+    document = update.message.document
+    file_name = document.file_name or ""
+    if not file_name.lower().endswith((".txt", ".gz")):
+        await update.message.reply_text("Поддерживаются файлы .txt и .gz. Отправьте другой файл или нажмите 'Отмена'.")
+        return ADD_TO_LIST
+
+    log.info(f"Импорт файла '{file_name}' в список '{target_list}'", extra={'user_id': user_id})
+    status = await update.message.reply_text(f"⏳ Загружаю файл {file_name}...")
+    last_edit = time.monotonic()
+
+    async def show_progress(result) -> None:
+        nonlocal last_edit
+        if time.monotonic() - last_edit < IMPORT_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        try:
+            await status.edit_text(f"⏳ Импорт в {target_list.capitalize()}: обработано строк {result.lines}, добавлено {result.added}")
+        except BadRequest:
+            pass
+
+    # У каждой загрузки свой файл: несколько импортов могут идти одновременно
+    fd, tmp_path = tempfile.mkstemp(prefix=IMPORT_TMP_PREFIX)
+    os.close(fd)
+    try:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(tmp_path)
+        with _open_import_file(tmp_path) as f:
+            result = await list_manager.import_entries(
+                target_list, f, show_progress, skip_covered=DnsmasqManager().covers_subdomains(target_list)
+            )
+    except Exception as e:
+        log.error(f"Ошибка импорта файла '{file_name}': {e}", extra={'user_id': user_id})
+        await status.edit_text(f"❌ Не удалось импортировать файл: {e}")
+        return ADD_TO_LIST
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    report = [
+        f"Импорт {file_name} завершен, строк: {result.lines}.",
+        f"✅ Добавлено: {result.added} шт.",
+    ]
+    if result.existing:
+        report.append(f"🤷 Пропущено (уже в списке): {result.existing} шт.")
+    if result.foreign:
+        report.append(f"↔️ Пропущено (есть в других списках): {result.foreign} шт.")
+    if result.covered:
+        report.append(f"🌳 Пропущено (покрыты родительским доменом): {result.covered} шт.")
+    if result.rejected:
+        report.append(f"🚫 Отклонено (некорректные записи): {result.rejected} шт.")
+
+    if result.added:
+        await status.edit_text("\n".join(report + ["Применяю изменения..."]))
+        _success, message = await list_manager.schedule_apply(result.diff)
+        report.append(message)
+        try:
+            await status.edit_text("\n".join(report), parse_mode=ParseMode.MARKDOWN)
+        except BadRequest:
+            await status.edit_text("\n".join(report))
+    else:
+        await status.edit_text("\n".join(report))
 
     await update.message.reply_text(f"Выбран список: *{target_list.capitalize()}*", reply_markup=ReplyKeyboardMarkup(lists_action_keyboard, resize_keyboard=True), parse_mode=ParseMode.MARKDOWN)
     return SHOW_LIST
@@ -851,19 +1104,25 @@ async def handle_move_domain_confirmation(update: Update, context: ContextTypes.
     domains_to_move = move_data.get('domains_to_move')
     domains_to_add_after_move = context.user_data.get('domains_to_add_after_move', [])
 
-    changes_made = False
     report = []
+    # Все перемещения и добавления фиксируются одной транзакцией:
+    # по одной записи на каждый затронутый список
+    transaction = list_manager.transaction()
+    moved_domains = set()
 
     if action == 'move_domain_confirm':
         log.debug(f"Пользователь {user_id} подтвердил перемещение доменов.", extra={'user_id': user_id})
-        moved_count = 0
         if domains_to_move and target_list:
+            # Владельцы могли измениться с момента запроса, проверяем их одним проходом
+            owners = list_manager.find_domains(d for dmns in domains_to_move.values() for d in dmns)
             for source_list, domains in domains_to_move.items():
                 for domain in domains:
-                    await list_manager.move_domain(domain, source_list, target_list)
-                    moved_count += len(domains)
-            report.append(f"🔄 Перемещено: {moved_count} шт.")
-            changes_made = True
+                    current_list = owners.get(domain) or source_list
+                    if current_list == target_list:
+                        continue
+                    transaction.move(domain, current_list, target_list)
+                    moved_domains.add(domain)
+            report.append(f"🔄 Перемещено: {len(moved_domains)} шт.")
     else:
         log.debug(f"Пользователь {user_id} отменил перемещение доменов.", extra={'user_id': user_id})
         skipped_count = sum(len(d) for d in domains_to_move.values())
@@ -871,17 +1130,18 @@ async def handle_move_domain_confirmation(update: Update, context: ContextTypes.
 
     # Добавляем домены, которые не требовали перемещения
     if domains_to_add_after_move:
-        added = await list_manager.add_to_list(target_list, domains_to_add_after_move)
-        if added:
-            report.append(f"✅ Добавлено новых: {len(domains_to_add_after_move)} шт.")
-            changes_made = True
+        transaction.add(target_list, domains_to_add_after_move)
+
+    diff = await transaction.commit()
+    added_count = len(diff.added.get(target_list, set()) - moved_domains)
+    if added_count > 0:
+        report.append(f"✅ Добавлено новых: {added_count} шт.")
 
     await query.edit_message_text("\n".join(report))
 
-    if changes_made:
-        await context.bot.send_message(chat_id=query.message.chat_id, text="Применяю изменения...")
-        _success, message = await list_manager.apply_changes()
-        await context.bot.send_message(chat_id=query.message.chat_id, text=message, parse_mode=ParseMode.MARKDOWN)
+    if diff:
+        await context.bot.send_message(chat_id=query.message.chat_id, text="Изменения будут применены через несколько секунд...")
+        schedule_apply_report(context, query.message.chat_id, diff)
 
     # Очистка user_data
     context.user_data.pop('domains_to_move_data', None)
@@ -891,6 +1151,33 @@ async def handle_move_domain_confirmation(update: Update, context: ContextTypes.
     return SHOW_LIST
 
 
+@private_access
+async def collapse_list_content(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Удаляет из выбранного списка поддомены, покрытые родительскими доменами.
+    """
+    user_id = update.effective_user.id
+    list_name = context.user_data.get('current_list')
+    log.debug(f"Запрошено сжатие списка '{list_name}'", extra={'user_id': user_id})
+
+    # Родитель покрывает поддомены только через правила dnsmasq ipset=;
+    # без них удаление поддомена отключило бы его маршрутизацию
+    if not DnsmasqManager().covers_subdomains(list_name):
+        await update.message.reply_text("⚠️ Сжатие недоступно: правила dnsmasq для этого списка не применены, "
+                                        "поэтому родительский домен не покрывает поддомены. Примените режим 'По спискам'.")
+        return SHOW_LIST
+
+    removed = await list_manager.collapse_list(list_name)
+    if removed:
+        await update.message.reply_text(f"🧹 Удалено избыточных поддоменов: {len(removed)} шт. Изменения будут применены через несколько секунд...")
+        diff = ListDiff()
+        diff.removed[list_name] = set(removed)
+        schedule_apply_report(context, update.effective_chat.id, diff)
+    else:
+        await update.message.reply_text("ℹ️ В списке нет поддоменов, покрытых родительскими доменами.")
+    return SHOW_LIST
+
+
 @private_access
 async def ask_for_domains_to_remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
@@ -911,11 +1198,10 @@ async def remove_domains_from_list(update: Update, context: ContextTypes.DEFAULT
     list_name = context.user_data.get('current_list')
     domains = update.message.text.splitlines()
     log.debug(f"Попытка удалить {len(domains)} домен(ов) из списка '{list_name}'", extra={'user_id': user_id})
-    removed = await list_manager.remove_from_list(list_name, domains)
-    if removed:
-        await update.message.reply_text("✅ Домены удалены. Применяю изменения...")
-        _success, message = await list_manager.apply_changes()
-        await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+    diff = await list_manager.transaction().remove(list_name, domains).commit()
+    if diff:
+        await update.message.reply_text("✅ Домены удалены. Изменения будут применены через несколько секунд...")
+        schedule_apply_report(context, update.effective_chat.id, diff)
     else:
         await update.message.reply_text("ℹ️ Этих доменов не было в списке.")
     await update.message.reply_text(f"Выбран список: *{list_name.capitalize()}*", reply_markup=ReplyKeyboardMarkup(lists_action_keyboard, resize_keyboard=True), parse_mode=ParseMode.MARKDOWN)
@@ -964,8 +1250,7 @@ async def menu_firewall(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     current_state = "unknown"
     try:
         if os.path.exists(FIREWALL_STATE_FILE):
-            with open(FIREWALL_STATE_FILE, "r") as f:
-                current_state = f.read().strip()
+            current_state = read_state().mode
     except Exception as e:
         log.warning(f"Не удалось прочитать файл состояния Firewall: {e}")
 
@@ -1019,18 +1304,18 @@ async def handle_firewall_action(update: Update, context: ContextTypes.DEFAULT_T
     log.debug(f"Запрошено действие с Firewall: {action}", extra={'user_id': user_id})
 
     command = ""
-    new_state = ""
+    new_state = None
     
     if action == "apply_lists":
         script_path = os.path.join(script_dir, "scripts", "kdw_apply_proxy_lists.sh")
         command = f"sh {script_path}"
-        new_state = "lists_only"
+        new_state = FirewallState.compile("lists_only")
         await query.message.edit_text("⏳ Применяю режим 'По спискам'...", reply_markup=None)
 
     elif action == "flush":
         script_path = os.path.join(script_dir, "scripts", "kdw_flush_proxy_rules.sh")
         command = f"sh {script_path}"
-        new_state = "flushed"
+        new_state = FirewallState.compile("flushed")
         await query.message.edit_text("⏳ Применяю режим 'Напрямую'...", reply_markup=None)
 
     elif action == "apply_all":
@@ -1045,23 +1330,22 @@ async def handle_firewall_action(update: Update, context: ContextTypes.DEFAULT_T
             )
             return FIREWALL_MENU
             
-        port = PROXY_PORTS.get(default_proxy)
+        port = get_registry().port(default_proxy)
         if not port:
-            await query.message.edit_text(f"❌ Ошибка: не определен порт для прокси типа '{default_proxy}'.", reply_markup=None)
+            await query.message.edit_text(f"❌ Ошибка: не определен порт для прокси типа '{default_proxy}' (секция [lists] в kdw.cfg).", reply_markup=None)
             return FIREWALL_MENU
 
         script_path = os.path.join(script_dir, "scripts", "kdw_apply_all_traffic_proxy.sh")
         command = f"sh {script_path} {default_proxy} {port}"
-        new_state = "all_traffic"
+        new_state = FirewallState.compile("all_traffic", default_proxy, port)
         await query.message.edit_text(f"⏳ Применяю режим 'Весь трафик' через {default_proxy}...", reply_markup=None)
 
     else:
         return FIREWALL_MENU
 
-    # Записываем новое состояние для сохранения после перезагрузки
+    # Записываем новое состояние (режим, прокси, порт и правила) для восстановления после перезагрузки
     try:
-        with open(FIREWALL_STATE_FILE, "w") as f:
-            f.write(new_state)
+        write_state(new_state)
     except Exception as e:
         log.error(f"Критическая ошибка: не удалось записать состояние Firewall в файл {FIREWALL_STATE_FILE}: {e}")
         await query.message.edit_text(f"❌ Критическая ошибка: не удалось сохранить состояние Firewall.", reply_markup=None)
@@ -1355,7 +1639,7 @@ async def menu_default_proxy_type(update: Update, context: ContextTypes.DEFAULT_
     current_default = config.get('firewall', 'default_proxy_type', fallback='trojan')
     
     keyboard = []
-    for proxy_type in PROXY_PORTS.keys():
+    for proxy_type in PROXY_TYPES:
         button_text = f"• {proxy_type.capitalize()} •" if proxy_type == current_default else proxy_type.capitalize()
         keyboard.append([InlineKeyboardButton(button_text, callback_data=f"set_default_proxy_{proxy_type}")])
     
@@ -1546,6 +1830,21 @@ def main() -> None:
 
     # Запускаем периодическую проверку обновлений (раз в 24 часа)
     application.job_queue.run_repeating(check_for_updates, interval=86400, first=10)
+    # Обновляем списки из подписок, если они настроены
+    if config.has_section('subscriptions') and config.items('subscriptions'):
+        application.job_queue.run_repeating(
+            refresh_subscriptions,
+            interval=config.getint('kdw.settings', 'subscription_interval', fallback=3600),
+            first=120
+        )
+    # Если домены разрешаются при применении, периодически продлеваем IP с истекшим TTL.
+    # Иначе адреса в ipset добавляет dnsmasq и продлевать нечего
+    if config.getboolean('kdw.settings', 'resolve_on_apply', fallback=False):
+        application.job_queue.run_repeating(
+            refresh_resolved_ips,
+            interval=config.getint('kdw.settings', 'dns_refresh_interval', fallback=300),
+            first=60
+        )
 
     # Основной обработчик диалогов, управляющий навигацией по меню
     conv_handler = ConversationHandler(
@@ -1615,12 +1914,19 @@ def main() -> None:
                 MessageHandler(filters.Regex('^👁️ Показать$'), show_list_content),
                 MessageHandler(filters.Regex('^➕ Добавить$'), ask_for_domains_to_add),
                 MessageHandler(filters.Regex('^➖ Удалить$'), ask_for_domains_to_remove),
+                MessageHandler(filters.Regex('^🧹 Сжать$'), collapse_list_content),
+                MessageHandler(filters.Regex('^Поиск домена$'), ask_for_search_query),
                 MessageHandler(filters.Regex('^🔙 Назад$'), menu_lists),
             ],
+            # Ожидание строки для поиска по спискам
+            SEARCH_DOMAIN: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, search_domain),
+            ],
             # Ожидание доменов для добавления
             ADD_TO_LIST: [
                 MessageHandler(filters.Regex('^Отмена$'), select_list_action),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, add_domains_to_list),
+                MessageHandler(filters.Document.ALL, add_domains_from_document),
             ],
             # Ожидание доменов для удаления
             REMOVE_FROM_LIST: [
@@ -1644,6 +1950,7 @@ def main() -> None:
     
     # Добавляем обработчики колбэков отдельно от ConversationHandler, чтобы избежать конфликтов состояний
     application.add_handler(CallbackQueryHandler(handle_key_action, pattern='^key_'))
+    application.add_handler(CallbackQueryHandler(handle_list_page, pattern='^list(page|export):'))
     application.add_handler(CallbackQueryHandler(handle_confirmation, pattern='^confirm_'))
     application.add_handler(CallbackQueryHandler(handle_update_confirmation, pattern='^update_'))
     application.add_handler(CallbackQueryHandler(handle_log_level_selection, pattern='^log_'))
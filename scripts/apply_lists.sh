@@ -0,0 +1,35 @@
+#!/bin/sh
+
+# =================================================================
+# KDW Lists Applier
+#
+# Описание:
+#   Синхронизирует ipset-списки KDW с файлами списков и
+#   генерирует для dnsmasq правила ipset= из доменов списков.
+#   В ядро отправляется только разница с последним примененным
+#   состоянием, поэтому существующие записи не пропадают.
+#   Без аргументов обрабатываются все списки, иначе - только
+#   переданные (например: apply_lists.sh trojan vmess).
+#   Флаг --full пересобирает ipset через теневой список и
+#   атомарный ipset swap.
+#   Флаг --refresh (при resolve_on_apply = True) повторно разрешает
+#   только домены с истекшим TTL и продлевает их записи.
+#   Совместим с BusyBox ash.
+# =================================================================
+
+# --- Переменные ---
+SCRIPT_DIR=$(dirname "$0")
+KDW_DIR=$(cd "${SCRIPT_DIR}/.." && pwd)
+PYTHON="${KDW_DIR}/venv/bin/python"
+
+# --- Основной код ---
+if ! command -v "ipset" >/dev/null 2>&1; then
+    echo "ОШИБКА: Утилита 'ipset' не найдена. Установите ее (opkg install ipset)."
+    exit 1
+fi
+
+if [ ! -x "$PYTHON" ]; then
+    PYTHON="python3"
+fi
+
+cd "$KDW_DIR" && exec "$PYTHON" -m core.ipset_manager "$@"
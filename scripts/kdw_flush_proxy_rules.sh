@@ -6,61 +6,34 @@
 # Описание:
 #   Полностью удаляет все правила iptables и ipset,
 #   созданные KDW.
+#   С флагом --keep-ipsets ipset-списки не удаляются: так
+#   повторное применение режима "По спискам" не оставляет
+#   проксируемые адреса без записей.
+#   Таблица nat читается один раз (iptables-save), все правила
+#   KDW удаляются одной транзакцией iptables-restore, а ipset -
+#   одним пакетом ipset restore.
 #   Совместим с BusyBox ash.
 # =================================================================
 
+# --- Переменные ---
+SCRIPT_DIR=$(dirname "$0")
+KDW_DIR=$(cd "${SCRIPT_DIR}/.." && pwd)
+PYTHON="${KDW_DIR}/venv/bin/python"
+[ -x "$PYTHON" ] || PYTHON="python3"
+
 # --- Функции ---
 log() {
     echo "$1"
 }
 
-check_utils() {
-    for util in iptables ipset; do
-        if ! command -v "$util" >/dev/null 2>&1; then
-            log "ИНФО: Утилита '$util' не найдена. Пропускаю очистку для нее."
-            # Не выходим с ошибкой, так как при удалении это нормально
-        fi
-    done
-}
-
 # --- Основной код ---
-check_utils
+KEEP_IPSETS=""
+[ "$1" = "--keep-ipsets" ] && KEEP_IPSETS="--keep-ipsets"
 
 log "--- Очистка правил Firewall KDW ---"
-
-# --- Шаг 1: Удаление правил из PREROUTING ---
-if command -v "iptables" >/dev/null 2>&1; then
-    log "1. Удаляю ссылки на KDW_PROXY из цепочки PREROUTING..."
-    # Получаем список номеров правил, которые ссылаются на KDW_PROXY
-    while true; do
-        RULE_NUM=$(iptables -t nat -L PREROUTING --line-numbers | grep 'KDW_PROXY' | awk '{print $1}' | head -n 1)
-        if [ -z "$RULE_NUM" ]; then
-            break
-        fi
-        log " - Удаляю правило номер $RULE_NUM..."
-        iptables -t nat -D PREROUTING "$RULE_NUM"
-    done
-fi
-
-# --- Шаг 2: Очистка и удаление цепочки KDW_PROXY ---
-if command -v "iptables" >/dev/null 2>&1; then
-    if iptables -t nat -L KDW_PROXY >/dev/null 2>&1; then
-        log "2. Очищаю и удаляю цепочку KDW_PROXY..."
-        iptables -t nat -F KDW_PROXY
-        iptables -t nat -X KDW_PROXY
-    else
-        log "2. Цепочка KDW_PROXY не найдена, пропускаю."
-    fi
-fi
-
-# --- Шаг 3: Удаление ipset-списков ---
-if command -v "ipset" >/dev/null 2>&1; then
-    log "3. Удаляю все ipset-списки KDW..."
-    # Находим все списки, начинающиеся с "kdw_"
-    ipset list -n | grep '^kdw_' | while read -r set_name; do
-        log " - Удаляю ipset '$set_name'..."
-        ipset destroy "$set_name"
-    done
+if ! (cd "$KDW_DIR" && "$PYTHON" -m core.firewall flushed $KEEP_IPSETS); then
+    log "ОШИБКА: очистка правил KDW завершилась с ошибкой."
+    exit 1
 fi
 
 log ""
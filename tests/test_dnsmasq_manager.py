@@ -0,0 +1,54 @@
+import pytest
+from unittest.mock import AsyncMock, patch
+from core.dnsmasq_manager import DnsmasqManager, compile_ipset_lines, MAX_LINE_LENGTH
+
+@pytest.fixture
+def dnsmasq_manager(tmp_path):
+    """Фикстура для создания DnsmasqManager с временной директорией правил."""
+    return DnsmasqManager(ipsets_dir=str(tmp_path / "ipsets"))
+
+def test_compile_groups_domains_per_line():
+    """Тест: домены группируются в директивы ipset= не длиннее лимита."""
+    domains = [f"domain{i:04d}.example.com" for i in range(200)]
+    lines = compile_ipset_lines(domains, "kdw_trojan_list")
+
+    assert 1 < len(lines) < len(domains)
+    assert all(len(line) <= MAX_LINE_LENGTH for line in lines)
+    assert all(line.startswith("ipset=/") and line.endswith("/kdw_trojan_list") for line in lines)
+    compiled = [domain for line in lines for domain in line[len("ipset=/"):-len("/kdw_trojan_list")].split("/")]
+    assert compiled == sorted(domains)
+
+def test_compile_empty_list():
+    """Тест: для пустого списка директив нет."""
+    assert compile_ipset_lines([], "kdw_trojan_list") == []
+
+@pytest.mark.asyncio
+async def test_sync_reloads_only_on_change(dnsmasq_manager):
+    """Тест: dnsmasq перезапускается только при изменении правил."""
+    mock_reload = AsyncMock(return_value=(True, ""))
+
+    with patch.object(dnsmasq_manager, 'reload', mock_reload):
+        success, _report = await dnsmasq_manager.sync({"trojan": ["b.com", "a.com"]})
+        assert success is True
+        with open(dnsmasq_manager.conf_path("trojan"), encoding="utf-8") as f:
+            assert f.read() == "ipset=/a.com/b.com/kdw_trojan_list_dns\n"
+
+        _success, report = await dnsmasq_manager.sync({"trojan": ["a.com", "b.com"]})
+
+    assert mock_reload.await_count == 1
+    assert "не изменились" in report
+
+@pytest.mark.asyncio
+async def test_covers_subdomains_requires_dnsmasq_rules(dnsmasq_manager, tmp_path):
+    """Тест: поддомены покрыты, только если dnsmasq установлен и правила списка записаны."""
+    init_script = tmp_path / "S56dnsmasq"
+    init_script.write_text("")
+
+    with patch('core.dnsmasq_manager.DNSMASQ_INIT_PATTERN', str(tmp_path / "S*dnsmasq*")):
+        assert dnsmasq_manager.covers_subdomains("trojan") is False
+        with patch.object(dnsmasq_manager, 'reload', AsyncMock(return_value=(True, ""))):
+            await dnsmasq_manager.sync({"trojan": ["a.com"]})
+        assert dnsmasq_manager.covers_subdomains("trojan") is True
+
+    with patch('core.dnsmasq_manager.DNSMASQ_INIT_PATTERN', str(tmp_path / "missing*")):
+        assert dnsmasq_manager.covers_subdomains("trojan") is False
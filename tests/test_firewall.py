@@ -0,0 +1,326 @@
+import pytest
+from unittest.mock import AsyncMock, patch
+from core.firewall import FirewallManager, compile_restore, compile_lists_rules, MODE_LISTS, MODE_ALL, EXCLUDE_NETS
+from core.list_registry import ListRegistry, ListSpec
+
+
+@pytest.fixture
+def registry():
+    return ListRegistry([ListSpec("trojan", 10829), ListSpec("vmess", 10810), ListSpec("direct", None)])
+
+def make_shell_mock(existing_sets=(), hooked=False, restore_ok=True):
+    """Мок run_shell_command: сохраняет содержимое транзакций iptables-restore."""
+    transactions = []
+
+    async def side_effect(command):
+        if command == "ipset -n list":
+            return True, "\n".join(existing_sets)
+        if command == "iptables -t nat -S PREROUTING":
+            return True, "-P PREROUTING ACCEPT" + ("\n-A PREROUTING -j KDW_PROXY" if hooked else "")
+        if command.startswith("iptables-restore --noflush < "):
+            with open(command.split("< ")[1], encoding="utf-8") as f:
+                transactions.append(f.read().splitlines())
+            return (True, "") if restore_ok else (False, "iptables-restore: line 4 failed")
+        return True, ""
+
+    return AsyncMock(side_effect=side_effect), transactions
+
+def test_lists_rules_put_direct_first(registry):
+    """Тест: RETURN для direct идет раньше перенаправлений, отсутствующие ipset пропускаются."""
+    rules = compile_lists_rules(registry, {"kdw_trojan_list", "kdw_direct_list"})
+    assert rules == [
+        "-A KDW_PROXY -m set --match-set kdw_direct_list dst -j RETURN",
+        "-A KDW_PROXY -p tcp -m set --match-set kdw_trojan_list dst -j REDIRECT --to-ports 10829",
+    ]
+
+def test_restore_adds_hook_only_when_missing():
+    """Тест: переход из PREROUTING добавляется только если его еще нет."""
+    assert compile_restore(["-A KDW_PROXY -j RETURN"], hooked=False).splitlines() == [
+        "*nat", ":KDW_PROXY - [0:0]", "-I PREROUTING 1 -j KDW_PROXY", "-A KDW_PROXY -j RETURN", "COMMIT",
+    ]
+    assert "-I PREROUTING" not in compile_restore([], hooked=True)
+
+@pytest.mark.asyncio
+async def test_apply_lists_in_one_transaction(registry):
+    """Тест: режим 'по спискам' применяется одним вызовом iptables-restore."""
+    mock_run, transactions = make_shell_mock(["kdw_trojan_list", "kdw_vmess_list"], hooked=True)
+
+    with patch('core.firewall.run_shell_command', mock_run):
+        success, report = await FirewallManager(registry).apply(MODE_LISTS)
+
+    assert success is True
+    assert len(transactions) == 1
+    assert transactions[0][:2] == ["*nat", ":KDW_PROXY - [0:0]"]
+    assert sum(line.startswith("-A KDW_PROXY") for line in transactions[0]) == 2
+    assert "2 правил" in report and "Нет ipset для списков: direct" in report
+
+@pytest.mark.asyncio
+async def test_apply_all_traffic(registry):
+    """Тест: режим 'весь трафик' исключает локальные сети и перенаправляет остальное."""
+    mock_run, transactions = make_shell_mock()
+
+    with patch('core.firewall.run_shell_command', mock_run):
+        success, _report = await FirewallManager(registry).apply(MODE_ALL, 10829)
+
+    assert success is True
+    rules = transactions[0]
+    assert "-I PREROUTING 1 -j KDW_PROXY" in rules
+    assert rules[-2:] == ["-A KDW_PROXY -p tcp -j REDIRECT --to-ports 10829", "COMMIT"]
+    assert sum(" -j RETURN" in line for line in rules) == len(EXCLUDE_NETS)
+
+@pytest.mark.asyncio
+async def test_failed_restore_reports_unchanged(registry):
+    """Тест: ошибка iptables-restore не оставляет частичных правил и попадает в отчет."""
+    mock_run, _transactions = make_shell_mock(restore_ok=False)
+
+    with patch('core.firewall.run_shell_command', mock_run):
+        success, report = await FirewallManager(registry).apply(MODE_ALL, 10829)
+
+    assert success is False
+    assert "правила не изменены" in report
+
+NAT_DUMP = """# Generated by iptables-save
+*nat
+:PREROUTING ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+:KDW_PROXY - [0:0]
+:_NDM_HOTSPOT_PRERT - [0:0]
+-A PREROUTING -j KDW_PROXY
+-A PREROUTING -j _NDM_HOTSPOT_PRERT
+-A PREROUTING -j KDW_PROXY
+-A PREROUTING -p tcp -m set --match-set kdw_trojan_list dst -j REDIRECT --to-ports 10829
+-A KDW_PROXY -p tcp -m set --match-set kdw_trojan_list dst -j REDIRECT --to-ports 10829
+-A POSTROUTING -o eth3 -j MASQUERADE
+COMMIT
+"""
+
+def test_flush_removes_every_kdw_rule_in_one_transaction():
+    """Тест: все переходы и правила с ipset KDW удаляются одной транзакцией, чужие правила не трогаются."""
+    from core.firewall import compile_flush
+    assert compile_flush(NAT_DUMP).splitlines() == [
+        "*nat",
+        ":KDW_PROXY - [0:0]",
+        "-D PREROUTING -j KDW_PROXY",
+        "-D PREROUTING -j KDW_PROXY",
+        "-D PREROUTING -p tcp -m set --match-set kdw_trojan_list dst -j REDIRECT --to-ports 10829",
+        "-X KDW_PROXY",
+        "COMMIT",
+    ]
+    assert compile_flush("*nat\n:PREROUTING ACCEPT [0:0]\nCOMMIT\n") is None
+
+@pytest.mark.asyncio
+async def test_flush_batches_ipsets(registry):
+    """Тест: ipset KDW очищаются и удаляются одним пакетом, с --keep-ipsets не трогаются."""
+    batches = []
+
+    async def side_effect(command):
+        if command == "iptables-save -t nat":
+            return True, NAT_DUMP
+        if command == "ipset -n list":
+            return True, "kdw_trojan_list\nkdw_trojan_list_0\nother_set"
+        if "< " in command:
+            with open(command.split("< ")[1], encoding="utf-8") as f:
+                batches.append((command.split(" <")[0], f.read().splitlines()))
+        return True, ""
+
+    with patch('core.firewall.run_shell_command', AsyncMock(side_effect=side_effect)):
+        success, _report = await FirewallManager(registry).flush()
+        assert success is True
+        assert [command for command, _ in batches] == ["iptables-restore --noflush", "ipset restore"]
+        assert batches[1][1] == ["flush kdw_trojan_list", "flush kdw_trojan_list_0",
+                                 "destroy kdw_trojan_list", "destroy kdw_trojan_list_0"]
+
+        batches.clear()
+        await FirewallManager(registry).flush(keep_ipsets=True)
+        assert [command for command, _ in batches] == ["iptables-restore --noflush"]
+
+@pytest.fixture
+def reconciler(tmp_path, registry):
+    """Реконсилер с временными файлами состояния, отпечатка и списков."""
+    from core.firewall import FirewallReconciler
+    state_file = tmp_path / "firewall_mode.state"
+    state_file.write_text("lists_only")
+    # ipset list -t по умолчанию недоступен: ipset старого формата нет
+    with patch('core.list_manager.LISTS_DIR', str(tmp_path)), \
+            patch('core.ipset_manager.run_shell_command', AsyncMock(return_value=(False, ""))), \
+            patch('core.ipset_manager.IPSET_STATE_FILE', str(tmp_path / "ipset.state.json")), \
+            patch('core.ipset_manager.SNAPSHOT_FILE', str(tmp_path / "ipset.snapshot")), \
+            patch('core.ipset_manager.SNAPSHOT_META_FILE', str(tmp_path / "ipset.snapshot.json")):
+        yield FirewallReconciler(FirewallManager(registry), str(state_file), str(tmp_path / "fingerprint"))
+
+def make_kernel_mock():
+    """Мок ядра: хранит правила KDW и ipset, считает вызовы команд."""
+    kernel = {"rules": [], "sets": []}
+    calls = []
+
+    async def side_effect(command):
+        calls.append(command.split(" <")[0])
+        if command == "iptables-save -t nat":
+            return True, "*nat\n:PREROUTING ACCEPT [0:0]\n" + "".join(f"{rule}\n" for rule in kernel["rules"]) + "COMMIT"
+        if command == "ipset -n list":
+            return True, "\n".join(kernel["sets"])
+        if command == "iptables -t nat -S PREROUTING":
+            return True, "-P PREROUTING ACCEPT"
+        if (command.startswith("sh ") and "apply_lists" in command) or command.startswith("ipset -exist restore"):
+            kernel["sets"] = ["kdw_trojan_list", "kdw_vmess_list", "kdw_direct_list"]
+        if command.startswith("iptables-restore"):
+            with open(command.split("< ")[1], encoding="utf-8") as f:
+                kernel["rules"] = [line for line in f.read().splitlines() if line.startswith(("-A", ":KDW"))]
+        return True, ""
+
+    return AsyncMock(side_effect=side_effect), kernel, calls
+
+@pytest.mark.asyncio
+async def test_reconcile_is_noop_when_state_matches(reconciler):
+    """Тест: повторное согласование без изменений не трогает ни ipset, ни iptables."""
+    mock_run, _kernel, calls = make_kernel_mock()
+
+    with patch('core.firewall.run_shell_command', mock_run):
+        success, _report = await reconciler.reconcile()
+        assert success is True
+        assert any(call.startswith("sh ") for call in calls) and "iptables-restore --noflush" in calls
+
+        calls.clear()
+        success, report = await reconciler.reconcile()
+
+    assert success is True
+    assert "актуально" in report
+    assert calls == ["iptables-save -t nat", "ipset -n list"]
+
+@pytest.mark.asyncio
+async def test_reconcile_restores_only_rules_when_chain_lost(reconciler):
+    """Тест: если пропали только правила, ipset не пересинхронизируются."""
+    mock_run, kernel, calls = make_kernel_mock()
+
+    with patch('core.firewall.run_shell_command', mock_run):
+        await reconciler.reconcile()
+        kernel["rules"] = []
+        calls.clear()
+        success, _report = await reconciler.reconcile()
+
+    assert success is True
+    assert "iptables-restore --noflush" in calls
+    assert not any(call.startswith("sh ") for call in calls)
+
+@pytest.mark.asyncio
+async def test_reconcile_syncs_ipsets_when_lists_change(reconciler, tmp_path):
+    """Тест: изменение файла списка запускает синхронизацию ipset."""
+    mock_run, _kernel, calls = make_kernel_mock()
+
+    with patch('core.firewall.run_shell_command', mock_run):
+        await reconciler.reconcile()
+        (tmp_path / "trojan.list").write_text("example.com\n")
+        calls.clear()
+        await reconciler.reconcile()
+
+    assert any(call.startswith("sh ") for call in calls)
+
+@pytest.mark.asyncio
+async def test_reconcile_restores_snapshot_and_refreshes_in_background(reconciler, tmp_path):
+    """Тест: при загрузке ipset восстанавливаются из снимка, а списки применяются в фоне."""
+    (tmp_path / "ipset.snapshot").write_text("create kdw_trojan_list list:set size 32\n")
+    (tmp_path / "ipset.snapshot.json").write_text('{"fingerprint": "", "snapshot": "x"}')
+    mock_run, _kernel, calls = make_kernel_mock()
+
+    with patch('core.firewall.run_shell_command', mock_run), patch('core.ipset_manager.run_shell_command', mock_run):
+        success, report = await reconciler.reconcile()
+
+    assert success is True
+    assert "восстановлены из снимка" in report
+    background = [call for call in calls if call.startswith("sh ")]
+    assert len(background) == 1 and background[0].endswith("&")
+    assert "--full" not in background[0]
+    assert calls.index("ipset -exist restore") < calls.index("iptables-restore --noflush")
+
+def test_state_record_roundtrip_and_legacy_format(tmp_path):
+    """Тест: запись состояния сохраняет правила с хэшем, прежний формат читается как режим."""
+    from core.firewall import FirewallState, read_state, write_state
+    path = str(tmp_path / "firewall_mode.state")
+    write_state(FirewallState.compile(MODE_ALL, "vmess", 10810), path)
+
+    state = read_state(path)
+    assert (state.mode, state.proxy, state.port) == (MODE_ALL, "vmess", 10810)
+    assert state.exclude == list(EXCLUDE_NETS)
+    assert state.rules[-1] == "-A KDW_PROXY -p tcp -j REDIRECT --to-ports 10810"
+    assert state.intact
+
+    (tmp_path / "firewall_mode.state").write_text("lists_only\n")
+    assert read_state(path).mode == MODE_LISTS
+    assert read_state(str(tmp_path / "missing")).mode == "flushed"
+
+@pytest.mark.asyncio
+async def test_reconcile_restores_recorded_all_traffic_rules(reconciler):
+    """Тест: режим 'весь трафик' восстанавливается по записи состояния, без kdw.cfg."""
+    from core.firewall import FirewallState, write_state
+    write_state(FirewallState.compile(MODE_ALL, "vmess", 10810), reconciler.state_file)
+    mock_run, kernel, calls = make_kernel_mock()
+
+    with patch('core.firewall.run_shell_command', mock_run), \
+            patch.object(reconciler, 'desired_port', side_effect=AssertionError("kdw.cfg не читается")):
+        success, _report = await reconciler.reconcile()
+
+    assert success is True
+    assert calls.count("iptables-restore --noflush") == 1
+    assert not any(call.startswith("sh ") for call in calls)
+    assert kernel["rules"][-1] == "-A KDW_PROXY -p tcp -j REDIRECT --to-ports 10810"
+
+@pytest.mark.asyncio
+async def test_reconcile_recompiles_tampered_rules(reconciler):
+    """Тест: правила, не совпадающие с хэшем, собираются заново по порту из записи."""
+    from core.firewall import FirewallState, write_state
+    state = FirewallState.compile(MODE_ALL, "vmess", 10810)
+    state.rules[-1] = "-A KDW_PROXY -p tcp -j REDIRECT --to-ports 1"
+    write_state(state, reconciler.state_file)
+    mock_run, kernel, _calls = make_kernel_mock()
+
+    with patch('core.firewall.run_shell_command', mock_run):
+        success, _report = await reconciler.reconcile()
+
+    assert success is True
+    assert kernel["rules"][-1] == "-A KDW_PROXY -p tcp -j REDIRECT --to-ports 10810"
+
+@pytest.mark.asyncio
+async def test_reconcile_migrates_referenced_legacy_set(reconciler):
+    """Тест: на ipset старого формата ссылаются правила - они снимаются до синхронизации и применяются заново."""
+    legacy_rule = "-A KDW_PROXY -p tcp -m set --match-set kdw_trojan_list dst -j REDIRECT --to-ports 10829"
+    kernel = {"rules": [":KDW_PROXY - [0:0]", "-A PREROUTING -j KDW_PROXY", legacy_rule],
+              "sets": ["kdw_trojan_list"], "legacy": {"kdw_trojan_list"}}
+    calls = []
+
+    async def side_effect(command):
+        calls.append(command.split(" <")[0])
+        if command == "iptables-save -t nat":
+            return True, "*nat\n:PREROUTING ACCEPT [0:0]\n" + "".join(f"{rule}\n" for rule in kernel["rules"]) + "COMMIT"
+        if command == "ipset -n list":
+            return True, "\n".join(kernel["sets"])
+        if command == "ipset list -t":
+            return True, "\n".join(f"Name: {name}\nType: {'hash:net' if name in kernel['legacy'] else 'list:set'}\nReferences: 0"
+                                   for name in kernel["sets"])
+        if command == "iptables -t nat -S PREROUTING":
+            return True, "-P PREROUTING ACCEPT" + ("\n-A PREROUTING -j KDW_PROXY" if "-A PREROUTING -j KDW_PROXY" in kernel["rules"] else "")
+        if command.startswith("sh ") and "apply_lists" in command:
+            # Как IpsetManager.sync: ipset, на который ссылаются правила, не заменяется
+            if not any("kdw_trojan_list " in rule for rule in kernel["rules"]):
+                kernel["legacy"].clear()
+                kernel["sets"] = ["kdw_trojan_list", "kdw_vmess_list", "kdw_direct_list"]
+        if command.startswith("iptables-restore"):
+            with open(command.split("< ")[1], encoding="utf-8") as f:
+                content = f.read().splitlines()
+            if f"-X KDW_PROXY" in content:
+                kernel["rules"] = []
+            else:
+                kernel["rules"] = [line for line in content if line.startswith(("-A", ":KDW"))]
+                kernel["rules"] += ["-A PREROUTING -j KDW_PROXY"] if "-I PREROUTING 1 -j KDW_PROXY" in content else []
+        return True, ""
+
+    mock_run = AsyncMock(side_effect=side_effect)
+    with patch('core.firewall.run_shell_command', mock_run), patch('core.ipset_manager.run_shell_command', mock_run):
+        success, report = await reconciler.reconcile()
+
+    assert success is True
+    assert "правила KDW сняты" in report
+    assert not kernel["legacy"]
+    sync = next(i for i, call in enumerate(calls) if call.startswith("sh "))
+    restores = [i for i, call in enumerate(calls) if call == "iptables-restore --noflush"]
+    assert restores[0] < sync < restores[-1]
+    assert any("--match-set kdw_trojan_list dst" in rule for rule in kernel["rules"])
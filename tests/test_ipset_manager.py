@@ -0,0 +1,333 @@
+import pytest
+import fcntl
+from unittest.mock import AsyncMock, patch
+from core.ipset_manager import IpsetManager, ipset_name, shard_name, dynamic_set_name, snapshot_lines, snapshot_digest, apply_lock, IPSET_TIMEOUT_GRACE, SHARD_FILL
+
+@pytest.fixture
+def ipset_manager(tmp_path):
+    """Фикстура для создания IpsetManager с временными файлами."""
+    with patch('core.ipset_manager.RESTORE_FILE', str(tmp_path / "kdw_ipset.restore")):
+        yield IpsetManager(state_file=str(tmp_path / "ipset.state.json"))
+
+def make_shell_mock(existing_sets, restore_errors=(), legacy_sets=(), referenced=()):
+    """
+    Создает мок run_shell_command. Содержимое каждого пакета ipset restore
+    сохраняется в batches; restore_errors - ответы на очередные вызовы restore.
+    existing_sets - имена существующих ipset: kdw_<список>_list - list:set,
+    остальные - hash:net с таймаутами. legacy_sets - hash:net без таймаутов,
+    referenced - ipset, на которые ссылаются правила iptables.
+    """
+    batches = []
+    errors = list(restore_errors)
+
+    def header(name, set_type, extra):
+        return (f"Name: {name}\nType: {set_type}\nHeader: {extra}\n"
+                f"References: {1 if name in referenced else 0}\nNumber of entries: 0")
+
+    async def side_effect(command):
+        if command == "ipset list -t":
+            headers = []
+            for name in existing_sets:
+                if name.endswith("_list"):
+                    headers.append(header(name, "list:set", "size 32"))
+                else:
+                    headers.append(header(name, "hash:net", "family inet hashsize 64 maxelem 65536 timeout 0"))
+            headers += [header(name, "hash:net", "family inet hashsize 1024 maxelem 65536") for name in legacy_sets]
+            return True, "\n".join(headers)
+        if "restore" in command:
+            with open(command.split("< ")[1], encoding="utf-8") as f:
+                batches.append(f.read().splitlines())
+            if errors:
+                return False, errors.pop(0)
+        return True, ""
+
+    return AsyncMock(side_effect=side_effect), batches
+
+@pytest.mark.asyncio
+async def test_sync_pushes_only_delta_in_one_batch(ipset_manager):
+    """Тест: разница загружается в ядро одним пакетом ipset restore."""
+    ipset_manager.save_state({"kdw_trojan_list_0": {"a.com": 0, "b.com": 0}})
+    mock_run, batches = make_shell_mock(["kdw_trojan_list", "kdw_trojan_list_dns", "kdw_trojan_list_0"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        success, report = await ipset_manager.sync({
+            "trojan": ["b.com", "c.com", "# comment"],
+            "vmess": ["1.2.3.0/24"],
+        })
+
+    assert success is True
+    assert batches == [[
+        "del kdw_trojan_list_0 a.com",
+        "add kdw_trojan_list_0 c.com",
+        "create kdw_vmess_list list:set size 33",
+        "create kdw_vmess_list_dns hash:net hashsize 64 maxelem 65536 timeout 0",
+        "add kdw_vmess_list kdw_vmess_list_dns",
+        "create kdw_vmess_list_0 hash:net hashsize 64 maxelem 65536 timeout 0",
+        "add kdw_vmess_list_0 1.2.3.0/24",
+        "add kdw_vmess_list kdw_vmess_list_0",
+    ]]
+    assert "trojan: 2 зап. (+1 -1)" in report
+    assert "vmess: 1 зап. (+1 -0)" in report
+    assert "Время применения" in report
+    assert ipset_manager.load_state() == {"kdw_trojan_list_0": {"b.com": 0, "c.com": 0}, "kdw_vmess_list_0": {"1.2.3.0/24": 0}}
+
+@pytest.mark.asyncio
+async def test_sync_skips_failed_entry_and_retries_rest(ipset_manager):
+    """Тест: ошибочная запись откладывается, остаток пакета загружается повторно."""
+    mock_run, batches = make_shell_mock([], ["ipset v7.1: Error in line 6: Syntax error: cannot resolve"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        success, report = await ipset_manager.sync({"trojan": ["a.com", "bad.invalid", "c.com"]})
+
+    assert success is True
+    assert batches[1] == ["add kdw_trojan_list_0 c.com", "add kdw_trojan_list kdw_trojan_list_0"]
+    assert "ошибок: 1" in report
+    assert ipset_manager.load_state() == {"kdw_trojan_list_0": {"a.com": 0, "c.com": 0}}
+
+@pytest.mark.asyncio
+async def test_sync_drops_ipv6_entries(ipset_manager):
+    """Тест: IPv6-записи не попадают в пакет, и повторное применение ничего не загружает."""
+    entries = [f"2001:db8:{i:x}::/48" for i in range(50)] + ["1.2.3.0/24"]
+    ipset_manager.save_state({"kdw_trojan_list_0": {}})
+    mock_run, batches = make_shell_mock(["kdw_trojan_list", "kdw_trojan_list_dns", "kdw_trojan_list_0"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        success, report = await ipset_manager.sync({"trojan": entries})
+        assert success is True
+        assert batches == [["add kdw_trojan_list_0 1.2.3.0/24"]]
+        assert "пропущено IPv6-записей: 50" in report
+
+        batches.clear()
+        await ipset_manager.sync({"trojan": entries})
+
+    assert batches == []
+
+@pytest.mark.asyncio
+async def test_sync_noop_when_unchanged(ipset_manager):
+    """Тест: при отсутствии изменений ipset restore не вызывается."""
+    ipset_manager.save_state({shard_name("trojan", 0): {"a.com": 0}})
+    mock_run, batches = make_shell_mock([ipset_name("trojan"), dynamic_set_name("trojan"), shard_name("trojan", 0)])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        await ipset_manager.sync({"trojan": ["a.com"]})
+
+    assert batches == []
+
+@pytest.mark.asyncio
+async def test_full_sync_uses_shadow_swap(ipset_manager):
+    """Тест: полная пересборка наполняет теневой ipset и меняет его с живым."""
+    ipset_manager.save_state({"kdw_trojan_list_0": {"old.com": 0}})
+    mock_run, batches = make_shell_mock(["kdw_trojan_list", "kdw_trojan_list_dns", "kdw_trojan_list_0"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        success, _report = await ipset_manager.sync({"trojan": ["a.com"]}, full=True)
+
+    assert success is True
+    assert batches == [[
+        "create kdw_trojan_list_0_tmp hash:net hashsize 64 maxelem 65536 timeout 0",
+        "flush kdw_trojan_list_0_tmp",
+        "add kdw_trojan_list_0_tmp a.com",
+        "swap kdw_trojan_list_0_tmp kdw_trojan_list_0",
+        "destroy kdw_trojan_list_0_tmp",
+    ]]
+    assert ipset_manager.load_state() == {"kdw_trojan_list_0": {"a.com": 0}}
+
+@pytest.mark.asyncio
+async def test_failed_swap_keeps_live_set_state(ipset_manager):
+    """Тест: если swap не выполнился, состояние живого ipset не меняется."""
+    ipset_manager.save_state({"kdw_trojan_list_0": {"old.com": 0}})
+    mock_run, _batches = make_shell_mock(["kdw_trojan_list", "kdw_trojan_list_dns", "kdw_trojan_list_0"], ["Error in line 4: Kernel error"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        success, report = await ipset_manager.sync({"trojan": ["a.com"]}, full=True)
+
+    assert success is False
+    assert "ipset оставлен без изменений" in report
+    assert ipset_manager.load_state() == {"kdw_trojan_list_0": {"old.com": 0}}
+
+@pytest.mark.asyncio
+async def test_resolved_ips_get_timeouts_and_refresh(ipset_manager):
+    """Тест: IP из DNS добавляются с таймаутом, продленные - повторным add."""
+    now = 1_000_000
+    ipset_manager.save_state({"kdw_trojan_list_0": {"1.1.1.1": now + 10, "2.2.2.2": now + 10, "10.0.0.0/8": 0}})
+    mock_run, batches = make_shell_mock(["kdw_trojan_list", "kdw_trojan_list_dns", "kdw_trojan_list_0"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run), patch('core.ipset_manager.time.time', return_value=now):
+        success, report = await ipset_manager.sync({"trojan": {
+            "1.1.1.1": now + 300,     # продлен
+            "2.2.2.2": now + 10,      # не изменился
+            "3.3.3.3": now + 60,      # новый
+            "4.4.4.4": now - IPSET_TIMEOUT_GRACE,  # уже истек в ядре
+            "10.0.0.0/8": 0,
+        }})
+
+    assert success is True
+    assert batches == [[
+        f"add kdw_trojan_list_0 1.1.1.1 timeout {300 + IPSET_TIMEOUT_GRACE}",
+        f"add kdw_trojan_list_0 3.3.3.3 timeout {60 + IPSET_TIMEOUT_GRACE}",
+    ]]
+    assert "trojan: 4 зап. (+1 -0), продлено: 1" in report
+    assert ipset_manager.load_state()["kdw_trojan_list_0"]["1.1.1.1"] == now + 300
+
+@pytest.mark.asyncio
+async def test_shard_without_timeouts_is_rebuilt(ipset_manager):
+    """Тест: часть без поддержки таймаутов пересобирается через теневой ipset."""
+    # Состояние старого формата: перечень записей без сроков
+    with open(ipset_manager.state_file, "w", encoding="utf-8") as f:
+        f.write('{"kdw_trojan_list_0": ["a.com"]}')
+    mock_run, batches = make_shell_mock(["kdw_trojan_list", "kdw_trojan_list_dns"], legacy_sets=["kdw_trojan_list_0"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        await ipset_manager.sync({"trojan": ["a.com"]})
+
+    assert batches[0][0] == "create kdw_trojan_list_0_tmp hash:net hashsize 64 maxelem 65536 timeout 0"
+    assert "swap kdw_trojan_list_0_tmp kdw_trojan_list_0" in batches[0]
+    assert ipset_manager.load_state() == {"kdw_trojan_list_0": {"a.com": 0}}
+
+@pytest.mark.asyncio
+async def test_legacy_hash_set_is_replaced_by_list_set(ipset_manager):
+    """Тест: одиночный hash:net старого формата заменяется на list:set, если на него нет ссылок."""
+    ipset_manager.save_state({"kdw_trojan_list": {"a.com": 0}})
+    mock_run, batches = make_shell_mock([], legacy_sets=["kdw_trojan_list"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        success, _report = await ipset_manager.sync({"trojan": ["a.com"]})
+
+    assert success is True
+    assert batches[0][:2] == ["destroy kdw_trojan_list", "create kdw_trojan_list list:set size 33"]
+    assert ipset_manager.load_state() == {"kdw_trojan_list_0": {"a.com": 0}}
+
+@pytest.mark.asyncio
+async def test_referenced_legacy_set_requires_firewall_reapply(ipset_manager):
+    """Тест: используемый iptables ipset старого формата не трогается."""
+    mock_run, batches = make_shell_mock([], legacy_sets=["kdw_trojan_list"], referenced=["kdw_trojan_list"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        success, report = await ipset_manager.sync({"trojan": ["a.com"]})
+
+    assert success is False
+    assert batches == []
+    assert "перепримените правила Firewall" in report
+
+@pytest.mark.asyncio
+async def test_large_list_is_sharded_and_sized(ipset_manager):
+    """Тест: большой список делится на части по размеру, части объединяются list:set."""
+    entries = [f"10.{i // 65536}.{i // 256 % 256}.{i % 256}" for i in range(SHARD_FILL + 10)]
+    mock_run, batches = make_shell_mock([])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        success, report = await ipset_manager.sync({"trojan": entries})
+
+    assert success is True
+    batch = batches[0]
+    creates = [line for line in batch if line.startswith("create kdw_trojan_list_") and "_dns" not in line]
+    assert len(creates) == 2
+    assert all("maxelem 65536" in line and "hashsize 16384" in line for line in creates)
+    assert "add kdw_trojan_list kdw_trojan_list_0" in batch
+    assert "add kdw_trojan_list kdw_trojan_list_1" in batch
+    state = ipset_manager.load_state()
+    assert len(state["kdw_trojan_list_0"]) + len(state["kdw_trojan_list_1"]) == len(entries)
+    assert f"trojan: {len(entries)} зап." in report and "частей ipset: 2" in report
+
+@pytest.mark.asyncio
+async def test_shrinking_list_removes_extra_shards(ipset_manager):
+    """Тест: лишние части удаляются из list:set и уничтожаются."""
+    ipset_manager.save_state({"kdw_trojan_list_0": {"a.com": 0}, "kdw_trojan_list_1": {"b.com": 0}})
+    mock_run, batches = make_shell_mock(["kdw_trojan_list", "kdw_trojan_list_dns", "kdw_trojan_list_0", "kdw_trojan_list_1"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        await ipset_manager.sync({"trojan": ["a.com", "b.com"]})
+
+    assert batches[0][-2:] == ["del kdw_trojan_list kdw_trojan_list_1", "destroy kdw_trojan_list_1"]
+    assert ipset_manager.load_state() == {"kdw_trojan_list_0": {"a.com": 0, "b.com": 0}}
+
+@pytest.mark.asyncio
+async def test_set_type_change_recreates_shard(ipset_manager):
+    """Тест: часть другого типа ipset пересоздается, swap между типами не используется."""
+    ipset_manager.save_state({"kdw_trojan_list_0": {"1.1.1.1": 0}})
+    mock_run, batches = make_shell_mock(["kdw_trojan_list", "kdw_trojan_list_dns", "kdw_trojan_list_0"])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        success, _report = await ipset_manager.sync({"trojan": ["1.1.1.1"]}, set_types={"trojan": "hash:ip"})
+
+    assert success is True
+    assert batches == [[
+        "del kdw_trojan_list kdw_trojan_list_0",
+        "destroy kdw_trojan_list_0",
+        "create kdw_trojan_list_0 hash:ip hashsize 64 maxelem 65536 timeout 0",
+        "add kdw_trojan_list_0 1.1.1.1",
+        "add kdw_trojan_list kdw_trojan_list_0",
+    ]]
+
+@pytest.mark.asyncio
+async def test_full_sync_keeps_dnsmasq_set(ipset_manager):
+    """Тест: часть dnsmasq создается один раз и не пересобирается при полной синхронизации."""
+    mock_run, batches = make_shell_mock([])
+
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        await ipset_manager.sync({"trojan": ["1.1.1.1"]})
+
+    assert "create kdw_trojan_list_dns hash:net hashsize 64 maxelem 65536 timeout 0" in batches[0]
+    assert "add kdw_trojan_list kdw_trojan_list_dns" in batches[0]
+
+    batches.clear()
+    mock_run, batches = make_shell_mock(["kdw_trojan_list", "kdw_trojan_list_dns", "kdw_trojan_list_0"])
+    with patch('core.ipset_manager.run_shell_command', mock_run):
+        await ipset_manager.sync({"trojan": ["1.1.1.1"]}, full=True)
+
+    assert batches and not any("kdw_trojan_list_dns" in line for line in batches[0])
+    assert "kdw_trojan_list_dns" not in ipset_manager.load_state()
+
+def test_snapshot_lines_put_creates_first():
+    """Тест: в снимок попадают только ipset KDW, все create раньше add."""
+    save_output = "\n".join([
+        "create kdw_trojan_list list:set size 32",
+        "add kdw_trojan_list kdw_trojan_list_0",
+        "create kdw_trojan_list_0 hash:net family inet hashsize 64 maxelem 65536 timeout 0",
+        "add kdw_trojan_list_0 1.2.3.0/24",
+        "create kdw_trojan_list_0_tmp hash:net family inet hashsize 64 maxelem 65536 timeout 0",
+        "create other hash:ip family inet hashsize 64 maxelem 65536",
+        "add other 10.0.0.1",
+    ])
+    assert snapshot_lines(save_output) == [
+        "create kdw_trojan_list list:set size 32",
+        "create kdw_trojan_list_0 hash:net family inet hashsize 64 maxelem 65536 timeout 0",
+        "add kdw_trojan_list kdw_trojan_list_0",
+        "add kdw_trojan_list_0 1.2.3.0/24",
+    ]
+
+def test_snapshot_digest_ignores_timeouts_and_dnsmasq_addresses():
+    """Тест: убывающие таймауты и адреса от dnsmasq не меняют хэш снимка."""
+    base = ["create kdw_trojan_list_0 hash:net family inet hashsize 64 maxelem 65536 timeout 0",
+            "add kdw_trojan_list_0 1.1.1.1 timeout 900"]
+    assert snapshot_digest(base) == snapshot_digest([
+        base[0], "add kdw_trojan_list_0 1.1.1.1 timeout 42", "add kdw_trojan_list_dns 5.5.5.5",
+    ])
+    assert snapshot_digest(base) != snapshot_digest(base + ["add kdw_trojan_list_0 2.2.2.2"])
+
+@pytest.mark.asyncio
+async def test_snapshot_saved_with_fingerprint_once(ipset_manager, tmp_path):
+    """Тест: снимок сохраняется с отпечатком состояния и не переписывается без изменений."""
+    ipset_manager.save_state({"kdw_trojan_list_0": {"a.com": 0}})
+    mock_run = AsyncMock(return_value=(True, "create kdw_trojan_list list:set size 32"))
+
+    with patch('core.ipset_manager.run_shell_command', mock_run), \
+            patch('core.ipset_manager.SNAPSHOT_FILE', str(tmp_path / "ipset.snapshot")), \
+            patch('core.ipset_manager.SNAPSHOT_META_FILE', str(tmp_path / "ipset.snapshot.json")):
+        assert (await ipset_manager.save_snapshot())[1] == "Снимок ipset сохранен."
+        assert (await ipset_manager.save_snapshot())[1] == "Снимок ipset не изменился."
+        assert await ipset_manager.restore_snapshot() == (True, True)
+
+        ipset_manager.save_state({"kdw_trojan_list_0": {"b.com": 0}})
+        assert await ipset_manager.restore_snapshot() == (True, False)
+
+def test_apply_lock_excludes_other_holders(tmp_path):
+    """Тест: пока блокировка применения занята, другой владелец ее не получит."""
+    path = str(tmp_path / "kdw_ipset.lock")
+    with apply_lock(path):
+        with open(path, 'a') as other:
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    with open(path, 'a') as other:
+        fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
@@ -1,8 +1,9 @@
 import pytest
 import asyncio
 import os
+import gzip
 from unittest.mock import AsyncMock, patch, mock_open
-from core.list_manager import ListManager, LISTS_DIR, UPDATE_SCRIPT
+from core.list_manager import ListManager, ListDiff, ApplyScheduler, shorten_entry, LISTS_DIR, UPDATE_SCRIPT, LIST_PAGE_SIZE, LIST_ENTRY_WIDTH
 
 @pytest.fixture
 def list_manager():
@@ -97,3 +98,291 @@ async def test_apply_changes_failure(list_manager):
         assert "Ошибка обновления списков" in message
         assert "Error output" in message
         assert "Error message" in message
+
+@pytest.mark.asyncio
+async def test_find_domain_index(list_manager, mock_lists_dir):
+    """Тест: поиск домена по индексу и его обновление при изменениях."""
+    (mock_lists_dir / "trojan.list").write_text("example.com\n")
+    (mock_lists_dir / "vmess.list").write_text("other.com\n")
+
+    assert list_manager.find_domain(" example.com ") == "trojan"
+    assert list_manager.find_domain("missing.com") is None
+
+    await list_manager.add_to_list("vmess", ["new.com"])
+    assert list_manager.find_domain("new.com") == "vmess"
+
+    await list_manager.move_domain("example.com", "trojan", "vmess")
+    assert list_manager.find_domain("example.com") == "vmess"
+
+    await list_manager.remove_from_list("vmess", ["new.com"])
+    assert list_manager.find_domain("new.com") is None
+
+@pytest.mark.asyncio
+async def test_find_domain_index_invalidated_by_mtime(list_manager, mock_lists_dir):
+    """Тест: индекс перечитывает файл, измененный извне."""
+    file_path = mock_lists_dir / "shadowsocks.list"
+    file_path.write_text("old.com\n")
+    assert list_manager.find_domain("old.com") == "shadowsocks"
+
+    file_path.write_text("fresh.com\n")
+    mtime = os.stat(file_path).st_mtime + 10
+    os.utime(file_path, (mtime, mtime))
+
+    assert list_manager.find_domain("old.com") is None
+    assert list_manager.find_domain("fresh.com") == "shadowsocks"
+
+@pytest.mark.asyncio
+async def test_find_domains_batch(list_manager, mock_lists_dir):
+    """Тест: пакетный поиск доменов во всех списках."""
+    (mock_lists_dir / "trojan.list").write_text("a.com\nb.com\n")
+    (mock_lists_dir / "vmess.list").write_text("c.com\n")
+
+    result = list_manager.find_domains(["c.com", " a.com", "x.com", "a.com", ""])
+    assert result == {"c.com": "vmess", "a.com": "trojan", "x.com": None}
+    assert list(result) == ["c.com", "a.com", "x.com"]
+
+@pytest.mark.asyncio
+async def test_suffix_matching(list_manager, mock_lists_dir):
+    """Тест: родительский домен покрывает поддомены."""
+    (mock_lists_dir / "trojan.list").write_text("example.com\n1.2.3.4\n")
+    (mock_lists_dir / "vmess.list").write_text("cdn.example.com\n")
+
+    assert list_manager.find_covering("a.b.example.com") == ("example.com", "trojan")
+    assert list_manager.find_covering("example.com") is None
+    assert list_manager.match_host("x.cdn.example.com") == "vmess"
+    assert list_manager.match_host("www.example.com") == "trojan"
+    assert list_manager.match_host("example.org") is None
+    assert list_manager.match_host("1.2.3.4") == "trojan"
+
+@pytest.mark.asyncio
+async def test_collapse_list(list_manager, mock_lists_dir):
+    """Тест: сжатие списка удаляет покрытые поддомены."""
+    file_path = mock_lists_dir / "trojan.list"
+    file_path.write_text("example.com\nwww.example.com\na.b.example.com\nother.com\n")
+
+    removed = await list_manager.collapse_list("trojan")
+    assert removed == ["a.b.example.com", "www.example.com"]
+    assert list_manager.read_list("trojan") == "example.com\nother.com\n"
+    assert await list_manager.collapse_list("trojan") == []
+
+@pytest.mark.asyncio
+async def test_journal_and_compaction(list_manager, mock_lists_dir):
+    """Тест: изменения пишутся в журнал и уплотняются в .list файл."""
+    file_path = mock_lists_dir / "trojan.list"
+    journal_path = mock_lists_dir / "trojan.list.journal"
+    file_path.write_text("b.com\nc.com\n")
+
+    assert await list_manager.add_to_list("trojan", ["a.com"]) is True
+    assert await list_manager.remove_from_list("trojan", ["c.com"]) is True
+    assert file_path.read_text() == "b.com\nc.com\n"
+    assert journal_path.read_text() == "+a.com\n-c.com\n"
+
+    # Новый экземпляр восстанавливает состояние, проигрывая журнал
+    assert ListManager().find_domains(["a.com", "c.com"]) == {"a.com": "trojan", "c.com": None}
+
+    list_manager.compact("trojan")
+    assert file_path.read_text() == "a.com\nb.com\n"
+    assert not journal_path.exists()
+    assert not (mock_lists_dir / "trojan.list.tmp").exists()
+
+@pytest.mark.asyncio
+async def test_apply_changes_keeps_journal(list_manager, mock_lists_dir):
+    """Тест: применение изменений не уплотняет журнал и не переписывает .list."""
+    (mock_lists_dir / "trojan.list").write_text("b.com\n")
+    diff = await list_manager.transaction().add("trojan", ["a.com"]).commit()
+
+    with patch('core.list_manager.UPDATE_SCRIPT', str(mock_lists_dir / "apply_lists.sh")), \
+            patch('os.path.exists', return_value=True), \
+            patch('core.list_manager.run_shell_command', AsyncMock(return_value=(True, ""))):
+        success, _message = await list_manager.apply_changes(diff)
+
+    assert success is True
+    assert (mock_lists_dir / "trojan.list").read_text() == "b.com\n"
+    assert (mock_lists_dir / "trojan.list.journal").read_text() == "+a.com\n"
+
+@pytest.mark.asyncio
+async def test_torn_journal_line_is_discarded(list_manager, mock_lists_dir):
+    """Тест: оборванная сбоем строка журнала не применяется и отрезается."""
+    (mock_lists_dir / "trojan.list").write_text("a.com\n")
+    journal_path = mock_lists_dir / "trojan.list.journal"
+    journal_path.write_text("+b.com\n+goo")
+
+    assert sorted(list_manager.get_entries("trojan")) == ["a.com", "b.com"]
+    assert journal_path.read_text() == "+b.com\n"
+
+    await list_manager.add_to_list("trojan", ["google.com"])
+    assert sorted(ListManager().get_entries("trojan")) == ["a.com", "b.com", "google.com"]
+
+@pytest.mark.asyncio
+async def test_journal_compacts_at_threshold(list_manager, mock_lists_dir):
+    """Тест: журнал уплотняется автоматически по достижении порога."""
+    with patch('core.list_manager.JOURNAL_COMPACT_THRESHOLD', 3):
+        await list_manager.add_to_list("vmess", ["a.com", "b.com"])
+        assert (mock_lists_dir / "vmess.list.journal").exists()
+        await list_manager.add_to_list("vmess", ["c.com"])
+
+    assert not (mock_lists_dir / "vmess.list.journal").exists()
+    assert (mock_lists_dir / "vmess.list").read_text() == "a.com\nb.com\nc.com\n"
+
+@pytest.mark.asyncio
+async def test_transaction_single_write_per_list(list_manager, mock_lists_dir):
+    """Тест: транзакция пишет в каждый затронутый список один раз и возвращает diff."""
+    (mock_lists_dir / "trojan.list").write_text("a.com\nb.com\n")
+    (mock_lists_dir / "vmess.list").write_text("c.com\n")
+
+    tx = list_manager.transaction()
+    tx.move("a.com", "trojan", "vmess")
+    tx.move("b.com", "trojan", "vmess")
+    tx.add("vmess", ["c.com", "d.com"])
+    tx.remove("shadowsocks", ["missing.com"])
+
+    with patch.object(list_manager, '_commit_ops', wraps=list_manager._commit_ops) as commit_ops:
+        diff = await tx.commit()
+
+    assert commit_ops.call_count == 2
+    assert diff.added == {"trojan": set(), "vmess": {"a.com", "b.com", "d.com"}}
+    assert diff.removed == {"trojan": {"a.com", "b.com"}, "vmess": set()}
+    assert diff.touched_lists() == ["trojan", "vmess"]
+    assert list_manager.find_domains(["a.com", "d.com"]) == {"a.com": "vmess", "d.com": "vmess"}
+
+    assert not await list_manager.transaction().add("vmess", ["a.com"]).commit()
+
+@pytest.mark.asyncio
+async def test_transaction_normalizes_entries(list_manager, mock_lists_dir):
+    """Тест: транзакция нормализует записи, а удаление находит и старую, и нормализованную форму."""
+    (mock_lists_dir / "trojan.list").write_text("Legacy.COM\n")
+
+    diff = await list_manager.transaction().add("trojan", ["https://Example.com/path", "*.Пример.рф", "bad_domain"]).commit()
+    assert diff.added == {"trojan": {"example.com", "xn--e1afmkfd.xn--p1ai"}}
+
+    diff = await list_manager.transaction().remove("trojan", ["Legacy.COM", "EXAMPLE.com"]).commit()
+    assert diff.removed == {"trojan": {"Legacy.COM", "example.com"}}
+
+@pytest.mark.asyncio
+async def test_import_entries_in_chunks(list_manager, mock_lists_dir):
+    """Тест: импорт читает строки порциями, пропускает чужие, повторные и покрытые записи и уплотняет журнал один раз."""
+    (mock_lists_dir / "trojan.list").write_text("a.com\n")
+    (mock_lists_dir / "vmess.list").write_text("foreign.com\n")
+    lines = (line for line in ["a.com", "foreign.com", "B.com", "b.com", "bad_domain", "# comment", "sub.a.com"]
+             + [f"host{i}.example.com" for i in range(25)])
+    progress = AsyncMock()
+
+    with patch.object(list_manager, 'compact', wraps=list_manager.compact) as compact:
+        result = await list_manager.import_entries("trojan", lines, progress, chunk_size=10, skip_covered=True)
+
+    assert progress.await_count == 4
+    assert compact.call_count == 1
+    assert (result.lines, result.added, result.existing, result.foreign, result.covered, result.rejected) == (32, 26, 2, 1, 1, 1)
+    assert result.diff.touched_lists() == ["trojan"] and len(result.diff.added["trojan"]) == 26
+    assert not (mock_lists_dir / "trojan.list.journal").exists()
+    content = (mock_lists_dir / "trojan.list").read_text().split()
+    assert len(content) == 27 and "b.com" in content and "foreign.com" not in content
+
+def test_shorten_entry_fits_page_into_message():
+    """Тест: страница из самых длинных записей помещается в сообщение Telegram."""
+    long_entry = ".".join(["a" * 63] * 3) + ".com"
+    short = shorten_entry(long_entry)
+    assert len(short) == LIST_ENTRY_WIDTH
+    assert short.startswith("aaa") and short.endswith(".com") and "…" in short
+    assert shorten_entry("example.com") == "example.com"
+    assert len("\n".join([short] * LIST_PAGE_SIZE)) < 4096 - 200
+
+@pytest.mark.asyncio
+async def test_import_keeps_subdomains_without_dnsmasq(list_manager, mock_lists_dir):
+    """Тест: без покрытия через dnsmasq поддомен импортируется, а не пропускается."""
+    (mock_lists_dir / "trojan.list").write_text("example.com\n")
+
+    result = await list_manager.import_entries("trojan", ["cdn.example.com"])
+
+    assert (result.added, result.covered) == (1, 0)
+    assert list_manager.find_coverings(["cdn.example.com", "other.com"]) == {
+        "cdn.example.com": ("example.com", "trojan"), "other.com": None,
+    }
+
+@pytest.mark.asyncio
+async def test_get_page_and_export(list_manager, mock_lists_dir):
+    """Тест: страница берется из отсортированного индекса, который сбрасывается при изменении списка."""
+    (mock_lists_dir / "trojan.list").write_text("".join(f"d{i:03}.com\n" for i in range(120)))
+
+    entries, page, pages = list_manager.get_page("trojan", 1)
+    assert (entries[0], len(entries), page, pages) == ("d050.com", 50, 1, 3)
+    assert list_manager.get_page("trojan", 99)[1:] == (2, 3)
+    assert list_manager.sorted_entries("trojan") is list_manager.sorted_entries("trojan")
+
+    await list_manager.add_to_list("trojan", ["a.com"])
+    assert list_manager.get_page("trojan", 0)[0][0] == "a.com"
+    assert gzip.decompress(list_manager.export_gzip("trojan")).decode().splitlines()[:2] == ["a.com", "d000.com"]
+
+@pytest.mark.asyncio
+async def test_search_ranks_matches(list_manager, mock_lists_dir):
+    """Тест: поиск по всем спискам - точное совпадение, родитель, поддомены, начало и вхождение."""
+    (mock_lists_dir / "trojan.list").write_text("google.com\nmail.google.com\ngoogleapis.com\n")
+    (mock_lists_dir / "vmess.list").write_text("docs.google.com\nnotgoogle.com\n")
+
+    assert list_manager.search("google.com") == [
+        ("google.com", "trojan", "точное"),
+        ("docs.google.com", "vmess", "поддомен"),
+        ("mail.google.com", "trojan", "поддомен"),
+        ("notgoogle.com", "vmess", "вхождение"),
+    ]
+    assert [entry for entry, _, _ in list_manager.search("*.google.com")] == ["google.com", "docs.google.com", "mail.google.com"]
+    assert list_manager.search("a.mail.google.com")[0] == ("mail.google.com", "trojan", "родитель")
+    assert list_manager.search("googl", limit=2) == [("google.com", "trojan", "начало"), ("googleapis.com", "trojan", "начало")]
+
+    # Индекс пересобирается после изменения списка
+    await list_manager.add_to_list("vmess", ["maps.google.com"])
+    assert ("maps.google.com", "vmess", "поддомен") in list_manager.search("*.google.com")
+
+@pytest.mark.asyncio
+async def test_apply_changes_empty_diff(list_manager):
+    """Тест: пустой diff не запускает обновление."""
+    diff = await list_manager.transaction().commit()
+    with patch('core.list_manager.run_shell_command', new_callable=AsyncMock) as mock_run:
+        success, message = await list_manager.apply_changes(diff)
+    assert success is True
+    mock_run.assert_not_called()
+
+def test_list_diff_merge():
+    """Тест: при объединении изменений побеждает последняя операция над записью."""
+    first, second = ListDiff(), ListDiff()
+    first.added["trojan"] = {"a.com", "b.com"}
+    second.removed["trojan"] = {"a.com"}
+    second.added["vmess"] = {"a.com"}
+
+    first.merge(second)
+    assert first.added == {"trojan": {"b.com"}, "vmess": {"a.com"}}
+    assert first.removed == {"trojan": {"a.com"}}
+
+@pytest.mark.asyncio
+async def test_apply_scheduler_coalesces_and_serializes(list_manager):
+    """Тест: правки в пределах окна применяются одним запуском, запуски не пересекаются."""
+    running = 0
+    calls = []
+
+    async def fake_apply(diff=None):
+        nonlocal running
+        running += 1
+        assert running == 1
+        calls.append(diff.touched_lists() if diff is not None else None)
+        await asyncio.sleep(0.02)
+        running -= 1
+        return True, "ok"
+
+    scheduler = ApplyScheduler(list_manager, delay=0.01)
+    diffs = []
+    for name in ("trojan", "vmess", "trojan"):
+        diff = ListDiff()
+        diff.added[name] = {f"{name}.com"}
+        diffs.append(diff)
+
+    with patch.object(list_manager, 'apply_changes', side_effect=fake_apply):
+        futures = [scheduler.schedule(diff) for diff in diffs]
+        assert futures[0] is futures[1] is futures[2]
+        await asyncio.sleep(0.015)
+        # Правка во время выполнения уходит в следующий запуск
+        later = scheduler.schedule(None)
+        assert later is not futures[0]
+        assert await futures[0] == (True, "ok")
+        assert await later == (True, "ok")
+
+    assert calls == [["trojan", "vmess"], None]
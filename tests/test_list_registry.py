@@ -0,0 +1,34 @@
+import pytest
+from configparser import ConfigParser
+from core.list_registry import ListRegistry, ListSpec, parse_list_spec, DEFAULT_LISTS
+
+
+def make_config(text):
+    config = ConfigParser()
+    config.read_string(text)
+    return config
+
+def test_parse_list_spec():
+    """Тест: разбор порта, direct и типа ipset."""
+    assert parse_list_spec("Trojan", "10829") == ListSpec("trojan", 10829, "hash:net")
+    assert parse_list_spec("direct", "direct hash:ip") == ListSpec("direct", None, "hash:ip")
+    for value in ("", "port", "70000", "1080 hash:mac", "1080 hash:net extra"):
+        with pytest.raises(ValueError):
+            parse_list_spec("trojan", value)
+
+def test_registry_from_config():
+    """Тест: реестр строится из [lists], некорректные строки пропускаются."""
+    registry = ListRegistry.from_config(make_config(
+        "[lists]\nyoutube = 10829\ntrojan = 10829 hash:ip\nlocal = direct\nbroken = abc\n"
+    ))
+    assert registry.names() == ["youtube", "trojan", "local"]
+    assert registry.port("youtube") == 10829
+    assert registry.port("local") is None and registry.get("local").direct
+    assert registry.get("trojan").set_type == "hash:ip"
+    assert "broken" not in registry
+
+def test_registry_defaults_without_section():
+    """Тест: без секции [lists] используются списки по умолчанию."""
+    registry = ListRegistry.from_config(make_config("[kdw.settings]\n"))
+    assert registry.names() == list(DEFAULT_LISTS)
+    assert registry.port("trojan") == 10829
@@ -0,0 +1,68 @@
+import time
+import pytest
+from core.net_utils import aggregate_networks, normalize_entry, normalize_entries
+
+def test_aggregate_overlapping_and_adjacent_ipv4():
+    """Тест: вложенные и смежные подсети IPv4 сливаются в минимальный набор."""
+    networks, eliminated = aggregate_networks([
+        "10.0.0.0/24", "10.0.1.0/24",    # смежные -> 10.0.0.0/23
+        "10.0.0.128/25", "10.0.0.5",     # вложены в 10.0.0.0/24
+        "192.168.1.1", "192.168.1.0/32", # смежные адреса -> 192.168.1.0/31
+        "172.16.0.0/16",
+    ])
+
+    assert networks == ["10.0.0.0/23", "172.16.0.0/16", "192.168.1.0/31"]
+    assert eliminated == 4
+
+def test_aggregate_range_split_into_prefixes():
+    """Тест: объединенный интервал, не кратный префиксу, раскладывается на несколько CIDR."""
+    networks, eliminated = aggregate_networks(["10.0.0.0/24", "10.0.1.0/24", "10.0.2.0/24"])
+
+    assert networks == ["10.0.0.0/23", "10.0.2.0/24"]
+    assert eliminated == 1
+
+def test_aggregate_ipv6_kept_separate():
+    """Тест: IPv6 агрегируется отдельно от IPv4, одиночные адреса без /128."""
+    networks, eliminated = aggregate_networks(["2001:db8::/33", "2001:db8:8000::/33", "2001:db8::1", "1.1.1.1"])
+
+    assert networks == ["1.1.1.1", "2001:db8::/32"]
+    assert eliminated == 2
+
+def test_aggregate_invalid_entry():
+    """Тест: некорректная запись приводит к ValueError."""
+    with pytest.raises(ValueError):
+        aggregate_networks(["example.com"])
+
+@pytest.mark.parametrize("raw, expected", [
+    ("Example.COM.", "example.com"),
+    ("https://user@Sub.Example.com:8443/path?q=1", "sub.example.com"),
+    ("*.google.com", "google.com"),
+    ("пример.рф", "xn--e1afmkfd.xn--p1ai"),
+    ("10.0.0.1/8", "10.0.0.0/8"),
+    ("1.2.3.4/32", "1.2.3.4"),
+    ("http://1.2.3.4:8080/x", "1.2.3.4"),
+    ("[2001:db8::1]:443", "2001:db8::1"),
+    ("# комментарий", None),
+])
+def test_normalize_entry(raw, expected):
+    """Тест: URL, регистр, IDN, порты, маски и подсети приводятся к единому виду."""
+    assert normalize_entry(raw) == expected
+
+@pytest.mark.parametrize("raw", ["localhost", "bad_domain.com", "-x.com", "host.123", "a..b.com"])
+def test_normalize_entry_rejects(raw):
+    """Тест: некорректные записи отклоняются."""
+    with pytest.raises(ValueError):
+        normalize_entry(raw)
+
+def test_normalize_entries_bulk():
+    """Тест: пакет из 100 тыс. строк нормализуется быстрее секунды с отчетом об отказах и повторах."""
+    lines = [f"https://Domain{i}.Example.com/page" for i in range(100_000)] + ["Domain1.example.com", "not a domain", ""]
+
+    started = time.monotonic()
+    result = normalize_entries(lines)
+
+    assert time.monotonic() - started < 1.0
+    assert len(result.entries) == 100_000
+    assert result.entries[0] == "domain0.example.com"
+    assert result.duplicates == 1
+    assert result.rejected == ["not a domain"]
@@ -0,0 +1,109 @@
+import pytest
+import pytest_asyncio
+import asyncio
+import time
+import struct
+import socket
+from core.resolver import DnsResolver, ResolveCache, build_query, parse_response, split_entries, RESOLVED, FAILED, TIMED_OUT
+
+# Ответы тестового DNS-сервера: домен -> список (IP, TTL) или None (не отвечать)
+ZONE = {
+    "example.com": [("93.184.216.34", 300)],
+    "cdn.example.com": [("10.0.0.1", 60), ("10.0.0.2", 60)],
+    "slow.example.com": None,
+}
+
+def build_response(query: bytes) -> bytes | None:
+    """Собирает DNS-ответ на запрос тестового резолвера."""
+    query_id = struct.unpack("!H", query[:2])[0]
+    labels, offset = [], 12
+    while query[offset]:
+        length = query[offset]
+        labels.append(query[offset + 1:offset + 1 + length].decode())
+        offset += length + 1
+    question = query[12:offset + 5]
+    domain = ".".join(labels)
+
+    if domain in ZONE and ZONE[domain] is None:
+        return None
+    records = ZONE.get(domain, [])
+    rcode = 0 if domain in ZONE else 3
+    answers = b"".join(
+        b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, ttl, 4) + socket.inet_aton(ip)
+        for ip, ttl in records
+    )
+    header = struct.pack("!HHHHHH", query_id, 0x8180 | rcode, 1, len(records), 0, 0)
+    return header + question + answers
+
+class FakeDnsServer(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        response = build_response(data)
+        if response:
+            self.transport.sendto(response, addr)
+
+@pytest_asyncio.fixture
+async def dns_server():
+    """Фикстура: локальный UDP DNS-сервер с тестовой зоной."""
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(FakeDnsServer, local_addr=("127.0.0.1", 0))
+    yield transport.get_extra_info("sockname")[1]
+    transport.close()
+
+def test_split_entries():
+    """Тест: записи делятся на IP/подсети и домены."""
+    networks, domains = split_entries(["1.2.3.4", "10.0.0.0/8", "example.com", "# comment", ""])
+    assert networks == {"1.2.3.4", "10.0.0.0/8"}
+    assert domains == {"example.com"}
+
+def test_parse_response_roundtrip():
+    """Тест: разбор ответа возвращает все A-записи с TTL."""
+    response = build_response(build_query("cdn.example.com", 4242))
+    assert parse_response(response, 4242) == (0, [("10.0.0.1", 60), ("10.0.0.2", 60)])
+
+@pytest.mark.asyncio
+async def test_resolve_statuses(dns_server):
+    """Тест: разрешенные, несуществующие и зависшие домены."""
+    resolver = DnsResolver(nameserver="127.0.0.1", port=dns_server, timeout=0.2, attempts=1)
+    results = await resolver.resolve_many(["example.com", "missing.example.com", "slow.example.com"])
+
+    assert results["example.com"] == (RESOLVED, [("93.184.216.34", 300)])
+    assert results["missing.example.com"] == (FAILED, [])
+    assert results["slow.example.com"] == (TIMED_OUT, [])
+
+@pytest.mark.asyncio
+async def test_resolve_lists_builds_ip_sets(dns_server):
+    """Тест: списки превращаются в наборы IP со статистикой по каждому списку."""
+    resolver = DnsResolver(nameserver="127.0.0.1", port=dns_server, timeout=0.2, attempts=1)
+    ip_sets, stats = await resolver.resolve_lists({
+        "trojan": ["example.com", "cdn.example.com", "192.168.1.0/24"],
+        "vmess": ["slow.example.com", "missing.example.com"],
+    })
+
+    assert set(ip_sets["trojan"]) == {"93.184.216.34", "10.0.0.1", "10.0.0.2", "192.168.1.0/24"}
+    assert ip_sets["trojan"]["192.168.1.0/24"] == 0
+    assert ip_sets["vmess"] == {}
+    assert (stats["trojan"].resolved, stats["trojan"].total) == (2, 2)
+    assert (stats["vmess"].failed, stats["vmess"].timed_out) == (1, 1)
+
+@pytest.mark.asyncio
+async def test_cache_resolves_only_expired_domains(dns_server, tmp_path):
+    """Тест: свежие домены берутся из кэша, устаревшие разрешаются повторно."""
+    cache = ResolveCache(cache_file=str(tmp_path / "dns_cache.json"), min_ttl=0)
+    cache.update("example.com", [("1.1.1.1", 100)], now=int(time.time()))
+    cache.update("cdn.example.com", [("9.9.9.9", 100)], now=0)
+    resolver = DnsResolver(nameserver="127.0.0.1", port=dns_server, timeout=0.2, attempts=1)
+
+    ip_sets, stats = await resolver.resolve_lists({"trojan": ["example.com", "cdn.example.com"]}, cache=cache)
+
+    # example.com свеж - адрес из кэша, cdn.example.com устарел - получены новые адреса
+    assert set(ip_sets["trojan"]) == {"1.1.1.1", "10.0.0.1", "10.0.0.2"}
+    assert (stats["trojan"].cached, stats["trojan"].resolved) == (1, 1)
+
+    cache.save()
+    reloaded = ResolveCache(cache_file=cache.cache_file)
+    reloaded.load()
+    assert reloaded.get("cdn.example.com")[0] == ["10.0.0.1", "10.0.0.2"]
+    assert not reloaded.expired(["example.com", "cdn.example.com"])
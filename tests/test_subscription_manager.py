@@ -0,0 +1,98 @@
+import os
+import pytest
+import httpx
+from unittest.mock import patch
+from core.list_manager import ListManager
+from core.subscription_manager import SubscriptionManager, normalize_line
+
+@pytest.fixture
+def list_manager(tmp_path):
+    """Фикстура: ListManager во временной директории списков."""
+    lists_dir = tmp_path / "lists"
+    lists_dir.mkdir()
+    with patch('core.list_manager.LISTS_DIR', str(lists_dir)):
+        yield ListManager()
+
+def make_manager(list_manager, tmp_path, sources):
+    """Создает SubscriptionManager с временными файлами состояния."""
+    return SubscriptionManager(list_manager, sources,
+                               state_file=str(tmp_path / "subscriptions.state.json"),
+                               snapshots_dir=str(tmp_path / "subscriptions"))
+
+def test_normalize_line():
+    """Тест: комментарии, hosts-формат и регистр."""
+    assert normalize_line("  https://Example.COM./path  ") == "example.com"
+    assert normalize_line("0.0.0.0 ads.example.com # трекер") == "ads.example.com"
+    assert normalize_line("# комментарий") is None
+    assert normalize_line("") is None
+
+@pytest.mark.asyncio
+async def test_file_subscription_applies_only_delta(list_manager, tmp_path):
+    """Тест: из локального источника применяется только разница с прошлой загрузкой."""
+    source = tmp_path / "community.lst"
+    source.write_text("a.com\nb.com\nB.com\n")
+    manager = make_manager(list_manager, tmp_path, {"trojan": [str(source)]})
+
+    diff, _report = await manager.refresh()
+    assert diff.added == {"trojan": {"a.com", "b.com"}}
+
+    # Файл не изменился - повторное чтение не выполняется
+    diff, report = await manager.refresh()
+    assert not diff
+    assert "без изменений" in report
+
+    source.write_text("b.com\nc.com\n")
+    os.utime(source, (1, 1))
+    diff, _report = await manager.refresh()
+    assert diff.added == {"trojan": {"c.com"}}
+    assert diff.removed == {"trojan": {"a.com"}}
+    assert list_manager.get_entries("trojan") == {"b.com", "c.com"}
+
+@pytest.mark.asyncio
+async def test_subscription_skips_domains_from_other_lists(list_manager, tmp_path):
+    """Тест: домены, уже распределенные в другой список, подписка не добавляет."""
+    await list_manager.add_to_list("vmess", ["a.com"])
+    source = tmp_path / "community.lst"
+    source.write_text("a.com\nb.com\n")
+    manager = make_manager(list_manager, tmp_path, {"trojan": [str(source)]})
+
+    diff, report = await manager.refresh()
+
+    assert diff.added == {"trojan": {"b.com"}}
+    assert "пропущено 1" in report
+
+@pytest.mark.asyncio
+async def test_removed_source_drops_its_entries(list_manager, tmp_path):
+    """Тест: запись удаляется, только если ее нет ни в одном оставшемся источнике."""
+    first, second = tmp_path / "first.lst", tmp_path / "second.lst"
+    first.write_text("a.com\nshared.com\n")
+    second.write_text("shared.com\n")
+    await make_manager(list_manager, tmp_path, {"trojan": [str(first), str(second)]}).refresh()
+
+    diff, _report = await make_manager(list_manager, tmp_path, {"trojan": [str(second)]}).refresh()
+
+    assert diff.removed == {"trojan": {"a.com"}}
+    assert list_manager.get_entries("trojan") == {"shared.com"}
+
+@pytest.mark.asyncio
+async def test_http_subscription_uses_conditional_request(list_manager, tmp_path):
+    """Тест: повторная загрузка по HTTP отправляет If-None-Match и обрабатывает 304."""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, text="a.com\nb.com\n", headers={"ETag": '"v1"'})
+
+    real_client = httpx.AsyncClient
+    manager = make_manager(list_manager, tmp_path, {"trojan": ["https://lists.example/community.lst"]})
+    with patch('core.subscription_manager.httpx.AsyncClient',
+               lambda **kwargs: real_client(transport=httpx.MockTransport(handler), **kwargs)):
+        diff, _report = await manager.refresh()
+        assert diff.added == {"trojan": {"a.com", "b.com"}}
+
+        diff, _report = await manager.refresh()
+        assert not diff
+
+    assert requests[1].headers["If-None-Match"] == '"v1"'